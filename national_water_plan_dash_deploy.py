@@ -1,17 +1,195 @@
 # Deployed Version of National Water Plan Dashapp
 
+import argparse
+import collections
+import contextvars
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from dash import Dash, html, dcc, callback
-from dash.dependencies import Input, Output, State
+from dash import Dash, html, dcc, ctx, no_update, DiskcacheManager, Patch
+from dash import callback as dash_callback
+from dash.dependencies import Input, Output, State, handle_grouped_callback_args
+from flask import Response, abort, jsonify, request, stream_with_context
 import plotly_express as px
+import plotly.graph_objects as go
+from plotly.io.json import to_json_plotly
 import dash_bootstrap_components as dbc
+import diskcache
+import pyarrow as pa
+import pyarrow.dataset
 import gunicorn
+from national_water_plan_query import (SELECTION_COLUMNS, PandasBackend, RowBitmaps, SiteLocator, build_sqlite_database,
+                                       pack_rows, selection_mask)
+from national_water_plan_releases import CHANGE_GROUPS, OTHER_GROUP, STATUSES, diff_releases, release_summary
+from national_water_plan_scenarios import ScenarioEngine, projected_bands, scenario
+from national_water_plan_tiles import MAX_ZOOM, TileSet
 
 
 github_path = 'https://raw.githubusercontent.com/twrighta/national-water-plan-dashapp/main/national_water_plan.csv'
 
-df = pd.read_csv(github_path)  # Read csv from github
+# Partitioned dataset store - one directory per plan release and water company, written by
+# national_water_plan_processing.py --dataset-dir: <NWP_DATASET_DIR>/Release=<release>/Water company=<company>/
+# When it is set, only the NWP_RELEASE partitions are loaded into df. Other releases and per-company reads go
+# through load_sites(), which only reads the partitions (and columns) asked for.
+DATASET_DIR = os.environ.get("NWP_DATASET_DIR")
+DATASET_RELEASE = os.environ.get("NWP_RELEASE", "2020-2022")
+PARTITION_COLUMNS = ["Release", "Water company"]
+
+
+def load_sites(release=DATASET_RELEASE, companies=None, columns=None):
+    filters = [("Release", "==", release)]
+    if companies is not None:
+        filters.append(("Water company", "in", [str(company) for company in companies]))
+    if columns is not None:
+        columns = [column for column in columns if column not in PARTITION_COLUMNS] + ["Water company"]
+
+    sites = pd.read_parquet(DATASET_DIR, filters=filters, columns=columns)
+    # Partition values come back as categoricals at the end - restore them to the CSV's layout
+    company_column = sites.pop("Water company").astype(str)
+    sites = sites.drop(columns=[column for column in PARTITION_COLUMNS if column in sites.columns])
+    sites.insert(1 if "ID" in sites.columns else 0, "Water company", company_column)
+    if "ID" in sites.columns:
+        sites = sites.sort_values(by="ID", kind="stable")
+    return sites.reset_index(drop=True)
+
+
+def available_releases():
+    if DATASET_DIR is None:
+        return [DATASET_RELEASE]
+    return sorted(entry.split("=", 1)[1] for entry in os.listdir(DATASET_DIR) if entry.startswith("Release="))
+
+
+# Identifies the store's partitions of the given releases (all of them by default) by their files' paths, sizes
+# and modification times, so anything kept from a release is dropped once it is rewritten. None without a store.
+def store_fingerprint(releases=None):
+    if DATASET_DIR is None:
+        return None
+    digest = hashlib.sha256()
+    for release in sorted(available_releases() if releases is None else set(releases)):
+        for directory, _, names in sorted(os.walk(os.path.join(DATASET_DIR, f"Release={release}"))):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                status = os.stat(path)
+                digest.update(json.dumps([os.path.relpath(path, DATASET_DIR), status.st_size,
+                                          status.st_mtime_ns]).encode())
+    return digest.hexdigest()[:16]
+
+
+# Column groups
+OVERFLOW_LOC_FLAGS = ["Bathing Water Discharge Flag",
+                      "Ecological High Priority Site Flag",
+                      "Non-bathing Priority Site Flag",
+                      "Shellfish Water Discharge Flag"]
+IMPROVEMENT_COLUMNS = ["Storage", "Mew screen", "Other improvements to be confirmed", "Nature-Based",
+                       "Increased pass forward flow", "Bespoke solution", "Sealing of sewers", "Operational",
+                       "Smart sewers", "Spill treatment"]
+# Columns a site either has set or not ("Yes"/"No" flags and the 0/1 improvement columns) - any of them can be
+# combined as a filter, with all or any of them required
+BOOLEAN_FILTER_COLUMNS = OVERFLOW_LOC_FLAGS + ["Baseline Less than Target Flag"] + IMPROVEMENT_COLUMNS
+FUTURES_GEOGRAPHIES = ["Water company", "Receiving Environment", "River Basin District", "Management Catchment",
+                       "Local Authority", "Water Body"]
+SPILL_EVENT_COLUMNS = ["Spill Events 2020", "Spill Events 2021", "Spill Events 2022", "All Spill Events"]
+PROJECTED_SPILL_COLUMNS = ["2025 Projected Spills", "2030 Projected Spills", "2035 Projected Spills",
+                           "2040 Projected Spills", "2045 Projected Spills", "2050 Projected Spills"]
+REQUIREMENT_COLUMNS = ["Meets 2025 Requirements", "Meets 2030 Requirements", "Meets 2035 Requirements",
+                       "Meets 2040 Requirements", "Meets 2045 Requirements", "Meets 2050 Requirements"]
+NEAR_SITE_COLUMNS = ["ID", "Site name", "Water company", "Receiving Environment", "Latitude", "Longitude"]
+
+# COLUMN USAGE - the columns each part of the dashboard reads: what is built from df at load time, then each
+# callback that selects rows (by function name). Only their union, LOADED_COLUMNS, is kept in df - the rest of
+# the processed dataset (e.g. the Marine Protected Area and target delivery flags) is never read from the parquet
+# store, and dropped from the CSV as soon as it is read and measured.
+# Within a callback listed here, select_rows() materializes just its own columns of the rows it selects (see
+# ROW SELECTION); a callback not listed gets every loaded column. A new chart reading another column must
+# declare it here. NWP_LOAD_COLUMNS=all loads every column, as before. /stats/columns reports the saving.
+COLUMN_USAGE = {
+    # Load time
+    "row selection": FUTURES_GEOGRAPHIES + BOOLEAN_FILTER_COLUMNS,
+    "national averages": SPILL_EVENT_COLUMNS + PROJECTED_SPILL_COLUMNS + ["Baseline Less than Target Flag"],
+    "kpi tables": FUTURES_GEOGRAPHIES + ["Site name", "Baseline Less than Target Flag", "Improvement Count Needed",
+                                         "Meets 2050 Requirements"] + IMPROVEMENT_COLUMNS,
+    "nearby sites": NEAR_SITE_COLUMNS,
+    "map tiles": ["Latitude", "Longitude"] + SPILL_EVENT_COLUMNS,
+    "scenarios": FUTURES_GEOGRAPHIES + IMPROVEMENT_COLUMNS + PROJECTED_SPILL_COLUMNS + SPILL_EVENT_COLUMNS[:3] +
+                 ["Spill Improvement Date Planned"],
+    # Home
+    "update_hp_map": ["Site name", "Water company", "Latitude", "Longitude"] + SPILL_EVENT_COLUMNS,
+    "update_hp_pie": ["Receiving Environment"] + SPILL_EVENT_COLUMNS + OVERFLOW_LOC_FLAGS,
+    "improvements_bar_count": ["Receiving Environment"] + IMPROVEMENT_COLUMNS,
+    "update_hp_basin_bar": ["River Basin District"] + SPILL_EVENT_COLUMNS,
+    "hp_spills_flag_bar": BOOLEAN_FILTER_COLUMNS + SPILL_EVENT_COLUMNS,
+    # Water companies
+    "calculate_company_stats": ["Local Authority", "Management Catchment", "River Basin District",
+                                "Baseline Less than Target Flag"],
+    "company_map": ["Latitude", "Longitude"] + SPILL_EVENT_COLUMNS,
+    "company_release_line": SPILL_EVENT_COLUMNS,
+    "company_projected_line": PROJECTED_SPILL_COLUMNS,
+    "company_improvement_count_pie": IMPROVEMENT_COLUMNS,
+    # River basins
+    "calculate_river_basin_statistics": ["Local Authority", "Water Body", "Baseline Less than Target Flag",
+                                         "Improvement Count Needed"],
+    "river_basin_map": ["Water company", "Latitude", "Longitude"] + SPILL_EVENT_COLUMNS,
+    "basin_authority_spills": ["Local Authority"] + SPILL_EVENT_COLUMNS,
+    "projected_spill_line": ["Receiving Environment"] + PROJECTED_SPILL_COLUMNS,
+    "basin_water_bodies": ["Water Body"] + OVERFLOW_LOC_FLAGS + SPILL_EVENT_COLUMNS,
+    # Futures
+    "futures_stats": FUTURES_GEOGRAPHIES + ["Site name", "Baseline Less than Target Flag", "All Spill Events",
+                                            "Improvement Count Needed", "Meets 2050 Requirements"] +
+                     IMPROVEMENT_COLUMNS,
+    "futures_map": ["Site name", "Latitude", "Longitude", "Improvement Count Needed"] + SPILL_EVENT_COLUMNS,
+    "futures_projected_line": FUTURES_GEOGRAPHIES + PROJECTED_SPILL_COLUMNS,
+    "futures_meeting_requirements": FUTURES_GEOGRAPHIES + REQUIREMENT_COLUMNS,
+    "projected_spills_year_box": FUTURES_GEOGRAPHIES + PROJECTED_SPILL_COLUMNS,
+}
+# The combined Water Companies callback builds every chart of the page from one selection
+COLUMN_USAGE["company_page"] = list(dict.fromkeys(
+    COLUMN_USAGE["calculate_company_stats"] + COLUMN_USAGE["company_map"] + COLUMN_USAGE["company_release_line"] +
+    COLUMN_USAGE["company_projected_line"] + COLUMN_USAGE["company_improvement_count_pie"]))
+
+if os.environ.get("NWP_LOAD_COLUMNS", "used") == "all":
+    LOADED_COLUMNS = None
+else:
+    LOADED_COLUMNS = list(dict.fromkeys(["ID"] + [column for columns in COLUMN_USAGE.values() for column in columns]))
+
+
+# Uncompressed bytes of each column of the store's release that isn't loaded - from the parquet metadata alone
+def unloaded_store_column_bytes(loaded_columns):
+    column_bytes = collections.Counter()
+    dataset = pa.dataset.dataset(os.path.join(DATASET_DIR, f"Release={DATASET_RELEASE}"), partitioning="hive")
+    for fragment in dataset.get_fragments():
+        metadata = fragment.metadata
+        for row_group in range(metadata.num_row_groups):
+            for position in range(metadata.num_columns):
+                column = metadata.row_group(row_group).column(position)
+                if column.path_in_schema not in loaded_columns + PARTITION_COLUMNS:
+                    column_bytes[column.path_in_schema] += column.total_uncompressed_size
+    return dict(column_bytes)
+
+
+# Measured once, at load time, for /stats/columns: the bytes of each column left out of df
+if DATASET_DIR is not None:
+    df = load_sites(columns=LOADED_COLUMNS)
+    SKIPPED_COLUMN_BYTES = unloaded_store_column_bytes(list(df.columns))
+else:
+    df = pd.read_csv(github_path)  # Read csv from github
+    skipped_columns = [column for column in df.columns if column not in (LOADED_COLUMNS or df.columns)]
+    SKIPPED_COLUMN_BYTES = df[skipped_columns].memory_usage(deep=True, index=False).astype(int).to_dict()
+    df = df.drop(columns=skipped_columns).copy()  # A copy, so the skipped columns' memory is released
+LOADED_COLUMNS = list(df.columns)  # In the dataset's order
+
+# Identifies this exact dataset - namespaces anything cached from it
+DATASET_VERSION = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values).hexdigest()[:16]
 
 # Define categorical lists - filtering options within the dashapp - e.g., dropdowns
 COMPANIES = np.unique(df["Water company"])  # 9
@@ -22,12 +200,8 @@ LOCAL_AUTHORITIES = np.unique(df["Local Authority"])  # 288
 WATER_BODIES = np.unique(df["Water Body"])  # 2534
 RECEIVING_ENVIRONMENTS = np.unique(df["Receiving Environment"])  # 3
 YEAR_OPTIONS = [2020, 2021, 2022, 'All']  # For selecting years to filter to.
-OVERFLOW_LOC_FLAGS = ["Bathing Water Discharge Flag",
-                      "Ecological High Priority Site Flag",
-                      "Non-bathing Priority Site Flag",
-                      "Shellfish Water Discharge Flag"]
-FUTURES_GEOGRAPHIES = ["Water company", "Receiving Environment", "River Basin District", "Management Catchment",
-                       "Local Authority", "Water Body"]
+RELEASES = available_releases()  # Plan releases in the dataset store, oldest first
+FLAG_MATCH_OPTIONS = ["All", "Any"]
 
 AVG_SPILLS_2020 = np.nanmedian(df["Spill Events 2020"])
 AVG_SPILLS_2021 = np.nanmedian(df["Spill Events 2021"])
@@ -40,6 +214,13 @@ AVG_SPILLS_DICT = {2020: np.nanmedian(df["Spill Events 2020"]),
 
 PCT_UNDER_BASELINE = (len(df[df["Baseline Less than Target Flag"] == "Yes"]) / len(df)) * 100
 
+MAP_CENTRE = (52.43, -1.22)  # Latitude, longitude
+NEAR_RADIUS_KM = 5  # Default distance for the nearby sites panel
+NEAREST_SITES = 10
+PROJECTION_YEARS = [2025, 2030, 2035, 2040, 2045, 2050]
+SCENARIO_MEMBERS = 10  # Geography members shown in the scenario bar chart - those changed most
+PROJECTION_MODES = ["Point estimate", "Uncertainty"]  # Projected spill lines alone or with percentile bands
+
 # STRUCTURE
 # Page 1: Overall Sites / Homepage
 # Page 2: Water Company
@@ -49,6 +230,8 @@ PCT_UNDER_BASELINE = (len(df[df["Baseline Less than Target Flag"] == "Yes"]) / l
 
 # SETUP
 plot_palette = ["#003f5c", "#2f4b7c", "#665191", "#a05195", "#d45087", "#f95d6a", "#ff7c43", "#ffa600"]
+# Fixed per company, so a map showing only some of the companies' sites keeps their colours
+company_colours = dict(zip(COMPANIES, itertools.cycle(plot_palette)))
 graduated_palette = ["#004c6d", "#256081", "#3e7695", "#558ca9", "#6da2be", "#84b9d3", "#9cd1e9", "#b5e9ff"]
 
 specific_colours = {"sidebar_background": "#97deff",
@@ -56,6 +239,14 @@ specific_colours = {"sidebar_background": "#97deff",
                     "page_heading": "#003f5c",
                     "text_heading": "#003F3F"}
 
+# Basemap settings shared by every map figure
+MAP_GEOS = dict(resolution=50,
+                showland=True, landcolor="LightGreen",
+                showocean=True, oceancolor="LightBlue",
+                showlakes=True, lakecolor="Blue",
+                showrivers=True, rivercolor="Blue",
+                showcountries=True)
+
 # Object styles
 # Sidebar - for page navigation
 SIDEBAR_STYLE = {
@@ -101,6 +292,9 @@ sidebar = html.Div([
                     active="exact"),
         dbc.NavLink("Futures",
                     href="/futures",
+                    active="exact"),
+        dbc.NavLink("Release Changes",
+                    href="/release-changes",
                     active="exact")
     ],
         vertical=True,
@@ -108,13 +302,105 @@ sidebar = html.Div([
     style=SIDEBAR_STYLE,
     id="sidebar-nav")
 
+# Background callbacks - slow callbacks run as jobs in separate processes, so they don't tie up a web worker.
+# Jobs and their results are kept in a local disk cache (no broker needed). Results are cached by the callback's
+# inputs and the dataset version, so a repeated selection is answered straight from the cache.
+BACKGROUND_CACHE_DIR = os.environ.get("NWP_BACKGROUND_CACHE_DIR",
+                                      os.path.join(tempfile.gettempdir(), "nwp-background-jobs"))
+BACKGROUND_RESULT_EXPIRY = 24 * 60 * 60  # Seconds
+
+
+# Dash spawns a job process even when the result for those inputs is already cached - skip the process and let
+# the first poll collect the cached result. NO_JOB stands in for the process id so nothing is ever terminated.
+class CachedDiskcacheManager(DiskcacheManager):
+    NO_JOB = 0
+
+    def call_job_fn(self, key, job_fn, args, context):
+        if key in self.handle:
+            return self.NO_JOB
+        return super().call_job_fn(key, job_fn, args, context)
+
+    def terminate_job(self, job):
+        if job is not None and int(job) != self.NO_JOB:
+            super().terminate_job(job)
+
+    def job_running(self, job):
+        return int(job) != self.NO_JOB and super().job_running(job)
+
+
+background_callback_manager = CachedDiskcacheManager(diskcache.Cache(BACKGROUND_CACHE_DIR),
+                                                     cache_by=[lambda: DATASET_VERSION],
+                                                     expire=BACKGROUND_RESULT_EXPIRY)
+
+# Shown while a background callback is running, next to its Cancel button
+BACKGROUND_RUNNING_STYLE = {"display": "flex", "margin": "5px 0"}
+BACKGROUND_IDLE_STYLE = {"display": "none"}
+
 # Instantiate Dashapp
 app = Dash(__name__,
            suppress_callback_exceptions=True,
-           external_stylesheets=[dbc.themes.BOOTSTRAP])
+           external_stylesheets=[dbc.themes.BOOTSTRAP],
+           background_callback_manager=background_callback_manager)
 
 server = app.server
 
+# SERVER - Response compression for the callback and layout routes.
+# Responses smaller than COMPRESS_MIN_BYTES are sent as-is. Level is 1 (fastest) to 9 (smallest).
+COMPRESS_ROUTES = ["/_dash-update-component", "/_dash-layout", "/_dash-dependencies"]
+COMPRESS_MIN_BYTES = int(os.environ.get("NWP_COMPRESS_MIN_BYTES", 1024))
+COMPRESS_LEVEL = int(os.environ.get("NWP_COMPRESS_LEVEL", 6))
+
+# Bytes before/after compression per callback output (or per route for the layout routes)
+compression_stats = {}
+compression_stats_lock = threading.Lock()
+
+
+def record_compression(key, uncompressed_bytes, compressed_bytes):
+    with compression_stats_lock:
+        stats = compression_stats.setdefault(key, {"responses": 0,
+                                                   "uncompressed_bytes": 0,
+                                                   "compressed_bytes": 0})
+        stats["responses"] += 1
+        stats["uncompressed_bytes"] += uncompressed_bytes
+        stats["compressed_bytes"] += compressed_bytes
+
+
+@server.after_request
+def compress_response(response):
+    if request.path not in COMPRESS_ROUTES:
+        return response
+    if response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+
+    # Callback responses are keyed by their output, e.g. "hp-map.figure"
+    key = request.path
+    if request.path == "/_dash-update-component":
+        key = (request.get_json(silent=True) or {}).get("output", key)
+
+    payload = response.get_data()
+    if len(payload) < COMPRESS_MIN_BYTES or not request.accept_encodings["gzip"]:  # Absent or q=0
+        record_compression(key, len(payload), len(payload))
+        return response
+
+    compressed = gzip.compress(payload, compresslevel=COMPRESS_LEVEL)
+    record_compression(key, len(payload), len(compressed))
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Content-Length"] = len(compressed)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# Bandwidth accounting - total bytes saved by compression for each callback
+@server.route("/stats/compression")
+def compression_report():
+    with compression_stats_lock:
+        report = {key: dict(stats, saved_bytes=stats["uncompressed_bytes"] - stats["compressed_bytes"])
+                  for key, stats in compression_stats.items()}
+    return jsonify(report)
+
+
 # Define App Layout
 content = html.Div(id="page-content", style=CONTENT_STYLE)
 app.layout = html.Div([dcc.Location(id="url"), sidebar, content])
@@ -136,7 +422,22 @@ homepage_content = html.Div(children=[
                                    labelStyle={"padding": "5px",
                                                "display": "inline-block"}
                                    ),
-                    dcc.Graph(id="hp-map")
+                    html.Div(children=[
+                        dbc.Progress(value=100,
+                                     striped=True,
+                                     animated=True,
+                                     label="Building map...",
+                                     style={"flex": "1"}),
+                        dbc.Button("Cancel",
+                                   id="hp-map-cancel",
+                                   size="sm",
+                                   color="secondary",
+                                   style={"margin-left": "5px"})
+                    ],
+                        id="hp-map-progress",
+                        style=BACKGROUND_IDLE_STYLE),
+                    dcc.Graph(id="hp-map"),
+                    dcc.Store(id="hp-map-view")  # The map's last view - see MAP TILES
                 ])
             ],
                 width=6),
@@ -154,6 +455,11 @@ homepage_content = html.Div(children=[
                                  multi=True,
                                  value=["Bathing Water Discharge Flag", "Ecological High Priority Site Flag"],
                                  id="flags-dropdown"),
+                    dcc.RadioItems(options=FLAG_MATCH_OPTIONS,
+                                   value="All",
+                                   id="flags-match-radio",
+                                   labelStyle={"padding": "5px",
+                                               "display": "inline-block"}),
                     dcc.Graph(id="total-spills_flagged-bar")
                 ])
             ],
@@ -176,6 +482,31 @@ homepage_content = html.Div(children=[
                 ])
             ],
                 width=5)
+        ]),
+        dbc.Row([
+            dbc.Col([
+                html.Div(children=[
+                    dcc.Dropdown(options=OVERFLOW_LOC_FLAGS,
+                                 value=OVERFLOW_LOC_FLAGS[0],
+                                 id="near-flag-dropdown"),
+                    dcc.Input(placeholder="Please enter a distance in km:",
+                              value=NEAR_RADIUS_KM,
+                              type="number",
+                              id="near-radius-input"),
+                    dcc.Graph(id="near-sites-map")
+                ])
+            ],
+                width=7),
+            dbc.Col([
+                html.Div(children=[
+                    dcc.Input(placeholder="Please enter a number of sites:",
+                              value=NEAREST_SITES,
+                              type="number",
+                              id="nearest-count-input"),
+                    dcc.Graph(id="nearest-sites-bar")
+                ])
+            ],
+                width=5)
         ])
     ])
 ])
@@ -229,7 +560,8 @@ companies_page = html.Div(children=[
                                    id="company-year-radio",
                                    labelStyle={"padding": "5px",
                                                "display": "inline-block"}),
-                    dcc.Graph(id="company-map-fig")
+                    dcc.Graph(id="company-map-fig"),
+                    dcc.Store(id="company-map-fig-view")  # The map's last view - see MAP TILES
                 ])
             ],
                 width=6),
@@ -243,6 +575,11 @@ companies_page = html.Div(children=[
         dbc.Row([
             dbc.Col([
                 html.Div(children=[
+                    dcc.RadioItems(options=PROJECTION_MODES,
+                                   value=PROJECTION_MODES[0],
+                                   id="wc-projection-mode-radio",
+                                   labelStyle={"padding": "5px",
+                                               "display": "inline-block"}),
                     dcc.Graph(id="wc-projected-spills")
                 ])
             ],
@@ -305,7 +642,8 @@ basin_content = html.Div(children=[
                                        id="basin-year-radio",
                                        labelStyle={'display': 'inline-block',
                                                    "padding": "5px"}),
-                        dcc.Graph(id="basin-map-fig")
+                        dcc.Graph(id="basin-map-fig"),
+                        dcc.Store(id="basin-map-fig-view")  # The map's last view - see MAP TILES
                     ])
                 ],
                     width=6),
@@ -401,7 +739,21 @@ futures_content = html.Div(children=[
                     html.H4(id="futures-meeting-2050")
                 ])
 
-            ])
+            ]),
+            html.Div(children=[
+                dbc.Progress(value=100,
+                             striped=True,
+                             animated=True,
+                             label="Calculating statistics...",
+                             style={"flex": "1"}),
+                dbc.Button("Cancel",
+                           id="futures-stats-cancel",
+                           size="sm",
+                           color="secondary",
+                           style={"margin-left": "5px"})
+            ],
+                id="futures-stats-progress",
+                style=BACKGROUND_IDLE_STYLE)
         ]),
         html.Div(children=[
             dbc.Row([
@@ -413,12 +765,19 @@ futures_content = html.Div(children=[
                                        labelStyle={"display": "inline-block",
                                                    "padding": "5px"}
                                        ),
-                        dcc.Graph(id="futures-map")
+                        dcc.Graph(id="futures-map"),
+                        dcc.Store(id="futures-map-view")  # The map's last view - see MAP TILES
                     ]),
                 ],
                     width=6),
                 dbc.Col([
                     html.Div(children=[
+                        dcc.RadioItems(options=PROJECTION_MODES,
+                                       value=PROJECTION_MODES[0],
+                                       id="futures-projection-mode-radio",
+                                       labelStyle={"display": "inline-block",
+                                                   "padding": "5px"}
+                                       ),
                         dcc.Graph(id="futures-projected-line-fig")
                     ])
                 ],
@@ -433,7 +792,7 @@ futures_content = html.Div(children=[
                     width=6),
                 dbc.Col([
                     html.Div(children=[
-                        dcc.RadioItems(options=[2025, 2030, 2035, 2040, 2045, 2050],
+                        dcc.RadioItems(options=PROJECTION_YEARS,
                                        value=2025,
                                        id="futures-proj-year-radio",
                                        labelStyle={"display": "inline-block",
@@ -443,11 +802,1243 @@ futures_content = html.Div(children=[
                     ])
                 ],
                     width=6)
+            ]),
+            html.H2("What if...",
+                    style=PAGE_HEADINGS_STYLE),
+            dbc.Row([
+                dbc.Col([
+                    html.Div(children=[
+                        dcc.Dropdown(options=IMPROVEMENT_COLUMNS,
+                                     value=["Storage"],
+                                     multi=True,
+                                     placeholder="Please select improvements:",
+                                     id="scenario-improvements-dropdown"),
+                        dcc.Dropdown(options=PROJECTION_YEARS,
+                                     value=2030,
+                                     placeholder="Delivered as planned",
+                                     id="scenario-delivered-by-dropdown"),
+                        dcc.Input(placeholder="Please enter a % reduction in spills once delivered:",
+                                  value=0,
+                                  type="number",
+                                  min=0,
+                                  max=100,
+                                  id="scenario-reduction-input"),
+                        dcc.Graph(id="scenario-line-fig")
+                    ])
+                ],
+                    width=6),
+                dbc.Col([
+                    html.Div(children=[
+                        dcc.Graph(id="scenario-members-bar")
+                    ])
+                ],
+                    width=6)
             ])
         ])
     ])
 ])
 
+# RELEASE CHANGES CONTENT
+releases_content = html.Div(children=[
+    html.H1("National Water Plan - Release Changes",
+            style=PAGE_HEADINGS_STYLE),
+    html.Hr(),
+    html.Div(children=[
+        dbc.Row([
+            dbc.Col([
+                dcc.Dropdown(options=RELEASES,
+                             value=RELEASES[-2] if len(RELEASES) > 1 else RELEASES[0],
+                             placeholder="Please select the earlier release:",
+                             id="release-old-dropdown")
+            ],
+                width=6),
+            dbc.Col([
+                dcc.Dropdown(options=RELEASES,
+                             value=RELEASES[-1],
+                             placeholder="Please select the later release:",
+                             id="release-new-dropdown")
+            ],
+                width=6)
+        ]),
+        html.H2(id="release-changes-summary",
+                style={"textAlign": "center",
+                       "fontWeight": "bold"}),
+        dbc.Row([
+            dbc.Col([
+                html.Div(children=[
+                    dcc.Graph(id="release-status-bar")
+                ])
+            ],
+                width=6),
+            dbc.Col([
+                html.Div(children=[
+                    dcc.Graph(id="release-groups-bar")
+                ])
+            ],
+                width=6)
+        ]),
+        dbc.Row([
+            dbc.Col([
+                html.Div(children=[
+                    dcc.Graph(id="release-columns-bar")
+                ])
+            ],
+                width=12)
+        ])
+    ])
+])
+
+
+# CALLBACK LAYERS
+# Every callback is registered through callback() below, which wraps the function in each layer of CALLBACK_LAYERS
+# in turn - the first layer is innermost. A layer takes a callback function and returns a wrapped function.
+CALLBACK_LAYERS = []
+
+# Function name -> (wrapped function, its Input and State ids in argument order), for the prerendered bundle
+registered_callbacks = {}
+
+
+def callback(*args, **kwargs):
+    def register(func):
+        wrapped = func
+        for layer in CALLBACK_LAYERS:
+            wrapped = layer(wrapped)
+        _, inputs, state, argument_indices, _ = handle_grouped_callback_args(args, kwargs)
+        dependencies = inputs + state
+        if isinstance(argument_indices, int):  # A single Input
+            argument_indices = [argument_indices]
+        registered_callbacks[func.__name__] = (wrapped, [str(dependencies[i]) for i in argument_indices])
+        return dash_callback(*args, **kwargs)(wrapped)
+    return register
+
+
+# FIGURE POST-PROCESSING - slims every figure a callback returns before it is serialised.
+# Numeric arrays are sent as compact typed binary arrays (smallest dtype that holds the values), map coordinates
+# are rounded to COORDINATE_DECIMALS, hover data is trimmed to the fields the hover label shows and the template
+# only keeps the defaults for trace types actually in the figure.
+COORDINATE_DECIMALS = 4  # ~10m - far finer than a marker at any zoom level
+VALUE_DECIMALS = 2
+HOVER_HIDDEN_FIELDS = ["Latitude=%{lat}", "Longitude=%{lon}"]
+FIGURE_ARRAY_PROPERTIES = [("x",), ("y",), ("lat",), ("lon",), ("values",), ("customdata",),
+                           ("marker", "size"), ("marker", "color")]
+FIGURE_SIZE_REPORT = os.environ.get("NWP_FIGURE_SIZE_REPORT", "0") == "1"  # Serialises figures twice - opt in
+
+# Payload bytes before/after post-processing per callback, when FIGURE_SIZE_REPORT is on
+figure_size_stats = {}
+figure_size_stats_lock = threading.Lock()
+
+
+def compact_array(values, decimals):
+    array = np.asarray(values)
+    if array.ndim == 0 or array.size == 0 or array.dtype.kind not in "iufb":
+        return values  # Scalars and categorical/text arrays are left alone
+
+    if array.dtype.kind == "f":
+        if not np.isfinite(array).all():
+            return np.round(array, decimals).astype(np.float32)
+        array = np.round(array, decimals)
+        if not np.array_equal(array, np.trunc(array)):
+            return array.astype(np.float32)
+
+    # Whole numbers - use the smallest integer type plotly.js can decode
+    smallest = np.result_type(np.min_scalar_type(array.min()), np.min_scalar_type(array.max()))
+    if smallest.kind in "ui" and smallest.itemsize <= 4:
+        return array.astype(smallest)
+    return array.astype(np.float32) if array.dtype.kind == "f" else values
+
+
+def trim_hover_data(trace):
+    hovertemplate = trace.hovertemplate
+    if not hovertemplate:
+        return
+    for field in HOVER_HIDDEN_FIELDS:
+        hovertemplate = hovertemplate.replace(f"<br>{field}", "").replace(f"{field}<br>", "")
+
+    # Keep only the customdata columns the hover label refers to, renumbering the references to match
+    if trace.customdata is not None:
+        customdata = np.asarray(trace.customdata)
+        used = [i for i in range(customdata.shape[1]) if f"customdata[{i}]" in hovertemplate]
+        for new_i, old_i in enumerate(used):
+            hovertemplate = hovertemplate.replace(f"customdata[{old_i}]", f"customdata[{new_i}]")
+        trace.customdata = customdata[:, used] if used else None
+    trace.hovertemplate = hovertemplate
+
+
+def slim_figure(fig):
+    for trace in fig.data:
+        trim_hover_data(trace)
+        for path in FIGURE_ARRAY_PROPERTIES:
+            parent = trace
+            for key in path[:-1]:
+                parent = parent[key] if key in parent else None
+            if parent is None or path[-1] not in parent or parent[path[-1]] is None:
+                continue  # Property doesn't exist for this trace type, or isn't set
+            values = parent[path[-1]]
+            decimals = COORDINATE_DECIMALS if path[-1] in ("lat", "lon") else VALUE_DECIMALS
+            parent[path[-1]] = compact_array(values, decimals)
+
+    # Template defaults for trace types not in the figure are never used by the browser
+    template = fig.layout.template.to_plotly_json()
+    trace_types = {trace.type for trace in fig.data}
+    template["data"] = {trace_type: defaults for trace_type, defaults in template.get("data", {}).items()
+                        if trace_type in trace_types}
+    fig.layout.template = template
+    return fig
+
+
+def record_figure_size(name, before_bytes, after_bytes):
+    with figure_size_stats_lock:
+        stats = figure_size_stats.setdefault(name, {"figures": 0, "bytes_before": 0, "bytes_after": 0})
+        stats["figures"] += 1
+        stats["bytes_before"] += before_bytes
+        stats["bytes_after"] += after_bytes
+
+
+def postprocess_output(name, output):
+    if not isinstance(output, go.Figure):
+        return output
+    if not FIGURE_SIZE_REPORT:
+        return slim_figure(output)
+    before_bytes = len(to_json_plotly(output))
+    output = slim_figure(output)
+    record_figure_size(name, before_bytes, len(to_json_plotly(output)))
+    return output
+
+
+def figure_postprocessing_layer(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, (tuple, list)):
+            return type(result)(postprocess_output(func.__name__, output) for output in result)
+        return postprocess_output(func.__name__, result)
+    return wrapper
+
+
+CALLBACK_LAYERS.append(figure_postprocessing_layer)
+
+
+# Figure payload sizes before/after slimming - enable with NWP_FIGURE_SIZE_REPORT=1
+@server.route("/stats/figures")
+def figure_size_report():
+    with figure_size_stats_lock:
+        report = {name: dict(stats, saved_bytes=stats["bytes_before"] - stats["bytes_after"])
+                  for name, stats in figure_size_stats.items()}
+    return jsonify(report)
+
+
+# PARTIAL FIGURE UPDATES - when only a year or a map selection changes, a figure keeps its layout, basemap and
+# template, so the callback's new figure is sent as a Patch of just what can differ:
+#   "markers" - a map's year changed: its sites and traces are the same, only each trace's marker sizes and
+#               colours and hover labels differ (and the title and colour range)
+#   "data"    - a chart's year or selection changed: every trace is replaced
+# along with the layout besides PATCH_KEPT_LAYOUT. Trace properties and PATCH_LAYOUT_KEYS the new figure lacks are
+# deleted, so the client's patched figure is the same as the full one; a figure setting a layout key outside
+# PATCH_LAYOUT_KEYS is always sent in full. A full figure is sent whenever anything else triggers the
+# callback - a different company, basin or member, the initial load. FIGURE_PATCHES lists the triggers each callback
+# can patch on. NWP_FIGURE_PATCHES=0 always sends full figures. /stats/patches compares both modes over the
+# patched responses: payload bytes of the patch and of the full figure it replaced, and the ms spent building
+# the figure and serialising each.
+FIGURE_PATCH_UPDATES = os.environ.get("NWP_FIGURE_PATCHES", "1") == "1"
+MARKER_TRACE_PROPERTIES = ["marker", "hovertemplate", "customdata"]
+PATCH_KEPT_LAYOUT = ["template", "geo"]
+# Every other top-level layout key the dashboard's figures set
+PATCH_LAYOUT_KEYS = ["title", "margin", "legend", "xaxis", "yaxis", "coloraxis", "barmode", "boxmode", "transition",
+                     "uirevision"]
+FIGURE_PATCHES = {
+    "company_map": {"company-year-radio.value": "markers"},
+    "company_page": {"company-year-radio.value": "markers", "company-map-fig.selectedData": "data"},
+    "river_basin_map": {"basin-year-radio.value": "markers"},
+    "futures_map": {"futures-year-radio.value": "markers"},
+    "update_hp_pie": {"hp-year-radio.value": "data", "hp-map.selectedData": "data"},
+    "improvements_bar_count": {"hp-map.selectedData": "data"},
+    "update_hp_basin_bar": {"hp-year-radio.value": "data", "hp-map.selectedData": "data"},
+    "hp_spills_flag_bar": {"hp-map.selectedData": "data"},
+    "company_release_line": {"company-map-fig.selectedData": "data"},
+    "company_projected_line": {"company-map-fig.selectedData": "data"},
+    "company_improvement_count_pie": {"company-map-fig.selectedData": "data"},
+    "basin_authority_spills": {"basin-year-radio.value": "data", "basin-map-fig.selectedData": "data"},
+    "projected_spill_line": {"basin-map-fig.selectedData": "data"},
+    "basin_water_bodies": {"basin-year-radio.value": "data", "basin-map-fig.selectedData": "data"},
+}
+
+patch_stats = {}  # Callback name -> patched responses and their bytes and ms in both modes
+patch_stats_lock = threading.Lock()
+
+
+# The figure as a Patch and the payload sizes, or the figure itself (and no sizes) when it can't be patched
+def figure_patch(fig, kind):
+    start = time.perf_counter()
+    figure_json = to_json_plotly(fig)
+    full_ms = (time.perf_counter() - start) * 1000
+    figure = json.loads(figure_json)
+    layout = figure.get("layout", {})
+    if any(name not in PATCH_KEPT_LAYOUT + PATCH_LAYOUT_KEYS for name in layout):
+        return fig, {}
+
+    patch = Patch()
+    if kind == "markers":
+        for i, trace in enumerate(figure["data"]):
+            for name in MARKER_TRACE_PROPERTIES:
+                if name in trace:
+                    patch["data"][i][name] = trace[name]
+                else:
+                    del patch["data"][i][name]
+    else:
+        patch["data"] = figure["data"]
+    for name in PATCH_LAYOUT_KEYS:
+        if name in layout:
+            patch["layout"][name] = layout[name]
+        else:
+            del patch["layout"][name]
+
+    start = time.perf_counter()
+    patch_bytes = len(json.dumps(patch.to_plotly_json()))
+    return patch, {"full_bytes": len(figure_json), "patch_bytes": patch_bytes,
+                   "full_serialise_ms": full_ms, "patch_serialise_ms": (time.perf_counter() - start) * 1000}
+
+
+def record_patch(name, build_ms, sizes):
+    with patch_stats_lock:
+        stats = patch_stats.setdefault(name, {"responses": 0, "build_ms": 0.0, "full_bytes": 0, "patch_bytes": 0,
+                                              "full_serialise_ms": 0.0, "patch_serialise_ms": 0.0})
+        stats["responses"] += 1
+        stats["build_ms"] += build_ms
+        for key, value in sizes.items():
+            stats[key] += value
+
+
+def figure_patch_layer(func):
+    triggers = FIGURE_PATCHES.get(func.__name__)
+    if not FIGURE_PATCH_UPDATES or triggers is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = func(*args)
+        build_ms = (time.perf_counter() - start) * 1000
+        try:
+            kinds = {triggers.get(prop_id) for prop_id in ctx.triggered_prop_ids}
+        except Exception:  # Called outside a Dash request, e.g. when prerendering
+            return result
+        if not kinds or None in kinds:
+            return result
+        kind = "data" if "data" in kinds else "markers"
+
+        outputs = list(result) if isinstance(result, (tuple, list)) else [result]
+        totals = {}
+        for i, output in enumerate(outputs):
+            if isinstance(output, go.Figure):
+                outputs[i], sizes = figure_patch(output, kind)
+                totals = {key: totals.get(key, 0) + value for key, value in sizes.items()}
+        if totals:
+            record_patch(func.__name__, build_ms, totals)
+        return type(result)(outputs) if isinstance(result, (tuple, list)) else outputs[0]
+    return wrapper
+
+
+CALLBACK_LAYERS.append(figure_patch_layer)
+
+
+# Patch and full figure payloads and serialising times over the patched responses - NWP_FIGURE_PATCHES=1
+@server.route("/stats/patches")
+def patch_report():
+    with patch_stats_lock:
+        report = {name: dict(stats, saved_bytes=stats["full_bytes"] - stats["patch_bytes"])
+                  for name, stats in patch_stats.items()}
+    return jsonify(report)
+
+
+# PRERENDERED BUNDLE - every page and input combination rendered ahead of time, so most requests need no compute.
+# Build one with: python national_water_plan_dash_deploy.py --prerender <bundle dir>
+# and serve from it with NWP_PRERENDERED_DIR=<bundle dir>. The bundle holds one JSON file of callback outputs per
+# combination - <bundle dir>/<callback>/<key>.json - and a manifest.json listing the callbacks it covers, the
+# dataset version it was built from and the store_fingerprint() of the releases in the store (the Release Changes
+# page reads them all). A bundle built from another dataset version or store is ignored. Inputs without a
+# finite domain (the N-count boxes, cleared dropdowns, dropdown searches) are computed live as before.
+PRERENDERED_DIR = os.environ.get("NWP_PRERENDERED_DIR")
+PRERENDER_DOMAINS = {
+    "url.pathname": ["/home", "/water-companies", "/river-basin-districts", "/futures", "/release-changes"],
+    "hp-year-radio.value": YEAR_OPTIONS,
+    "flags-dropdown.value": [list(flags) for n_flags in range(len(OVERFLOW_LOC_FLAGS) + 1)
+                             for flags in itertools.permutations(OVERFLOW_LOC_FLAGS, n_flags)],  # Order is shown
+    "flags-match-radio.value": FLAG_MATCH_OPTIONS,
+    "hp-receiving-environment.value": RECEIVING_ENVIRONMENTS.tolist(),
+    "wc-dropdown.value": COMPANIES.tolist(),
+    "company-year-radio.value": YEAR_OPTIONS,
+    "basin-dropdown.value": BASIN_DISTRICTS.tolist(),
+    "basin-year-radio.value": YEAR_OPTIONS,
+    "basin-authority-best-flag.value": ["Best", "Worst"],
+    "basin-flags-dropdown.value": ["", None] + OVERFLOW_LOC_FLAGS,
+    "geography-dropdown.value": FUTURES_GEOGRAPHIES,
+    # The member options depend on the chosen geography
+    "geography-member-dropdown.value": lambda values: df[values["geography-dropdown.value"]].unique().tolist(),
+    "futures-year-radio.value": YEAR_OPTIONS,
+    "futures-proj-year-radio.value": PROJECTION_YEARS,
+    # Uncertainty bands are drawn live (and kept) - see UNCERTAINTY BANDS
+    "wc-projection-mode-radio.value": PROJECTION_MODES[:1],
+    "futures-projection-mode-radio.value": PROJECTION_MODES[:1],
+    "release-old-dropdown.value": RELEASES,
+    "release-new-dropdown.value": RELEASES,
+    # Map selections are computed live
+    "hp-map.selectedData": [None],
+    "company-map-fig.selectedData": [None],
+    "basin-map-fig.selectedData": [None],
+    # Zoomed and panned map views too
+    "hp-map-view.data": [None],
+    "company-map-fig-view.data": [None],
+    "basin-map-fig-view.data": [None],
+    "futures-map-view.data": [None],
+}
+
+prerendered_stats = {}  # Callback name -> bundle hits and live misses
+prerendered_stats_lock = threading.Lock()
+
+
+def prerendered_key(args):
+    return hashlib.sha256(json.dumps(list(args)).encode()).hexdigest()[:32]
+
+
+def load_prerendered_manifest():
+    if PRERENDERED_DIR is None:
+        return None
+    with open(os.path.join(PRERENDERED_DIR, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["dataset_version"] != DATASET_VERSION:
+        print(f"Prerendered bundle {PRERENDERED_DIR} is for dataset {manifest['dataset_version']}, "
+              f"not {DATASET_VERSION} - ignoring it")
+        return None
+    if manifest.get("store_fingerprint") != store_fingerprint():
+        print(f"Prerendered bundle {PRERENDERED_DIR} was built before the releases in {DATASET_DIR} were last "
+              f"written - ignoring it")
+        return None
+    return manifest
+
+
+prerendered_manifest = load_prerendered_manifest()
+
+
+def prerendered_layer(func):
+    if prerendered_manifest is None or func.__name__ not in prerendered_manifest["callbacks"]:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            path = os.path.join(PRERENDERED_DIR, func.__name__, f"{prerendered_key(args)}.json")
+            with open(path) as output_file:
+                result = json.load(output_file)
+            outcome = "hits"
+        except (OSError, TypeError):  # Not prerendered, or arguments that aren't JSON (never sent by the browser)
+            result = func(*args)
+            outcome = "misses"
+        with prerendered_stats_lock:
+            stats = prerendered_stats.setdefault(func.__name__, {"hits": 0, "misses": 0})
+            stats[outcome] += 1
+        return result
+    return wrapper
+
+
+CALLBACK_LAYERS.append(prerendered_layer)
+
+
+# Every combination of values for the given Input/State ids - None if any of them has no finite domain
+def prerender_combinations(dependencies):
+    if not all(dependency in PRERENDER_DOMAINS for dependency in dependencies):
+        return None
+    combinations = [{}]
+    for dependency in sorted(dependencies, key=lambda dependency: callable(PRERENDER_DOMAINS[dependency])):
+        domain = PRERENDER_DOMAINS[dependency]
+        combinations = [dict(values, **{dependency: value}) for values in combinations
+                        for value in (domain(values) if callable(domain) else domain)]
+    return [[values[dependency] for dependency in dependencies] for values in combinations]
+
+
+# Render every combination of every callback (or only those named) into bundle_dir. Combinations that fail are
+# left out, so they are computed live.
+def build_prerendered_bundle(bundle_dir, names=None):
+    manifest = {"dataset_version": DATASET_VERSION, "store_fingerprint": store_fingerprint(), "callbacks": {}}
+    for name, (func, dependencies) in registered_callbacks.items():
+        combinations = prerender_combinations(dependencies)
+        if combinations is None or (names is not None and name not in names):
+            continue
+        os.makedirs(os.path.join(bundle_dir, name), exist_ok=True)
+        start = time.perf_counter()
+        failed = 0
+        for args in combinations:
+            try:
+                output = to_json_plotly(func(*args))
+            except Exception:
+                failed += 1
+                continue
+            with open(os.path.join(bundle_dir, name, f"{prerendered_key(args)}.json"), "w") as output_file:
+                output_file.write(output)
+        manifest["callbacks"][name] = {"inputs": dependencies,
+                                       "combinations": len(combinations) - failed,
+                                       "failed": failed}
+        print(f"{name}: {len(combinations) - failed} combinations, {failed} failed "
+              f"({time.perf_counter() - start:.1f}s)")
+    with open(os.path.join(bundle_dir, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+# Bundle hits and live-computed misses per callback, when serving from NWP_PRERENDERED_DIR
+@server.route("/stats/prerendered")
+def prerendered_report():
+    with prerendered_stats_lock:
+        report = {name: dict(stats) for name, stats in prerendered_stats.items()}
+    return jsonify(report)
+
+
+
+# ALLOCATION PROFILING - opt in with NWP_ALLOCATION_PROFILE=1 to find which callbacks drive worker memory.
+# tracemalloc runs only while a callback does, so each invocation gets its own figures: the peak it allocated,
+# the net bytes it still holds when it returns (its output included), and the ALLOCATION_TOP_SITES source lines
+# holding the most of that. tracemalloc is process-wide, so profiled invocations run one at a time - this is for
+# diagnosis, not production. Per-callback summaries are served at /debug/allocations. With
+# NWP_ALLOCATION_DUMP=<file> every invocation is also appended to the file as a line of JSON for offline
+# analysis - background callbacks run in a job process, so they only show up there.
+ALLOCATION_PROFILE = os.environ.get("NWP_ALLOCATION_PROFILE", "0") == "1"
+ALLOCATION_DUMP = os.environ.get("NWP_ALLOCATION_DUMP")
+ALLOCATION_TOP_SITES = 10
+# Stack frames kept per allocation. More frames trace allocations deep in pandas/plotly back to the line in this
+# file (callback_line), but slow traced callbacks down - ~3x at 1 frame, ~10x at 5, ~50x at 25.
+ALLOCATION_TRACE_FRAMES = int(os.environ.get("NWP_ALLOCATION_FRAMES", 5))
+
+allocation_stats = {}
+allocation_stats_lock = threading.Lock()
+allocation_profile_lock = threading.Lock()
+
+
+# The lines holding the most traced memory, each with the line in this file that led to it
+def allocation_sites(snapshot):
+    sites = []
+    for stat in snapshot.statistics("traceback")[:ALLOCATION_TOP_SITES]:
+        own_frames = [frame for frame in stat.traceback if frame.filename == __file__]  # Oldest first
+        sites.append({"site": f"{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}",
+                      "callback_line": own_frames[-1].lineno if own_frames else None,
+                      "size_bytes": stat.size,
+                      "count": stat.count})
+    return sites
+
+
+def record_allocations(name, profile):
+    with allocation_stats_lock:
+        stats = allocation_stats.setdefault(name, {"calls": 0, "net_bytes_total": 0, "net_bytes_max": 0,
+                                                   "peak_bytes_max": 0, "peak_bytes_last": 0, "top_sites": []})
+        stats["calls"] += 1
+        stats["net_bytes_total"] += profile["net_bytes"]
+        stats["net_bytes_max"] = max(stats["net_bytes_max"], profile["net_bytes"])
+        stats["peak_bytes_last"] = profile["peak_bytes"]
+        if profile["peak_bytes"] >= stats["peak_bytes_max"]:
+            stats["peak_bytes_max"] = profile["peak_bytes"]
+            stats["top_sites"] = profile["top_sites"]  # From the invocation with the highest peak
+        if ALLOCATION_DUMP is not None:
+            with open(ALLOCATION_DUMP, "a") as dump_file:
+                dump_file.write(json.dumps(profile) + "\n")
+
+
+def allocation_profiling_layer(func):
+    if not ALLOCATION_PROFILE:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with allocation_profile_lock:
+            tracemalloc.start(ALLOCATION_TRACE_FRAMES)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+                net_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+        record_allocations(func.__name__, {"callback": func.__name__,
+                                           "time": time.time(),
+                                           "duration_ms": round(duration_ms, 1),
+                                           "net_bytes": net_bytes,
+                                           "peak_bytes": peak_bytes,
+                                           "top_sites": allocation_sites(snapshot)})
+        return result
+    return wrapper
+
+
+CALLBACK_LAYERS.append(allocation_profiling_layer)
+
+
+# Allocation summary per callback, highest peak first - only with NWP_ALLOCATION_PROFILE=1
+@server.route("/debug/allocations")
+def allocation_report():
+    if not ALLOCATION_PROFILE:
+        abort(404)
+    with allocation_stats_lock:
+        report = {name: dict(stats, net_bytes_mean=stats["net_bytes_total"] // stats["calls"])
+                  for name, stats in sorted(allocation_stats.items(),
+                                            key=lambda item: item[1]["peak_bytes_max"], reverse=True)}
+    return jsonify(report)
+
+
+# IN-FLIGHT COALESCING - when the same callback is invoked with identical inputs while a previous invocation is
+# still computing (e.g. a shared link opened by many people at once), the later invocations wait for that
+# computation and share its result, or its exception, instead of repeating it. Inputs are compared as normalised
+# JSON, together with the triggering inputs, which some callbacks look at through ctx.
+# NWP_COALESCE_CALLBACKS=0 turns it off. /stats/coalescing counts computed and coalesced invocations.
+COALESCE_CALLBACKS = os.environ.get("NWP_COALESCE_CALLBACKS", "1") == "1"
+
+inflight_calls = {}  # (callback, normalised inputs) -> Future of the computing invocation
+inflight_calls_lock = threading.Lock()
+coalescing_stats = {}  # Callback name -> computed and coalesced invocation counts
+
+
+def coalescing_key(name, args):
+    try:
+        triggered = sorted(ctx.triggered_prop_ids)
+    except Exception:  # Called outside a Dash request, e.g. when prerendering
+        triggered = None
+    try:
+        return name, json.dumps([args, triggered], sort_keys=True)
+    except TypeError:  # Inputs that aren't JSON are never sent by the browser - don't coalesce them
+        return None
+
+
+def coalescing_layer(func):
+    if not COALESCE_CALLBACKS:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = coalescing_key(func.__name__, args)
+        if key is None:
+            return func(*args)
+
+        with inflight_calls_lock:
+            stats = coalescing_stats.setdefault(func.__name__, {"computed": 0, "coalesced": 0})
+            inflight = inflight_calls.get(key)
+            computing = inflight is None
+            if computing:
+                inflight = inflight_calls[key] = Future()
+            stats["computed" if computing else "coalesced"] += 1
+        if not computing:
+            return inflight.result()
+
+        try:
+            result = func(*args)
+            inflight.set_result(result)
+            return result
+        except BaseException as error:  # Including PreventUpdate - every waiting invocation gets the same
+            inflight.set_exception(error)
+            raise
+        finally:
+            with inflight_calls_lock:
+                del inflight_calls[key]
+    return wrapper
+
+
+CALLBACK_LAYERS.append(coalescing_layer)
+
+
+@server.route("/stats/coalescing")
+def coalescing_report():
+    with inflight_calls_lock:
+        report = {"in_flight": len(inflight_calls),
+                  "callbacks": {name: dict(stats) for name, stats in coalescing_stats.items()}}
+    return jsonify(report)
+
+
+# SHARED CACHE - a cache tier shared by every worker on the host, behind each worker's own: callback outputs (as
+# the JSON sent to the browser) and the slow aggregates (uncertainty bands, release diffs), so what one worker
+# computes - before or since a restart - every worker reuses. It is a diskcache store in NWP_SHARED_CACHE_DIR,
+# bounded to NWP_SHARED_CACHE_MB with least recently used entries evicted; each entry is written in one SQLite
+# transaction, so a half-written one is never read. Keys start with CACHE_NAMESPACE: the dataset version, this
+# app's code and its NWP_ settings. In front of it, callback outputs are kept per worker in memory (the
+# SHARED_CACHE_MEMORY_ENTRIES most recently used) and are keyed like IN-FLIGHT COALESCING, plus whatever
+# CACHE_KEY_SOURCES gives for callbacks reading more than the loaded dataset.
+# Off unless NWP_SHARED_CACHE=1 turns it on, as it outlives the app, and never used by --prerender. /stats/cache
+# gives hits and misses per tier and callback.
+SHARED_CACHE = os.environ.get("NWP_SHARED_CACHE", "0") == "1"
+SHARED_CACHE_DIR = os.environ.get("NWP_SHARED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nwp-shared-cache"))
+SHARED_CACHE_MB = int(os.environ.get("NWP_SHARED_CACHE_MB", 512))
+SHARED_CACHE_MEMORY_ENTRIES = 256
+# Callback name -> function of its arguments giving the rest of its cache key
+CACHE_KEY_SOURCES = {
+    # The releases it compares, as they are in the store now
+    "release_changes_page": lambda old_release, new_release: store_fingerprint([old_release, new_release]),
+}
+
+
+def app_code_hash():
+    digest = hashlib.sha256()
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(app_dir)):
+        if name.startswith("national_water_plan_") and name.endswith(".py"):
+            with open(os.path.join(app_dir, name), "rb") as code_file:
+                digest.update(code_file.read())
+    return digest.hexdigest()
+
+
+CACHE_NAMESPACE = hashlib.sha256(json.dumps([DATASET_VERSION, app_code_hash(),
+                                             sorted((name, value) for name, value in os.environ.items()
+                                                    if name.startswith("NWP_"))]).encode()).hexdigest()[:16]
+
+shared_cache = diskcache.Cache(SHARED_CACHE_DIR, size_limit=SHARED_CACHE_MB * 1024 * 1024,
+                               eviction_policy="least-recently-used") if SHARED_CACHE else None
+memory_cache = collections.OrderedDict()  # Coalescing key -> output JSON, least recently used first
+memory_cache_lock = threading.Lock()
+cache_stats = {}  # Tier -> callback or function name -> hits and misses
+cache_stats_lock = threading.Lock()
+
+
+def record_cache_lookup(tier, name, hit):
+    with cache_stats_lock:
+        stats = cache_stats.setdefault(tier, {}).setdefault(name, {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+
+
+def memory_cache_get(key):
+    with memory_cache_lock:
+        output = memory_cache.get(key)
+        if output is not None:
+            memory_cache.move_to_end(key)
+    return output
+
+
+def memory_cache_set(key, output):
+    with memory_cache_lock:
+        memory_cache[key] = output
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > SHARED_CACHE_MEMORY_ENTRIES:
+            memory_cache.popitem(last=False)
+
+
+def shared_cache_layer(func):
+    if not SHARED_CACHE:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = coalescing_key(func.__name__, args)
+        if key is None or shared_cache is None:  # Or closed since, by --prerender
+            return func(*args)
+        if func.__name__ in CACHE_KEY_SOURCES:
+            key += (CACHE_KEY_SOURCES[func.__name__](*args),)
+
+        output = memory_cache_get(key)
+        record_cache_lookup("memory", func.__name__, output is not None)
+        if output is None:
+            output = shared_cache.get((CACHE_NAMESPACE,) + key)
+            record_cache_lookup("shared", func.__name__, output is not None)
+            if output is not None:
+                memory_cache_set(key, output)
+        if output is not None:
+            return json.loads(output)
+
+        result = func(*args)
+        try:
+            output = to_json_plotly(result)
+        except Exception:  # Not serialisable - Dash will fail on it too, nothing to keep
+            return result
+        memory_cache_set(key, output)
+        shared_cache.set((CACHE_NAMESPACE,) + key, output)
+        return result
+    return wrapper
+
+
+CALLBACK_LAYERS.append(shared_cache_layer)
+
+
+# The shared tier under a function's own lru_cache, for the slow aggregates - its arguments must be hashable
+# and its result picklable
+def shared_memo(func):
+    if not SHARED_CACHE:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if shared_cache is None:  # Closed since, by --prerender
+            return func(*args)
+        key = (CACHE_NAMESPACE, func.__name__, args)
+        result = shared_cache.get(key)
+        record_cache_lookup("shared", func.__name__, result is not None)
+        if result is None:
+            result = func(*args)
+            shared_cache.set(key, result)
+        return result
+    return wrapper
+
+
+def lookup_counts(hits, misses):
+    return {"hits": hits, "misses": misses, "hit_rate": round(hits / max(hits + misses, 1), 3)}
+
+
+# Hits, misses and hit rate per tier and name. The per-worker tier of the aggregates is their lru_cache.
+@server.route("/stats/cache")
+def cache_report():
+    with cache_stats_lock:
+        report = {tier: {name: lookup_counts(stats["hits"], stats["misses"]) for name, stats in names.items()}
+                  for tier, names in cache_stats.items()}
+    for func in [projected_spill_bands, release_diff]:
+        info = func.cache_info()
+        report.setdefault("memory", {})[func.__name__] = lookup_counts(info.hits, info.misses)
+    with memory_cache_lock:
+        memory_entries = len(memory_cache)
+    report["entries"] = {"memory": memory_entries, "shared": len(shared_cache) if shared_cache is not None else 0}
+    report["namespace"] = CACHE_NAMESPACE
+    return jsonify(report)
+
+
+# ROW SELECTION - callbacks select and aggregate rows through query_backend (see national_water_plan_query.py).
+# NWP_QUERY_BACKEND=pandas (default) filters df in memory, NWP_QUERY_BACKEND=sqlite queries an embedded SQLite
+# file built from df, with indexes on the geography columns. Both give identical results.
+QUERY_BACKEND = os.environ.get("NWP_QUERY_BACKEND", "pandas")
+
+
+# With a partitioned dataset store, a company selection only reads that company's partition
+@functools.lru_cache(maxsize=4)
+def company_partition(company):
+    return load_sites(companies=[company], columns=LOADED_COLUMNS)
+
+
+# Boolean column and geography bitmaps over df's rows - the pandas backend answers its filters from these, so any
+# all/any combination of flags is a few bitwise operations
+row_bitmaps = RowBitmaps(df, BOOLEAN_FILTER_COLUMNS, FUTURES_GEOGRAPHIES)
+
+if QUERY_BACKEND == "sqlite":
+    query_backend = build_sqlite_database(df, os.path.join(tempfile.gettempdir(), f"nwp-{DATASET_VERSION}.sqlite"))
+else:
+    query_backend = PandasBackend(df, company_partition if DATASET_DIR is not None else None, row_bitmaps)
+
+
+# The COLUMN_USAGE callback running in this context, if any. Thread pools a callback fans out to are handed its
+# context (contextvars.copy_context()).
+running_callback = contextvars.ContextVar("running_callback", default=None)
+
+# Memory per row of each loaded column, to report what selecting fewer columns saves
+COLUMN_ROW_BYTES = (df.memory_usage(deep=True, index=False) / max(len(df), 1)).to_dict()
+
+# Per caller: selections made, rows selected, and bytes materialized and saved by selecting only their columns
+column_stats = {}
+column_stats_lock = threading.Lock()
+
+
+def column_usage_layer(func):
+    if func.__name__ not in COLUMN_USAGE:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = running_callback.set(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            running_callback.reset(token)
+    return wrapper
+
+
+CALLBACK_LAYERS.append(column_usage_layer)
+
+
+def record_selection(caller, columns, n_rows):
+    materialized = n_rows * sum(COLUMN_ROW_BYTES.get(column, 0) for column in columns)
+    with column_stats_lock:
+        stats = column_stats.setdefault(caller, {"selections": 0, "rows": 0, "bytes_materialized": 0,
+                                                 "bytes_saved": 0})
+        stats["selections"] += 1
+        stats["rows"] += n_rows
+        stats["bytes_materialized"] += int(materialized)
+        stats["bytes_saved"] += int(n_rows * sum(COLUMN_ROW_BYTES.values()) - materialized)
+
+
+# Rows matching the filters - only the running callback's declared columns of them, unless columns are given
+def select_rows(columns=None, **filters):
+    caller = running_callback.get()
+    columns = columns if columns is not None else COLUMN_USAGE.get(caller)
+    selected = query_backend.select(columns=columns, **filters)
+    if columns is not None:
+        record_selection(caller or "other", columns, len(selected))
+    return selected
+
+
+# Memory each worker saves by loading and selecting only the columns used
+@server.route("/stats/columns")
+def column_report():
+    skipped = SKIPPED_COLUMN_BYTES
+    with column_stats_lock:
+        selections = {caller: dict(stats) for caller, stats in column_stats.items()}
+    return jsonify({"loaded_columns": len(df.columns),
+                    "loaded_bytes": int(df.memory_usage(deep=True, index=False).sum()),
+                    "skipped_columns": sorted(skipped),
+                    "skipped_bytes": sum(skipped.values()),
+                    "selections": selections,
+                    "selection_bytes_saved": sum(stats["bytes_saved"] for stats in selections.values())})
+
+
+# CROSS-FILTERING - a box or lasso selection on a page's map (hp-map, company-map-fig, basin-map-fig) filters the
+# page's other charts. The selected points are matched back to sites by their coordinates, as sent (rounded to
+# COORDINATE_DECIMALS), and held as a row bitmap that the query backend intersects with the page's other filters.
+# A selection holding none of the page's sites - one made before switching company or basin - is ignored.
+def coordinate_keys(latitudes, longitudes):
+    scale = 10 ** COORDINATE_DECIMALS
+    latitudes = np.round(np.asarray(latitudes, dtype=float) * scale)
+    longitudes = np.round(np.asarray(longitudes, dtype=float) * scale) + 180 * scale
+    keys = latitudes * (360 * scale + 1) + longitudes
+    return np.where(np.isnan(keys), -1, keys).astype(np.int64)  # Sites without coordinates are never on a map
+
+
+SITE_COORDINATE_KEYS = coordinate_keys(df["Latitude"], df["Longitude"])
+
+
+def selected_rows(selected_data):
+    points = [point for point in (selected_data or {}).get("points") or [] if "lat" in point and "lon" in point]
+    if not points:
+        return None
+    point_keys = coordinate_keys([point["lat"] for point in points], [point["lon"] for point in points])
+    return pack_rows(np.isin(SITE_COORDINATE_KEYS, point_keys))
+
+
+# The ROW SELECTION filter for sites with all ("All") or any ("Any") of the chosen boolean columns
+def flag_match_filters(flags, match="All"):
+    if not flags:
+        return {}
+    return {"any_flags": list(flags)} if match == "Any" else {"flags": list(flags)}
+
+
+# Extra ROW SELECTION filters for a map selection on the page's entity (company= or basin=; every site on the Home
+# page) - {} if there is no selection or it holds none of the entity's sites. A chart's own filters (flags, receiving
+# environment) are applied on top, so a selection with none of the sites they match totals zero.
+def selection_filters(selected_data, **entity):
+    rows = selected_rows(selected_data)
+    if rows is None or not row_bitmaps.bitmap(rows=rows, **entity).any():
+        return {}
+    return {"rows": rows}
+
+
+# KPI TABLES - the header statistics for every company, basin and futures geography member, built once at load
+# time with one groupby per entity type. The header callbacks look their values up here; anything not in a table
+# (e.g. a cleared dropdown) falls back to computing from the selected rows.
+
+
+def kpi_groups(frame, key_column):
+    keys = frame[key_column]
+    below_target = (frame["Baseline Less than Target Flag"] == "Yes").groupby(keys).sum()
+    return keys, frame.groupby(by=keys).size(), below_target
+
+
+# Water Companies header: sites, local authorities, catchments, basins, % below target, company
+def company_kpi_table(frame):
+    keys, sites, below_target = kpi_groups(frame, "Water company")
+    groups = frame.groupby(by=keys)
+    table = pd.DataFrame({"sites": sites,
+                          "local_authorities": groups["Local Authority"].nunique(dropna=False),
+                          "catchments": groups["Management Catchment"].nunique(dropna=False),
+                          "basins": groups["River Basin District"].nunique(dropna=False),
+                          "pct_below_target": (below_target / (sites + 1) * 100).round(2)})
+    return {company: (*row, company) for company, row in zip(table.index, table.itertuples(index=False))}
+
+
+# River Basins header: % below target, sites, local authorities, water bodies, % needing improvement, basin
+def basin_kpi_table(frame):
+    keys, sites, below_target = kpi_groups(frame, "River Basin District")
+    groups = frame.groupby(by=keys)
+    needing_improvement = (frame["Improvement Count Needed"] > 0).groupby(keys).sum()
+    table = pd.DataFrame({"pct_below_target": (below_target / (sites + 1) * 100).round(2),
+                          "sites": sites,
+                          "local_authorities": groups["Local Authority"].nunique(dropna=False),
+                          "water_bodies": groups["Water Body"].nunique(dropna=False),
+                          "pct_needing_improvement": (needing_improvement / sites * 100).round(0)})
+    return {basin: (*row, basin) for basin, row in zip(table.index, table.itertuples(index=False))}
+
+
+# Futures header for one geography member: sites, % below target, improvements planned, improvements per site,
+# % meeting 2050 requirements
+def geography_kpi_table(frame, geography):
+    keys, counts, below_target = kpi_groups(frame, geography)
+    sites = frame.groupby(by=keys)["Site name"].nunique()
+    improvements = frame[IMPROVEMENT_COLUMNS].fillna(0).sum(axis=1).groupby(keys).sum()
+    meeting_2050 = (frame["Meets 2050 Requirements"] == 1).groupby(keys).sum()
+    table = pd.DataFrame({"sites": sites,
+                          "pct_below_target": ((below_target + 1) / (sites + 1) * 100).round(2),
+                          "improvements_planned": improvements,
+                          "improvements_ratio": (improvements / sites).round(2),
+                          "pct_meeting_2050": meeting_2050 / counts * 100})
+    return {member: tuple(row) for member, row in zip(table.index, table.itertuples(index=False))}
+
+
+COMPANY_KPIS = company_kpi_table(df)
+BASIN_KPIS = basin_kpi_table(df)
+GEOGRAPHY_KPIS = {geography: geography_kpi_table(df, geography) for geography in FUTURES_GEOGRAPHIES}
+
+
+# DATA EXPORT - the rows behind a page's charts, streamed in chunks as CSV or an Arrow IPC stream (columnar).
+# e.g. /export/csv?company=Yorkshire Water&flags=Bathing Water Discharge Flag&year=2021
+# Repeated flags must all be set, or with match=any at least one of them; any column in BOOLEAN_FILTER_COLUMNS works.
+# Each chunk of df is filtered on its own, so the full filtered copy is never built.
+# Rows carry df's columns - those declared in COLUMN_USAGE, or every column with NWP_LOAD_COLUMNS=all.
+EXPORT_FORMATS = {"csv": ("text/csv", "csv"),
+                  "arrow": ("application/vnd.apache.arrow.stream", "arrows")}
+EXPORT_CHUNK_ROWS = 2000
+
+
+def export_filters(args):
+    filters = {name: args[name] for name in SELECTION_COLUMNS if name in args}
+    if "geography" in args or "member" in args:
+        if args.get("geography") not in FUTURES_GEOGRAPHIES or "member" not in args:
+            abort(400, f"geography must be one of {FUTURES_GEOGRAPHIES} and given with a member")
+        filters["geography"] = args["geography"]
+        filters["geography_member"] = args["member"]
+    flags = args.getlist("flags")
+    if any(flag not in BOOLEAN_FILTER_COLUMNS for flag in flags):
+        abort(400, f"flags must be from {BOOLEAN_FILTER_COLUMNS}")
+    if args.get("match", "all") not in ("all", "any"):
+        abort(400, "match must be all or any")
+    if flags:
+        filters.update(flag_match_filters(flags, args.get("match", "all").title()))
+    return filters
+
+
+def export_columns(year):
+    # A single year keeps just that year's spill events column, as on the pages
+    if year in (None, "All"):
+        return list(df.columns)
+    if year not in [str(option) for option in YEAR_OPTIONS]:
+        abort(400, f"year must be one of {YEAR_OPTIONS}")
+    dropped = [column for column in SPILL_EVENT_COLUMNS if column != f"Spill Events {year}"]
+    return [column for column in df.columns if column not in dropped]
+
+
+def export_chunks(filters, columns):
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+        yield chunk.loc[selection_mask(chunk, **filters), columns]
+
+
+def csv_stream(chunks):
+    for i, chunk in enumerate(chunks):
+        yield chunk.to_csv(index=False, header=(i == 0))
+
+
+def arrow_stream(chunks, columns):
+    sink = io.BytesIO()
+    schema = pa.Schema.from_pandas(df[columns].iloc[:0], preserve_index=False)
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for chunk in chunks:
+            if len(chunk):
+                writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()  # End-of-stream marker
+
+
+@server.route("/export/<export_format>")
+def export_rows(export_format):
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    filters = export_filters(request.args)
+    columns = export_columns(request.args.get("year"))
+    chunks = export_chunks(filters, columns)
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    stream = csv_stream(chunks) if export_format == "csv" else arrow_stream(chunks, columns)
+    return Response(stream_with_context(stream),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=national_water_plan.{extension}"})
+
+
+# NEARBY SITES - sites within a distance of a point or of any site with a flag set, and the k sites nearest a
+# point, answered by a KD-tree over the site coordinates built at load time (see SiteLocator). Used by the
+# Home page panel and /api/sites/near.
+site_locator = SiteLocator(df["Latitude"], df["Longitude"])
+
+
+def near_sites(rows, distances_km):
+    return df.iloc[rows][NEAR_SITE_COLUMNS].assign(**{"Distance (km)": distances_km})
+
+
+def sites_within(latitude, longitude, radius_km):
+    return near_sites(*site_locator.within(latitude, longitude, radius_km))
+
+
+def sites_nearest(latitude, longitude, k):
+    return near_sites(*site_locator.nearest(latitude, longitude, k))
+
+
+def sites_near_flag(flag, radius_km):
+    return near_sites(*site_locator.near_rows(row_bitmaps.mask(flags=[flag]), radius_km))
+
+
+# The site clicked on a map, as (latitude, longitude), or None
+def clicked_point(click_data):
+    for point in (click_data or {}).get("points") or []:
+        if "lat" in point and "lon" in point:
+            return point["lat"], point["lon"]
+    return None
+
+
+# SCENARIOS - the Futures page what-if panel. The chosen improvements are delivered by a year and/or remove a share
+# of the projected spills at every site needing them; the engine recomputes every geography member's trajectory
+# from arrays built at load time (see national_water_plan_scenarios.py).
+scenario_engine = ScenarioEngine(df, IMPROVEMENT_COLUMNS, FUTURES_GEOGRAPHIES, PROJECTED_SPILL_COLUMNS)
+
+
+# UNCERTAINTY BANDS - the projected spill lines' Uncertainty mode shades Monte Carlo percentile bands around them
+# (see projected_bands). The draws run across a pool of NWP_UNCERTAINTY_WORKERS processes (1 - in the request's
+# thread) and the bands are kept per (geography, member). Seeded with NWP_UNCERTAINTY_SEED, so every worker process
+# and every restart draws the same bands.
+UNCERTAINTY_DRAWS = int(os.environ.get("NWP_UNCERTAINTY_DRAWS", 2000))
+UNCERTAINTY_WORKERS = int(os.environ.get("NWP_UNCERTAINTY_WORKERS", min(4, os.cpu_count() or 1)))
+UNCERTAINTY_SEED = int(os.environ.get("NWP_UNCERTAINTY_SEED", 0))
+BAND_OPACITIES = {(5, 95): 0.15, (25, 75): 0.3}  # Shaded percentile ranges - outermost first
+
+uncertainty_pool = ProcessPoolExecutor(max_workers=UNCERTAINTY_WORKERS) if UNCERTAINTY_WORKERS > 1 else None
+
+
+@functools.lru_cache(maxsize=256)
+@shared_memo
+def projected_spill_bands(geography, member):
+    sites = select_rows(PROJECTED_SPILL_COLUMNS + SPILL_EVENT_COLUMNS[:3],
+                        geography=geography, geography_member=member)
+    return projected_bands(sites, UNCERTAINTY_DRAWS, UNCERTAINTY_SEED, (geography, member), uncertainty_pool,
+                           PROJECTED_SPILL_COLUMNS)
+
+
+# Shade the bands behind a projected spills line, divided by scale (e.g. the number of sites, for a line of the
+# average per site)
+def add_projection_bands(fig, bands, scale=1):
+    years = [str(year) for year in bands.index]
+    for (low, high), opacity in BAND_OPACITIES.items():
+        fig.add_scatter(x=years,
+                        y=bands[high] / scale,
+                        mode="lines",
+                        line=dict(width=0),
+                        hoverinfo="skip",
+                        showlegend=False)
+        fig.add_scatter(x=years,
+                        y=bands[low] / scale,
+                        mode="lines",
+                        line=dict(width=0),
+                        fill="tonexty",
+                        fillcolor=f"rgba(47, 75, 124, {opacity})",
+                        name=f"{low}th-{high}th Percentile")
+    return fig
+
+
+# RELEASE CHANGES - sites added, removed and changed between two plan releases in the dataset store, for the
+# Release Changes page (see national_water_plan_releases.py). Each pair of releases is diffed once per worker, and
+# again whenever either release is rewritten in the store (their store_fingerprint() changes).
+RELEASE_CHANGED_COLUMNS = 15  # Columns shown in the changed columns chart - those with the most changes
+
+
+# Every column is compared, including those the pages never load into df
+def release_sites(release):
+    return load_sites(release=release) if DATASET_DIR is not None else df
+
+
+@functools.lru_cache(maxsize=4)
+@shared_memo
+def release_diff(old_release, new_release, fingerprint):
+    return diff_releases(release_sites(old_release), release_sites(new_release))
+
+
+def release_changes(old_release, new_release):
+    return release_diff(old_release, new_release, store_fingerprint([old_release, new_release]))
+
+
+# MAP TILES - the sites in Web Mercator z/x/y tiles (see national_water_plan_tiles.py), served as JSON from
+# /tiles/<dataset version>/<z>/<x>/<y>.json: the sites themselves from POINT_ZOOM, per-cell counts and spill sums
+# below it. A tile never changes within a dataset version, so each is built once per worker and sent with a year
+# long cache lifetime; /tiles/tiles.json (TileJSON) gives the current version's URL template.
+# The maps only send the sites in view. Each map's zoomed or panned view (its relayoutData geo keys) is kept in its
+# "<map>-view" store and the map callback selects just the sites in the tiles covering it - still as individual
+# points, so map selections and clicks match sites as before. A map re-centred on another basin or member drops
+# the view it had.
+TILE_CACHE_SECONDS = 365 * 24 * 60 * 60
+# A europe scoped map shows about this many degrees of longitude and latitude at projection scale 1. The view is
+# widened by VIEW_MARGIN, as the map's shape and conic projection bend its edges.
+GEO_SCOPE_SPAN = (90, 55)
+VIEW_MARGIN = 2
+
+site_tiles = TileSet(df["Latitude"], df["Longitude"], {column: df[column] for column in SPILL_EVENT_COLUMNS})
+
+
+@functools.lru_cache(maxsize=4096)
+def tile_json(z, x, y):
+    return json.dumps({name: np.asarray(values).tolist() for name, values in site_tiles.tile(z, x, y).items()})
+
+
+@server.route("/tiles/<version>/<int:z>/<int:x>/<int:y>.json")
+def map_tile(version, z, x, y):
+    if version != DATASET_VERSION or z > MAX_ZOOM or x >= 1 << z or y >= 1 << z:
+        abort(404)
+    response = Response(tile_json(z, x, y), mimetype="application/json")
+    response.headers["Cache-Control"] = f"public, max-age={TILE_CACHE_SECONDS}, immutable"
+    response.set_etag(f"{DATASET_VERSION}-{z}-{x}-{y}")
+    return response.make_conditional(request)
+
+
+@server.route("/tiles/tiles.json")
+def tilejson():
+    response = jsonify({"tilejson": "3.0.0",
+                        "name": "National Water Plan sites",
+                        "version": DATASET_VERSION,
+                        "tiles": [f"{request.host_url}tiles/{DATASET_VERSION}/{{z}}/{{x}}/{{y}}.json"],
+                        "minzoom": 0,
+                        "maxzoom": MAX_ZOOM,
+                        "fields": SPILL_EVENT_COLUMNS})
+    response.headers["Cache-Control"] = "no-cache"  # Points at the current version's tiles
+    return response
+
+
+# Keep the geo keys of each relayout event; clear the view when any other input (a re-centring dropdown) fires
+MAP_VIEW_MERGE = """
+function (relayoutData) {
+    var context = window.dash_clientside.callback_context;
+    var view = arguments[arguments.length - 1];
+    var relayout = context.triggered.some(function (input) { return input.prop_id.endsWith(".relayoutData"); });
+    if (!relayout) {
+        return context.triggered.length ? null : window.dash_clientside.no_update;
+    }
+    var keys = Object.keys(relayoutData || {}).filter(function (key) { return key.indexOf("geo.") === 0; });
+    if (!keys.length) {
+        return window.dash_clientside.no_update;
+    }
+    var merged = Object.assign({}, view);
+    keys.forEach(function (key) { merged[key] = relayoutData[key]; });
+    return merged;
+}
+"""
+
+
+def track_map_view(map_id, *recentre_inputs):
+    app.clientside_callback(MAP_VIEW_MERGE,
+                            Output(f"{map_id}-view", "data"),
+                            Input(map_id, "relayoutData"),
+                            *recentre_inputs,
+                            State(f"{map_id}-view", "data"))
+
+
+track_map_view("hp-map")
+track_map_view("company-map-fig", Input("wc-dropdown", "value"))
+track_map_view("basin-map-fig", Input("basin-dropdown", "value"))
+track_map_view("futures-map", Input("geography-member-dropdown", "value"))
+
+
+# Extra ROW SELECTION filters for the sites in a map's view - {} before it is zoomed or panned, or when every site
+# is in view. centre (latitude, longitude) and scale are the figure's own view.
+def view_filters(view, centre, scale):
+    if not view:
+        return {}
+    latitude = view.get("geo.center.lat", centre[0])
+    longitude = view.get("geo.center.lon", centre[1])
+    scale = view.get("geo.projection.scale", scale)
+    half_lon, half_lat = (span * VIEW_MARGIN / scale / 2 for span in GEO_SCOPE_SPAN)
+    in_view = site_tiles.mask_within(longitude - half_lon, latitude - half_lat,
+                                     longitude + half_lon, latitude + half_lat)
+    if in_view.sum() == len(site_tiles.rows):  # Every site with coordinates
+        return {}
+    return {"rows": pack_rows(in_view)}
+
 
 # CREATE CALLBACKS
 # Page navigation - navigate to the page by url. Error if another page is tried to be reached.
@@ -462,6 +2053,8 @@ def render_page_content(pathname):
         return basin_content
     elif pathname == "/futures":
         return futures_content
+    elif pathname == "/release-changes":
+        return releases_content
     return html.Div(
         [
             html.H1("404: Not found", className="text-danger"),
@@ -477,8 +2070,12 @@ def render_page_content(pathname):
 # Filterable by whether they are bathing water/shellfish/ecoloical/marine protected/priority flag
 @callback(
     Output("hp-map", "figure"),
-    Input("hp-year-radio", "value"))
-def update_hp_map(year):
+    Input("hp-year-radio", "value"),
+    Input("hp-map-view", "data"),
+    background=True,
+    running=[(Output("hp-map-progress", "style"), BACKGROUND_RUNNING_STYLE, BACKGROUND_IDLE_STYLE)],
+    cancel=[Input("hp-map-cancel", "n_clicks"), Input("url", "pathname")])
+def update_hp_map(year, view):
     if df.empty:
         failed_fig = px.scatter_geo(title=f"Failed for your selection")
         failed_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10))
@@ -494,8 +2091,9 @@ def update_hp_map(year):
     spill_column = year_column_map.get(year)
 
     # Filter and aggregate data based on the selected year
-    filtered_year_agg_df = df[["Site name", "Latitude", "Longitude", "Water company", spill_column]].groupby(
-        by=["Site name", "Water company"], as_index=False).sum().reset_index(drop=True)
+    filtered_year_agg_df = query_backend.aggregate(by=["Site name", "Water company"],
+                                                   columns=["Latitude", "Longitude", spill_column],
+                                                   **view_filters(view, MAP_CENTRE, 5))
 
     # Create scatter:
     map_fig = px.scatter_geo(filtered_year_agg_df,
@@ -503,29 +2101,26 @@ def update_hp_map(year):
                              lon="Longitude",
                              color="Water company",
                              size=spill_column,
-                             color_discrete_sequence=plot_palette,
+                             color_discrete_map=company_colours,
                              title=f"<b>Sewage Spill Events by Site - {str(year)}<b>",
                              scope="europe",
                              basemap_visible=True,
-                             center=dict(lat=52.43, lon=-1.22),
+                             center=dict(lat=MAP_CENTRE[0], lon=MAP_CENTRE[1]),
                              template="seaborn")
     map_fig.update_layout(transition_duration=500,
                           geo=dict(projection_scale=5),
+                          uirevision="hp-map",  # Keep the user's zoom through year changes
                           margin=dict(l=10, r=10, t=30, b=10))
-    map_fig.update_geos(resolution=50,
-                        showland=True, landcolor="LightGreen",
-                        showocean=True, oceancolor="LightBlue",
-                        showlakes=True, lakecolor="Blue",
-                        showrivers=True, rivercolor="Blue",
-                        showcountries=True)
+    map_fig.update_geos(**MAP_GEOS)
     return map_fig
 
 
 # Pie chart of count of all releases by Receiving environment. Filterable by year the type flags.
 @callback(
     Output("hp-pie", "figure"),
-    Input("hp-year-radio", "value"))
-def update_hp_pie(year):
+    Input("hp-year-radio", "value"),
+    Input("hp-map", "selectedData"))
+def update_hp_pie(year, selected_data):
     if df.empty:
         return px.pie(title=f"<b>Your selection failed<b>")
 
@@ -536,7 +2131,8 @@ def update_hp_pie(year):
         year_col = "All Spill Events"
         year_title = f"<b>All Sewage Spill Events<b>"
 
-    filtered_df = df[["Receiving Environment", year_col]].groupby(by="Receiving Environment", as_index=False).sum()
+    filtered_df = query_backend.aggregate(by=["Receiving Environment"], columns=[year_col],
+                                          **selection_filters(selected_data))
 
     pie_fig = px.pie(filtered_df,
                      values=year_col,
@@ -551,24 +2147,16 @@ def update_hp_pie(year):
 
 # Home page - Bar chart of counts of each type of improvements by receiving environment
 @callback(Output("home-improvements-bar", "figure"),
-              Input("hp-receiving-environment", "value"))
-def improvements_bar_count(receiving_environment):
-    filtered_df = df[df["Receiving Environment"] == receiving_environment]
+              Input("hp-receiving-environment", "value"),
+              Input("hp-map", "selectedData"))
+def improvements_bar_count(receiving_environment, selected_data):
+    counts = query_backend.total(IMPROVEMENT_COLUMNS, receiving_environment=receiving_environment,
+                                 **selection_filters(selected_data))
     reshaped_df = pd.DataFrame({"Improvement": ["Storage", "Mew Screen", "Other Unconfirmed Improvements",
                                                 "Nature-Based", "Increased pass forward flow", "Bespoke solution",
                                                 "Sealing of sewers", "Operational Improvement", "Smart sewers",
                                                 "Spill treatment"],
-                                "Count": [np.sum(filtered_df["Storage"]),
-                                          np.sum(filtered_df["Mew screen"]),
-                                          np.sum(filtered_df["Other improvements to be confirmed"]),
-                                          np.sum(filtered_df["Nature-Based"]),
-                                          np.sum(filtered_df["Increased pass forward flow"]),
-                                          np.sum(filtered_df["Bespoke solution"]),
-                                          np.sum(filtered_df["Sealing of sewers"]),
-                                          np.sum(filtered_df["Operational"]),
-                                          np.sum(filtered_df["Smart sewers"]),
-                                          np.sum(filtered_df["Spill treatment"])]
-                                })
+                                "Count": counts.to_numpy()})
     bar_fig = px.histogram(data_frame=reshaped_df.sort_values(by="Improvement", ascending=True),
                            x="Improvement",
                            y="Count",
@@ -582,12 +2170,14 @@ def improvements_bar_count(receiving_environment):
 
 # Barchart total spills per year by Basin district. Filterable by year.
 @callback(Output("hp-basin-bar", "figure"),
-              Input("hp-year-radio", "value"))
-def update_hp_basin_bar(year):
+              Input("hp-year-radio", "value"),
+              Input("hp-map", "selectedData"))
+def update_hp_basin_bar(year, selected_data):
+    selection = selection_filters(selected_data)
     if year == "All":
-        filtered_df = (df[["River Basin District", "All Spill Events"]].groupby
-                       (by="River Basin District", as_index=False).sum().reset_index(drop=True).sort_values
-                       (by="River Basin District", ascending=False))
+        filtered_df = query_backend.aggregate(by=["River Basin District"], columns=["All Spill Events"],
+                                              **selection).sort_values(
+            by="River Basin District", ascending=False)
 
         bar_fig = px.histogram(data_frame=filtered_df,
                                x="River Basin District",
@@ -600,9 +2190,9 @@ def update_hp_basin_bar(year):
         return bar_fig
 
     if year == 2020:
-        filtered_df = df[["River Basin District", "Spill Events 2020"]].groupby(by="River Basin District",
-                                                                                as_index=False).sum().reset_index(
-            drop=True).sort_values(by="River Basin District", ascending=False)
+        filtered_df = query_backend.aggregate(by=["River Basin District"], columns=["Spill Events 2020"],
+                                              **selection).sort_values(
+            by="River Basin District", ascending=False)
 
         bar_fig = px.histogram(data_frame=filtered_df,
                                x="River Basin District",
@@ -615,9 +2205,9 @@ def update_hp_basin_bar(year):
         return bar_fig
 
     if year == 2021:
-        filtered_df = df[["River Basin District", "Spill Events 2021"]].groupby(by="River Basin District",
-                                                                                as_index=False).sum().reset_index(
-            drop=True).sort_values(by="River Basin District", ascending=False)
+        filtered_df = query_backend.aggregate(by=["River Basin District"], columns=["Spill Events 2021"],
+                                              **selection).sort_values(
+            by="River Basin District", ascending=False)
         bar_fig = px.histogram(data_frame=filtered_df,
                                x="River Basin District",
                                y="Spill Events 2021",
@@ -629,9 +2219,9 @@ def update_hp_basin_bar(year):
         return bar_fig
 
     if year == 2022:
-        filtered_df = df[["River Basin District", "Spill Events 2022"]].groupby(by="River Basin District",
-                                                                                as_index=False).sum().reset_index(
-            drop=True).sort_values(by="River Basin District", ascending=False)
+        filtered_df = query_backend.aggregate(by=["River Basin District"], columns=["Spill Events 2022"],
+                                              **selection).sort_values(
+            by="River Basin District", ascending=False)
 
         bar_fig = px.histogram(data_frame=filtered_df,
                                x="River Basin District",
@@ -644,57 +2234,134 @@ def update_hp_basin_bar(year):
         return bar_fig
 
 
-# 2020, 2021, 2022 Total Spills barchart. Filterable by each flag or all flags
+# 2020, 2021, 2022 Total Spills barchart. Filterable by any combination of flags - sites with all of them or with
+# any of them
 @callback(Output("total-spills_flagged-bar", "figure"),
-              Input("flags-dropdown", "value"))
-def hp_spills_flag_bar(flags):
-    num_flags = len(flags)
-    if num_flags == 0:
-        filtered_df = df  # All sites included
-    if num_flags == 1:
-        filtered_df = df[(df[flags[0]] == "Yes")]
-    if num_flags == 2:
-        filtered_df = df[(df[flags[0]] == "Yes") & (df[flags[1]] == "Yes")]
-    if num_flags == 3:
-        filtered_df = df[(df[flags[0]] == "Yes") & (df[flags[1]] == "Yes") & (df[flags[2]] == "Yes")]
-    if num_flags == 4:
-        filtered_df = df[
-            (df[flags[0]] == "Yes") & (df[flags[1]] == "Yes") & (df[flags[2]] == "Yes") & (df[flags[3]] == "Yes")]
-
-    title_flags = str(flags).strip("[\'").strip("\']").strip("\'").strip()
-    summed_df = filtered_df[["Spill Events 2020", "Spill Events 2021", "Spill Events 2022"]].groupby(
-        by=["Spill Events 2020", "Spill Events 2021", "Spill Events 2022"], as_index=False).sum()
+              Input("flags-dropdown", "value"),
+              Input("flags-match-radio", "value"),
+              Input("hp-map", "selectedData"))
+def hp_spills_flag_bar(flags, flags_match, selected_data):
+    # All sites included when no flags are chosen
+    filters = flag_match_filters(flags, flags_match)
+    totals = query_backend.total(SPILL_EVENT_COLUMNS[:3], **filters, **selection_filters(selected_data))
     year_summed_df = pd.DataFrame({"Year": ["2020", "2021", "2022"],
-                                   "Events": [np.sum(summed_df["Spill Events 2020"]),
-                                              np.sum(summed_df["Spill Events 2021"]),
-                                              np.sum(summed_df["Spill Events 2022"])]})
-    if 0 < num_flags < 4:
-        by_string = title_flags.strip("[\'").strip("\']").strip()
-        bar_fig = px.histogram(year_summed_df,
-                               x="Year",
-                               y="Events",
-                               barmode="group",
-                               title=f"<b>Sewage Spill Events by: {by_string}<b>",
-                               nbins=3,
-                               template="seaborn")
-        bar_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
-                              yaxis_title="Sewage Spill Events")
-        return bar_fig
-    if num_flags == 0:
-        bar_fig = px.histogram(year_summed_df,
-                               x="Year",
-                               y="Events",
-                               barmode="group",
-                               title="<b>All Sewage Spill Events",
-                               nbins=3,
-                               template="seaborn")
-        bar_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
-                              yaxis_title="Sewage Spill Events")
-        return bar_fig
+                                   "Events": totals.to_numpy()})
+    if flags:
+        title = f"<b>Sewage Spill Events by {'any of' if flags_match == 'Any' else 'all of'}: {', '.join(flags)}<b>"
+    else:
+        title = "<b>All Sewage Spill Events"
+    bar_fig = px.histogram(year_summed_df,
+                           x="Year",
+                           y="Events",
+                           barmode="group",
+                           title=title,
+                           nbins=3,
+                           template="seaborn")
+    bar_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
+                          yaxis_title="Sewage Spill Events")
+    return bar_fig
+
+
+# Home page - sites within a distance of the site clicked on the map, or, until one is clicked, of any site with
+# the chosen flag
+@callback(Output("near-sites-map", "figure"),
+              Input("near-flag-dropdown", "value"),
+              Input("near-radius-input", "value"),
+              Input("hp-map", "clickData"))
+def near_sites_map(flag, radius_km, click_data):
+    radius_km = radius_km if radius_km is not None and radius_km > 0 else NEAR_RADIUS_KM
+    point = clicked_point(click_data)
+    if point is not None:
+        sites = sites_within(*point, radius_km)
+        title = f"<b>Sites within {radius_km} km of {point[0]:.3f}, {point[1]:.3f}<b>"
+    elif flag in OVERFLOW_LOC_FLAGS:
+        sites = sites_near_flag(flag, radius_km)
+        title = f"<b>Sites within {radius_km} km of a {flag} site<b>"
+    else:
+        sites = sites_within(*MAP_CENTRE, 0)
+        title = "<b>Select a flag or click a site on the map<b>"
+
+    map_fig = px.scatter_geo(sites,
+                             lat="Latitude",
+                             lon="Longitude",
+                             color="Distance (km)",
+                             hover_name="Site name",
+                             hover_data=["Water company", "Receiving Environment"],
+                             title=title,
+                             scope="europe",
+                             basemap_visible=True,
+                             center=dict(lat=point[0] if point else MAP_CENTRE[0],
+                                         lon=point[1] if point else MAP_CENTRE[1]),
+                             template="seaborn")
+    map_fig.update_layout(geo=dict(projection_scale=5),
+                          margin=dict(l=10, r=10, t=30, b=10))
+    map_fig.update_geos(**MAP_GEOS)
+    return map_fig
+
+
+# Home page - the sites nearest the site clicked on the map (the centre of England until one is clicked)
+@callback(Output("nearest-sites-bar", "figure"),
+              Input("nearest-count-input", "value"),
+              Input("hp-map", "clickData"))
+def nearest_sites_bar(k, click_data):
+    k = int(k) if k is not None and k > 0 else NEAREST_SITES
+    point = clicked_point(click_data) or MAP_CENTRE
+    sites = sites_nearest(*point, k)
+    sites = sites.assign(Site=sites["Site name"] + " (" + sites["ID"].astype(str) + ")")
+
+    bar_fig = px.bar(data_frame=sites.iloc[::-1],
+                     x="Distance (km)",
+                     y="Site",
+                     orientation="h",
+                     hover_data=["Water company"],
+                     title=f"<b>{k} Nearest Sites to {point[0]:.3f}, {point[1]:.3f}<b>",
+                     template="seaborn")
+    bar_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10))
+    return bar_fig
+
+
+# WATER COMPANIES PAGE
+# With NWP_COMBINED_COMPANY_PAGE=1 the page is computed in a single request (company_page below): the company
+# subset is filtered once and the figures are built concurrently on a bounded thread pool - most of the time in
+# the pandas/NumPy work releases the GIL. Otherwise each output has its own callback, as registered below.
+COMBINED_COMPANY_PAGE = os.environ.get("NWP_COMBINED_COMPANY_PAGE", "0") == "1"
+COMPANY_PAGE_THREADS = int(os.environ.get("NWP_COMPANY_PAGE_THREADS", 4))
+
+company_page_pool = ThreadPoolExecutor(max_workers=COMPANY_PAGE_THREADS, thread_name_prefix="company-page")
+
+# Build times (ms) per output of the combined page callback - the slowest output is the critical path
+page_build_stats = {}
+page_build_stats_lock = threading.Lock()
+
+
+def company_subset(company, selected_data=None):
+    return select_rows(company=company, **selection_filters(selected_data, company=company))
+
+
+def company_page_callback(*args, **kwargs):
+    # The per-output callbacks are not registered when the combined page callback owns their outputs
+    if COMBINED_COMPANY_PAGE:
+        return lambda func: func
+    return callback(*args, **kwargs)
+
+
+def timed_build(builder, *args):
+    start = time.perf_counter()
+    result = builder(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def record_page_build(page, timings_ms):
+    with page_build_stats_lock:
+        stats = page_build_stats.setdefault(page, {"requests": 0, "total_ms": {}, "last_ms": {}})
+        stats["requests"] += 1
+        stats["last_ms"] = timings_ms
+        for output, ms in timings_ms.items():
+            stats["total_ms"][output] = stats["total_ms"].get(output, 0) + ms
 
 
 # Water companies - calculate and return water company metrics
-@callback(
+@company_page_callback(
     [Output("company-sites", "children"),
      Output("company-lads", "children"),
      Output("company-catchments", "children"),
@@ -703,8 +2370,16 @@ def hp_spills_flag_bar(flags):
      Output("chosen-company", "children")],
     Input("wc-dropdown", "value"))
 def calculate_company_stats(company):
-    filtered_df = df[df["Water company"] == str(company)]
+    return company_kpis(company)
+
+
+def company_kpis(company):
+    if company in COMPANY_KPIS:
+        return COMPANY_KPIS[company]
+    return build_company_stats(company_subset(company), company)
+
 
+def build_company_stats(filtered_df, company):
     site_count = len(filtered_df)
     unique_local_authorities = len(np.unique(filtered_df["Local Authority"]))
     unique_catchments = len(np.unique(filtered_df["Management Catchment"]))
@@ -717,25 +2392,33 @@ def calculate_company_stats(company):
 
 # Water Companies - Map of all sites, sized by spill count. Coloured by whether less than or greater than average
 # or by improvement counts needed. Filterable by year, and down to water company
-@callback(
+@company_page_callback(
     Output("company-map-fig", "figure"),
     Input("company-year-radio", "value"),
-    Input("wc-dropdown", "value")
+    Input("wc-dropdown", "value"),
+    Input("company-map-fig-view", "data")
 )
-def company_map(year, company):
-    # Filter the DataFrame for the selected company
-    filtered_df = df[df["Water company"] == str(company)]
+def company_map(year, company, view):
+    return build_company_map(company_subset(company), year, company, view)
+
 
+def build_company_map(filtered_df, year, company, view=None):
     # Select the correct column based on the year
     if year in [2020, 2021, 2022]:
         spill_col = f"Spill Events {year}"
-        filtered_df["nat_avg"] = AVG_SPILLS_DICT[year]
+        nat_avg = AVG_SPILLS_DICT[year]
     else:
         spill_col = "All Spill Events"
-        filtered_df["nat_avg"] = AVG_SPILLS_DICT["All"]
+        nat_avg = AVG_SPILLS_DICT["All"]
         year = "All Spill Events"
 
-    filtered_df["Difference from National Average"] = filtered_df[spill_col] - filtered_df["nat_avg"]
+    # assign() rather than setting columns - the company subset can be shared between threads
+    # Coloured on the whole company's range, whichever of its sites are in view
+    colour_range = [filtered_df[spill_col].min() - nat_avg, filtered_df[spill_col].max() - nat_avg]
+    in_view = view_filters(view, MAP_CENTRE, 7)
+    if in_view:
+        filtered_df = select_rows(company=company, **in_view)
+    filtered_df = filtered_df.assign(**{"Difference from National Average": filtered_df[spill_col] - nat_avg})
 
     # Generate the figure
     map_fig = px.scatter_geo(filtered_df,
@@ -744,34 +2427,34 @@ def company_map(year, company):
                              color="Difference from National Average",
                              size=spill_col,
                              color_continuous_scale=graduated_palette,
+                             range_color=colour_range,
                              title=f"<b>{company} - Sewage Spill Events - {year}<b>",
                              scope="europe",
                              basemap_visible=True,
-                             center=dict(lat=52.43, lon=-1.22),
+                             center=dict(lat=MAP_CENTRE[0], lon=MAP_CENTRE[1]),
                              template="seaborn"
                              )
     map_fig.update_layout(transition_duration=500,
                           geo=dict(projection_scale=7),
+                          uirevision=company,
                           legend_title_text="Difference from National Average",
                           margin=dict(l=10, r=10, t=30, b=10))
-    map_fig.update_geos(resolution=50,
-                        showland=True, landcolor="LightGreen",
-                        showocean=True, oceancolor="LightBlue",
-                        showlakes=True, lakecolor="Blue",
-                        showrivers=True, rivercolor="Blue",
-                        showcountries=True)
+    map_fig.update_geos(**MAP_GEOS)
 
     return map_fig
 
 
 # - Water Companies - Line chart of all releases coloured by Receiving Environment, by year.
 # Compared to average for all water companies (dotted line)
-@callback(
+@company_page_callback(
     Output("wc-line-fig", "figure"),
-    Input("wc-dropdown", "value"))
-def company_release_line(company):
-    filtered_df = df[df["Water company"] == company]
+    Input("wc-dropdown", "value"),
+    Input("company-map-fig", "selectedData"))
+def company_release_line(company, selected_data):
+    return build_company_release_line(company_subset(company, selected_data), company)
 
+
+def build_company_release_line(filtered_df, company):
     avg_releases = {"2020_company": np.nanmean(filtered_df["Spill Events 2020"]),
                     "2021_company": np.nanmean(filtered_df["Spill Events 2021"]),
                     "2022_company": np.nanmean(filtered_df["Spill Events 2022"]),
@@ -803,11 +2486,17 @@ def company_release_line(company):
 
 # Water companies - Line chart of projected spills 2025-2050 - vs average of other water companies
 # 2025 Projected Spills
-@callback(Output("wc-projected-spills", "figure"),
-              Input("wc-dropdown", "value"))
-def company_projected_line(input_company):
-    filtered_df = df[df["Water company"] == input_company]
+# With Uncertainty, the company's percentile bands are shaded - not over a map selection, as they cover every site
+@company_page_callback(Output("wc-projected-spills", "figure"),
+              Input("wc-dropdown", "value"),
+              Input("company-map-fig", "selectedData"),
+              Input("wc-projection-mode-radio", "value"))
+def company_projected_line(input_company, selected_data, projection_mode):
+    return build_company_projected_line(company_subset(input_company, selected_data), input_company, projection_mode,
+                                        selection_filters(selected_data, company=input_company))
+
 
+def build_company_projected_line(filtered_df, input_company, projection_mode=None, selection=None):
     projected_spill_dict = {"2025_all": np.nanmean(df["2025 Projected Spills"]),
                             "2030_all": np.nanmean(df["2030 Projected Spills"]),
                             "2035_all": np.nanmean(df["2035 Projected Spills"]),
@@ -836,17 +2525,22 @@ def company_projected_line(input_company):
                          name="All Companies Average",
                          line=dict(dash="dash")
                          )
+    if projection_mode == "Uncertainty" and not selection and input_company in COMPANIES and len(filtered_df):
+        add_projection_bands(line_fig, projected_spill_bands("Water company", input_company), len(filtered_df))
     line_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
                            yaxis_title="Projected Sewage Spill Events")
     return line_fig
 
 
 # Water companies - Pie chart of counts of each improvement required
-@callback(Output("wc-pie-fig", "figure"),
-              Input("wc-dropdown", "value"))
-def company_improvement_count_pie(company):
-    filtered_df = df[df["Water company"] == company]
+@company_page_callback(Output("wc-pie-fig", "figure"),
+              Input("wc-dropdown", "value"),
+              Input("company-map-fig", "selectedData"))
+def company_improvement_count_pie(company, selected_data):
+    return build_company_improvement_count_pie(company_subset(company, selected_data), company)
+
 
+def build_company_improvement_count_pie(filtered_df, company):
     summed_df = pd.DataFrame({"Storage": np.sum(filtered_df["Storage"]),
                               "Mew Screen": np.sum(filtered_df["Mew screen"]),
                               "Other unconfirmed improvements ": np.sum(
@@ -873,6 +2567,74 @@ def company_improvement_count_pie(company):
     return pie_fig
 
 
+# Water companies - whole page in one request (NWP_COMBINED_COMPANY_PAGE=1). Only the map depends on the year and
+# the map's view, so a change to either rebuilds just the map.
+if COMBINED_COMPANY_PAGE:
+    @callback(
+        [Output("company-sites", "children"),
+         Output("company-lads", "children"),
+         Output("company-catchments", "children"),
+         Output("company-basins", "children"),
+         Output("company-underperforming", "children"),
+         Output("chosen-company", "children"),
+         Output("company-map-fig", "figure"),
+         Output("wc-line-fig", "figure"),
+         Output("wc-projected-spills", "figure"),
+         Output("wc-pie-fig", "figure")],
+        Input("wc-dropdown", "value"),
+        Input("company-year-radio", "value"),
+        Input("company-map-fig", "selectedData"),
+        Input("wc-projection-mode-radio", "value"),
+        Input("company-map-fig-view", "data"))
+    def company_page(company, year, selected_data, projection_mode, view):
+        start = time.perf_counter()
+        filtered_df = company_subset(company)  # Shared, read-only, by every builder
+        # The charts besides the map only show the sites selected on it
+        selection = selection_filters(selected_data, company=company)
+        selected_df = select_rows(company=company, **selection) if selection else filtered_df
+        timings_ms = {"filter": (time.perf_counter() - start) * 1000}
+
+        chart_builds = {"company_release_line": (build_company_release_line, selected_df, company),
+                        "company_projected_line": (build_company_projected_line, selected_df, company,
+                                                   projection_mode, selection),
+                        "company_improvement_count_pie": (build_company_improvement_count_pie, selected_df, company)}
+        if ctx.triggered_id in ["company-year-radio", "company-map-fig-view"]:
+            builds = {"company_map": (build_company_map, filtered_df, year, company, view)}
+        elif ctx.triggered_id == "wc-projection-mode-radio":
+            builds = {"company_projected_line": chart_builds["company_projected_line"]}
+        elif ctx.triggered_id == "company-map-fig":
+            builds = chart_builds
+        else:
+            builds = dict({"company_stats": (company_kpis, company),
+                           "company_map": (build_company_map, filtered_df, year, company, view)}, **chart_builds)
+        futures = {name: company_page_pool.submit(contextvars.copy_context().run, timed_build, *build)
+                   for name, build in builds.items()}
+
+        results = {}
+        for name, future in futures.items():
+            results[name], timings_ms[name] = future.result()
+        timings_ms["total"] = (time.perf_counter() - start) * 1000
+        record_page_build("water-companies", timings_ms)
+
+        stats = results.get("company_stats", [no_update] * 6)
+        return (*stats,
+                results.get("company_map", no_update),
+                results.get("company_release_line", no_update),
+                results.get("company_projected_line", no_update),
+                results.get("company_improvement_count_pie", no_update))
+
+
+# Per-output build timings for the combined page callbacks
+@server.route("/stats/page-builds")
+def page_build_report():
+    with page_build_stats_lock:
+        report = {page: dict(stats, critical_path=max((name for name in stats["last_ms"]
+                                                       if name not in ("filter", "total")),
+                                                      key=stats["last_ms"].get, default=None))
+                  for page, stats in page_build_stats.items()}
+    return jsonify(report)
+
+
 # River Basin Statistics for top of page
 @callback([Output("basin-sites-below-target", "children"),
                Output("basin-num-sites", "children"),
@@ -883,7 +2645,12 @@ def company_improvement_count_pie(company):
               Input("basin-dropdown", "value")
               )
 def calculate_river_basin_statistics(basin_district):
-    filtered_df = df[df["River Basin District"] == basin_district]
+    if basin_district in BASIN_KPIS:
+        return BASIN_KPIS[basin_district]
+    return build_basin_stats(select_rows(basin=basin_district), basin_district)
+
+
+def build_basin_stats(filtered_df, basin_district):
 
     # Sites within that are baseline less than target
     sites_below_target = round(
@@ -912,14 +2679,18 @@ def calculate_river_basin_statistics(basin_district):
 @callback(
     Output("basin-map-fig", "figure"),
     Input("basin-dropdown", "value"),
-    Input("basin-year-radio", "value")
+    Input("basin-year-radio", "value"),
+    Input("basin-map-fig-view", "data")
 )
-def river_basin_map(basin, year):
-    filtered_df = df[df["River Basin District"] == basin]
+def river_basin_map(basin, year, view):
+    filtered_df = select_rows(basin=basin)
 
     # Coords to centralise to
     avg_x = np.median(filtered_df["Longitude"])
     avg_y = np.median(filtered_df["Latitude"])
+    in_view = view_filters(view, (avg_y, avg_x), 8)
+    if in_view:
+        filtered_df = select_rows(basin=basin, **in_view)
 
     # Select the correct column based on the year
     if year in [2020, 2021, 2022]:
@@ -936,7 +2707,7 @@ def river_basin_map(basin, year):
                              lon="Longitude",
                              color="Water company",
                              size=spill_col,
-                             color_continuous_scale=graduated_palette,
+                             color_discrete_map=company_colours,
                              title=f"<b>{basin} - Sewage Spill Events - {year}<b>",
                              scope="europe",
                              basemap_visible=True,
@@ -945,15 +2716,11 @@ def river_basin_map(basin, year):
                              )
     map_fig.update_layout(transition_duration=500,
                           geo=dict(projection_scale=8),
+                          uirevision=basin,
                           legend_title_text="Water Company",
                           margin=dict(l=10, r=10, t=30, b=10))
 
-    map_fig.update_geos(resolution=50,
-                        showland=True, landcolor="LightGreen",
-                        showocean=True, oceancolor="LightBlue",
-                        showlakes=True, lakecolor="Blue",
-                        showrivers=True, rivercolor="Blue",
-                        showcountries=True)
+    map_fig.update_geos(**MAP_GEOS)
 
     return map_fig
 
@@ -965,19 +2732,21 @@ def river_basin_map(basin, year):
     Input("basin-dropdown", "value"),
     Input("basin-authority-input", "value"),
     Input("basin-authority-best-flag", "value"),
-    Input("basin-year-radio", "value")
+    Input("basin-year-radio", "value"),
+    Input("basin-map-fig", "selectedData")
 )
-def basin_authority_spills(basin, n_authorities, best_worst, year):
+def basin_authority_spills(basin, n_authorities, best_worst, year, selected_data):
+    selection = selection_filters(selected_data, basin=basin)
     num_authorities = len(np.unique(
-        df[df["River Basin District"] == basin]["Local Authority"]))  # Number of local authorities the District has
+        select_rows(basin=basin, **selection)["Local Authority"]))  # Number of local authorities the District has
 
     grouped_cols = ["Local Authority", "Spill Events 2020", "Spill Events 2021",
                     "Spill Events 2022", "All Spill Events"]
 
     if int(num_authorities) >= n_authorities > 0:  # Number of local authorities chosen to list by user
 
-        grouped_df = df[df["River Basin District"] == basin][grouped_cols].groupby(by="Local Authority",
-                                                                                   as_index=False).mean()
+        grouped_df = query_backend.aggregate(by=grouped_cols[:1], columns=grouped_cols[1:], how="mean", basin=basin,
+                                             **selection)
 
         if year in [2020, 2021, 2022]:
             spill_col = f"Spill Events {year}"
@@ -1003,8 +2772,8 @@ def basin_authority_spills(basin, n_authorities, best_worst, year):
 
     else:
         n_authorities = num_authorities
-        grouped_df = (df[df["River Basin District"] == basin][grouped_cols].groupby
-                      (by="Local Authority", as_index=False).mean())
+        grouped_df = query_backend.aggregate(by=grouped_cols[:1], columns=grouped_cols[1:], how="mean", basin=basin,
+                                             **selection)
 
         if year in [2020, 2021, 2022]:
             spill_col = f"Spill Events {year}"
@@ -1033,15 +2802,12 @@ def basin_authority_spills(basin, n_authorities, best_worst, year):
 # option to switch to sum of meeting YYYY requirements as a line chart too
 @callback(
     Output("projected-spills-line", "figure"),
-    Input("basin-dropdown", "value")
+    Input("basin-dropdown", "value"),
+    Input("basin-map-fig", "selectedData")
 )
-def projected_spill_line(basin):
-    projected_cols = ["Receiving Environment", "River Basin District", "2025 Projected Spills", "2030 Projected Spills",
-                      "2035 Projected Spills", "2040 Projected Spills",
-                      "2045 Projected Spills", "2050 Projected Spills"]
-
-    grouped_df = df[df["River Basin District"] == basin][projected_cols].groupby(by="Receiving Environment",
-                                                                                 as_index=False).sum()
+def projected_spill_line(basin, selected_data):
+    grouped_df = query_backend.aggregate(by=["Receiving Environment"], columns=PROJECTED_SPILL_COLUMNS, basin=basin,
+                                         **selection_filters(selected_data, basin=basin))
 
     try:
         proj_coastal_25 = float(
@@ -1129,10 +2895,12 @@ def projected_spill_line(basin):
     Input("basin-dropdown", "value"),
     Input("basin-year-radio", "value"),
     Input("basin-flags-dropdown", "value"),
-    Input("water-bodies-count", "value")
+    Input("water-bodies-count", "value"),
+    Input("basin-map-fig", "selectedData")
 )
-def basin_water_bodies(basin, year, flag, num_water_bodies):
-    filtered_df = df[df["River Basin District"] == basin]
+def basin_water_bodies(basin, year, flag, num_water_bodies, selected_data):
+    selection = selection_filters(selected_data, basin=basin)
+    filtered_df = select_rows(basin=basin, **selection)
     max_water_bodies = len(np.unique(filtered_df["Water Body"]))
 
     # If less than or equal to max water bodies and greater than 0
@@ -1146,16 +2914,17 @@ def basin_water_bodies(basin, year, flag, num_water_bodies):
 
         # Filter by flag
         if flag in OVERFLOW_LOC_FLAGS:
-            df2 = filtered_df[filtered_df[flag] == "Yes"]
+            flag_filters = dict(flags=[flag])
             flag_title = f"{flag} Filtering"
         else:
-            df2 = filtered_df
+            flag_filters = {}
             flag_title = "No Flag filtering"
 
-        # Organize columns and group by water body
-        if len(df2) >= 1:
-            grouped = df2[["Water Body", spill_col]].groupby("Water Body", as_index=False).sum().reset_index \
-                          (drop=True).sort_values(by=spill_col, ascending=False).iloc[: int(num_water_bodies)].copy()
+        # Group by water body
+        grouped = query_backend.aggregate(by=["Water Body"], columns=[spill_col], basin=basin, **flag_filters,
+                                          **selection)
+        if len(grouped) >= 1:
+            grouped = grouped.sort_values(by=spill_col, ascending=False).iloc[: int(num_water_bodies)]
 
             # Plot
             waterbody_bar_fig = px.histogram(data_frame=grouped,
@@ -1180,16 +2949,17 @@ def basin_water_bodies(basin, year, flag, num_water_bodies):
 
         # Filter by flag
         if flag in OVERFLOW_LOC_FLAGS:
-            df2 = filtered_df[filtered_df[flag] == "Yes"]
+            flag_filters = dict(flags=[flag])
             flag_title = f"{flag} Filtering"
         else:
-            df2 = filtered_df
+            flag_filters = {}
             flag_title = "No Flag filtering"
 
-        # Organize columns and group by water body
-        if len(df2) >= 1:
-            grouped = df2[["Water Body", spill_col]].groupby("Water Body", as_index=False).sum().reset_index \
-                          (drop=True).sort_values(by=spill_col, ascending=False).iloc[: int(num_water_bodies)].copy()
+        # Group by water body
+        grouped = query_backend.aggregate(by=["Water Body"], columns=[spill_col], basin=basin, **flag_filters,
+                                          **selection)
+        if len(grouped) >= 1:
+            grouped = grouped.sort_values(by=spill_col, ascending=False).iloc[: int(num_water_bodies)]
 
             # Plot
             waterbody_bar_fig = px.histogram(data_frame=grouped,
@@ -1234,32 +3004,18 @@ def update_geography_dropdown(search_value):
      Output("futures-improvements-ratio", "children"),
      Output("futures-meeting-2050", "children")],
     Input("geography-member-dropdown", "value"),
-    State("geography-dropdown", "value")
+    State("geography-dropdown", "value"),
+    background=True,
+    running=[(Output("futures-stats-progress", "style"), BACKGROUND_RUNNING_STYLE, BACKGROUND_IDLE_STYLE)],
+    cancel=[Input("futures-stats-cancel", "n_clicks"), Input("url", "pathname")]
 )
 def futures_stats(geography_member, selected_geography):
     # If a specific geography member is selected
     if geography_member != "All":
-        filtered_df = df[df[selected_geography] == geography_member]
-
-        total_sites = int(len(filtered_df["Site name"].unique()))
-        pct_sites_currently_below_target = round(
-            (len(filtered_df[filtered_df["Baseline Less than Target Flag"] == "Yes"]) + 1) / (total_sites + 1) * 100, 2)
-
-        total_improvements_planned = np.sum(filtered_df[["Storage", "Mew screen", "Other improvements to be confirmed",
-                                                         "Nature-Based", "Increased pass forward flow",
-                                                         "Bespoke solution", "Sealing of sewers", "Operational",
-                                                         "Smart sewers", "Spill treatment"]].fillna(0).values)
-
-        total_improvements_planned_ratio = round(total_improvements_planned / total_sites, 2)
-
-        try:
-            sites_meeting_2050_target = (len(filtered_df[filtered_df["Meets 2050 Requirements"] == 1]) / len(
-                filtered_df)) * 100
-        except ZeroDivisionError:
-            sites_meeting_2050_target = "N/A"  # Filtered_df has no length - not populated at the moment in time.
-
-        return (total_sites, pct_sites_currently_below_target, total_improvements_planned,
-                total_improvements_planned_ratio, sites_meeting_2050_target)
+        member_kpis = GEOGRAPHY_KPIS.get(selected_geography, {})
+        if geography_member in member_kpis:
+            return member_kpis[geography_member]
+        return build_geography_stats(select_rows(geography=selected_geography, geography_member=geography_member))
 
     # If "All" geography members are selected, return aggregated statistics for the entire geography
     else:
@@ -1283,20 +3039,52 @@ def futures_stats(geography_member, selected_geography):
                 sites_meeting_2050_target)
 
 
+def build_geography_stats(filtered_df):
+    total_sites = int(len(filtered_df["Site name"].unique()))
+    pct_sites_currently_below_target = round(
+        (len(filtered_df[filtered_df["Baseline Less than Target Flag"] == "Yes"]) + 1) / (total_sites + 1) * 100, 2)
+
+    total_improvements_planned = np.sum(filtered_df[IMPROVEMENT_COLUMNS].fillna(0).values)
+
+    total_improvements_planned_ratio = round(total_improvements_planned / total_sites, 2)
+
+    try:
+        sites_meeting_2050_target = (len(filtered_df[filtered_df["Meets 2050 Requirements"] == 1]) / len(
+            filtered_df)) * 100
+    except ZeroDivisionError:
+        sites_meeting_2050_target = "N/A"  # Filtered_df has no length - not populated at the moment in time.
+
+    return (total_sites, pct_sites_currently_below_target, total_improvements_planned,
+            total_improvements_planned_ratio, sites_meeting_2050_target)
+
+
+# Futures map colours span the whole member's improvement counts, whichever of its sites are in view. None (plotly's
+# own range) when the member has no sites, e.g. before one is chosen.
+def member_colour_range(geog_filtered):
+    if not len(geog_filtered):
+        return None
+    return [np.nanmin(geog_filtered["Improvement Count Needed"]), np.nanmax(geog_filtered["Improvement Count Needed"])]
+
+
 # Futures - map of all points in the chosen geography. Coloured by improvement count, filterable by year
 @callback(Output("futures-map", "figure"),
               State("geography-dropdown", "value"),
               Input("geography-member-dropdown", "value"),
-              Input("futures-year-radio", "value")
+              Input("futures-year-radio", "value"),
+              Input("futures-map-view", "data")
               )
-def futures_map(geography, geography_member, year):
+def futures_map(geography, geography_member, year, view):
     # If not 'All', then focus on a single component of that geography and just group by whole geography
     if str(year) != 'All':
         hover_year = "Spill Events " + str(year)
-        geog_filtered = df[df[geography] == geography_member]
+        geog_filtered = select_rows(geography=geography, geography_member=geography_member)
         # Coordinates to centralise to
         avg_x = np.nanmedian(geog_filtered["Longitude"])
         avg_y = np.nanmedian(geog_filtered["Latitude"])
+        colour_range = member_colour_range(geog_filtered)
+        in_view = view_filters(view, (avg_y, avg_x), 8)
+        if in_view:
+            geog_filtered = select_rows(geography=geography, geography_member=geography_member, **in_view)
         scatter_filtered = px.scatter_geo(data_frame=geog_filtered,
                                           lat="Latitude",
                                           lon="Longitude",
@@ -1306,24 +3094,25 @@ def futures_map(geography, geography_member, year):
                                           hover_name="Site name",
                                           hover_data=["Improvement Count Needed"],
                                           color="Improvement Count Needed",
+                                          range_color=colour_range,
                                           size=hover_year,
                                           center=dict(lat=avg_y, lon=avg_x),
                                           template="seaborn")
         scatter_filtered.update_layout(geo=dict(projection_scale=8),
+                                       uirevision=f"{geography}|{geography_member}",
                                        legend_title_text="Improvements Required",
                                        margin=dict(l=10, r=10, t=30, b=10))
-        scatter_filtered.update_geos(resolution=50,
-                                     showland=True, landcolor="LightGreen",
-                                     showocean=True, oceancolor="LightBlue",
-                                     showlakes=True, lakecolor="Blue",
-                                     showrivers=True, rivercolor="Blue",
-                                     showcountries=True)
+        scatter_filtered.update_geos(**MAP_GEOS)
         return scatter_filtered
     elif str(year) == "All":
-        geog_filtered = df[df[geography] == geography_member]
+        geog_filtered = select_rows(geography=geography, geography_member=geography_member)
 
         avg_x = np.nanmedian(geog_filtered["Longitude"])
         avg_y = np.nanmedian(geog_filtered["Latitude"])
+        colour_range = member_colour_range(geog_filtered)
+        in_view = view_filters(view, (avg_y, avg_x), 8)
+        if in_view:
+            geog_filtered = select_rows(geography=geography, geography_member=geography_member, **in_view)
         scatter_unfiltered = px.scatter_geo(data_frame=geog_filtered,
                                             lat="Latitude",
                                             lon="Longitude",
@@ -1332,31 +3121,30 @@ def futures_map(geography, geography_member, year):
                                             title=f"<b>{geography_member} - Sewage Spill Events - {str(year)} Years<b>",
                                             hover_name="Site name",
                                             color="Improvement Count Needed",
+                                            range_color=colour_range,
                                             hover_data=["All Spill Events", "Improvement Count Needed"],
                                             size="All Spill Events",
                                             center=dict(lat=avg_y, lon=avg_x),
                                             template="seaborn"
                                             )
         scatter_unfiltered.update_layout(geo=dict(projection_scale=8),
+                                         uirevision=f"{geography}|{geography_member}",
                                          legend=dict(title="Improvements Required"),
                                          margin=dict(l=10, r=10, t=30, b=10))
-        scatter_unfiltered.update_geos(resolution=50,
-                                       showland=True, landcolor="LightGreen",
-                                       showocean=True, oceancolor="LightBlue",
-                                       showlakes=True, lakecolor="Blue",
-                                       showrivers=True, rivercolor="Blue",
-                                       showcountries=True)
+        scatter_unfiltered.update_geos(**MAP_GEOS)
         return scatter_unfiltered
 
 
-# Futures - Line graph of sum of projected spills each 5 year - Can do whole geography or an individual unit within
+# Futures - Line graph of sum of projected spills each 5 year - Can do whole geography or an individual unit within.
+# With Uncertainty, an individual unit's percentile bands are shaded.
 @callback(Output("futures-projected-line-fig", "figure"),
               Input("geography-dropdown", "value"),
-              Input("geography-member-dropdown", "value"))
-def futures_projected_line(geography, geography_member):
+              Input("geography-member-dropdown", "value"),
+              Input("futures-projection-mode-radio", "value"))
+def futures_projected_line(geography, geography_member, projection_mode):
     x_years = ["2025", "2030", "2035", "2040", "2045", "2050"]
     if geography_member != "All":
-        filtered_df = df[df[geography] == geography_member].copy()
+        filtered_df = select_rows(geography=geography, geography_member=geography_member)
         proj_2025 = np.sum(filtered_df["2025 Projected Spills"])
         proj_2030 = np.sum(filtered_df["2030 Projected Spills"])
         proj_2035 = np.sum(filtered_df["2035 Projected Spills"])
@@ -1371,6 +3159,8 @@ def futures_projected_line(geography, geography_member):
                            y="Projected Spills",
                            title=f"<b>{geography_member} - Projected Sewage Spill Events 2025-2050<b>",
                            template="seaborn")
+        if projection_mode == "Uncertainty" and len(filtered_df):
+            add_projection_bands(line_fig, projected_spill_bands(geography, geography_member))
         line_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
                                yaxis_title="Projected Sewage Spill Events")
         return line_fig
@@ -1405,7 +3195,7 @@ def futures_projected_line(geography, geography_member):
 def futures_meeting_requirements(geography, geography_member):
     x_years = ["2025", "2030", "2035", "2040", "2045", "2050"]
     if geography_member != "All":
-        filtered_df = df[df[geography] == geography_member].copy()
+        filtered_df = select_rows(geography=geography, geography_member=geography_member)
         req_2025 = round((np.sum(filtered_df["Meets 2025 Requirements"]) / len(filtered_df)) * 100, 2)
         req_2030 = round((np.sum(filtered_df["Meets 2030 Requirements"]) / len(filtered_df)) * 100, 2)
         req_2035 = round((np.sum(filtered_df["Meets 2035 Requirements"]) / len(filtered_df)) * 100, 2)
@@ -1470,7 +3260,7 @@ def projected_spills_year_box(geography, geography_member, year):
 
     # Geographies with only a few individual geography members
     else:
-        filtered_df = df[df[geography] == geography_member]
+        filtered_df = select_rows(geography=geography, geography_member=geography_member)
         box_fig = px.box(data_frame=filtered_df,
                          x=geography,
                          y=selected_year_col,
@@ -1480,6 +3270,240 @@ def projected_spills_year_box(geography, geography_member, year):
         return box_fig
 
 
+# Futures - what-if scenario against the plan: projected spills for the geography member (all sites until one is
+# chosen) and the members whose 2025-2050 total changes most
+@callback(
+    [Output("scenario-line-fig", "figure"),
+     Output("scenario-members-bar", "figure")],
+    Input("geography-dropdown", "value"),
+    Input("geography-member-dropdown", "value"),
+    Input("scenario-improvements-dropdown", "value"),
+    Input("scenario-delivered-by-dropdown", "value"),
+    Input("scenario-reduction-input", "value"))
+def futures_scenario(geography, geography_member, improvements, delivered_by, reduction_pct):
+    geography = geography if geography in FUTURES_GEOGRAPHIES else FUTURES_GEOGRAPHIES[0]
+    what_if = scenario(improvements or [], min(max(reduction_pct or 0, 0), 100) / 100, delivered_by)
+    planned = scenario_engine.totals(geography)
+    totals = scenario_engine.totals(geography, what_if)
+
+    if geography_member in planned.index:
+        name = geography_member
+        planned_line, scenario_line = planned.loc[geography_member], totals.loc[geography_member]
+    else:
+        name = "All Sites"
+        planned_line, scenario_line = planned.sum(), totals.sum()
+    plot_df = pd.DataFrame({"Year": [str(year) for year in PROJECTION_YEARS] * 2,
+                            "Projected Spills": np.concatenate([planned_line.to_numpy(), scenario_line.to_numpy()]),
+                            "Trajectory": ["Planned"] * len(PROJECTION_YEARS) + ["Scenario"] * len(PROJECTION_YEARS)})
+    line_fig = px.line(plot_df,
+                       x="Year",
+                       y="Projected Spills",
+                       color="Trajectory",
+                       title=f"<b>{name} - Projected Sewage Spill Events, Planned vs Scenario<b>",
+                       template="seaborn")
+    line_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
+                           yaxis_title="Projected Sewage Spill Events")
+
+    change = (totals - planned).sum(axis=1).sort_values(kind="stable").iloc[:SCENARIO_MEMBERS]
+    bar_fig = px.bar(x=change.to_numpy(),
+                     y=change.index.astype(str),
+                     orientation="h",
+                     title=f"<b>{geography} - Change in Projected Sewage Spill Events 2025-2050<b>",
+                     template="seaborn")
+    bar_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10),
+                          xaxis_title="Change in Projected Sewage Spill Events",
+                          yaxis_title=geography)
+    return line_fig, bar_fig
+
+
+# RELEASE CHANGES PAGE
+# Sites added, removed and changed per water company, which kinds of column changed, and the most changed columns
+@callback(
+    [Output("release-changes-summary", "children"),
+     Output("release-status-bar", "figure"),
+     Output("release-groups-bar", "figure"),
+     Output("release-columns-bar", "figure")],
+    Input("release-old-dropdown", "value"),
+    Input("release-new-dropdown", "value"))
+def release_changes_page(old_release, new_release):
+    if old_release not in RELEASES or new_release not in RELEASES:
+        return "Please select two releases to compare", no_update, no_update, no_update
+    sites, changes = release_changes(old_release, new_release)
+    summary = release_summary(sites)
+    counts = sites["Status"].value_counts().reindex(STATUSES, fill_value=0)
+
+    status_fig = px.bar(data_frame=summary.melt(id_vars="Water company", value_vars=STATUSES,
+                                                var_name="Status", value_name="Sites"),
+                        x="Water company",
+                        y="Sites",
+                        color="Status",
+                        barmode="stack",
+                        title=f"<b>Sites Added, Removed and Changed - {old_release} to {new_release}<b>",
+                        template="seaborn")
+    status_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10))
+
+    groups_fig = px.bar(data_frame=summary.melt(id_vars="Water company", value_vars=list(CHANGE_GROUPS) + [OTHER_GROUP],
+                                                var_name="Changed", value_name="Sites"),
+                        x="Water company",
+                        y="Sites",
+                        color="Changed",
+                        barmode="group",
+                        title="<b>Changed Sites by What Changed<b>",
+                        template="seaborn")
+    groups_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10))
+
+    column_counts = changes["Column"].astype(str).value_counts().iloc[:RELEASE_CHANGED_COLUMNS]
+    columns_fig = px.bar(data_frame=column_counts.rename_axis("Column").reset_index(name="Sites Changed"),
+                         x="Column",
+                         y="Sites Changed",
+                         title="<b>Most Changed Columns<b>",
+                         template="seaborn")
+    columns_fig.update_layout(margin=dict(l=10, r=10, t=30, b=10))
+
+    return (f"{counts['Added']} Sites Added, {counts['Removed']} Removed, {counts['Changed']} Changed",
+            status_fig, groups_fig, columns_fig)
+
+
+# JSON API - read-only aggregates for other tools, computed the same way as on the pages.
+# Every response carries a strong ETag derived from the dataset version and the request, so a client polling with
+# If-None-Match gets an empty 304 until the data changes. Aggregates are computed once per worker and kept.
+YEARLY_SPILL_GROUPS = {"company": "Water company", "basin": "River Basin District"}
+
+
+def api_etag():
+    query = "&".join(f"{key}={value}" for key, value in sorted(request.args.items(multi=True)))
+    return hashlib.sha256(f"{DATASET_VERSION}|{request.path}?{query}".encode()).hexdigest()[:32]
+
+
+def etag_json(func):
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        etag = api_etag()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(func(**kwargs))
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"  # Always revalidate - a 304 costs next to nothing
+        return response
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def company_aggregates():
+    aggregates = {}
+    for company in COMPANIES:
+        sites, lads, catchments, basins, pct_below_target, _ = company_kpis(company)
+        aggregates[str(company)] = {"sites": sites,
+                                    "local_authorities": lads,
+                                    "management_catchments": catchments,
+                                    "river_basins": basins,
+                                    "pct_below_target": pct_below_target}
+    return aggregates
+
+
+@functools.lru_cache(maxsize=None)
+def basin_aggregates():
+    aggregates = {}
+    for basin in BASIN_DISTRICTS:
+        (pct_below_target, sites, lads, water_bodies,
+         pct_needing_improvement, _) = calculate_river_basin_statistics(basin)
+        aggregates[str(basin)] = {"sites": sites,
+                                  "local_authorities": lads,
+                                  "water_bodies": water_bodies,
+                                  "pct_below_target": pct_below_target,
+                                  "pct_needing_improvement": float(pct_needing_improvement)}
+    return aggregates
+
+
+@functools.lru_cache(maxsize=None)
+def yearly_spill_aggregates(group_column):
+    totals = query_backend.aggregate(by=[group_column], columns=SPILL_EVENT_COLUMNS).set_index(group_column)
+    totals.columns = ["2020", "2021", "2022", "All"]
+    return totals.to_dict(orient="index")
+
+
+@functools.lru_cache(maxsize=None)
+def projected_spill_aggregates(geography, geography_member):
+    if geography_member is None:
+        totals = query_backend.aggregate(by=[geography], columns=PROJECTED_SPILL_COLUMNS).set_index(geography)
+        totals.columns = [column[:4] for column in PROJECTED_SPILL_COLUMNS]
+        return totals.to_dict(orient="index")
+    totals = select_rows(PROJECTED_SPILL_COLUMNS, geography=geography, geography_member=geography_member).sum()
+    return {column[:4]: float(total) for column, total in totals.items()}
+
+
+# Per-company site counts and below-target percentages, as in the Water Companies header
+@server.route("/api/companies")
+@etag_json
+def api_companies():
+    return company_aggregates()
+
+
+# Per-basin statistics, as in the River Basin Districts header
+@server.route("/api/basins")
+@etag_json
+def api_basins():
+    return basin_aggregates()
+
+
+# Total spill events per year for each company (?by=company, default) or basin (?by=basin)
+@server.route("/api/spills/yearly")
+@etag_json
+def api_yearly_spills():
+    group = request.args.get("by", "company")
+    if group not in YEARLY_SPILL_GROUPS:
+        abort(400, f"by must be one of {list(YEARLY_SPILL_GROUPS)}")
+    return yearly_spill_aggregates(YEARLY_SPILL_GROUPS[group])
+
+
+# Projected spills 2025-2050 summed for one geography member (?geography=...&member=...) or every member
+@server.route("/api/spills/projected")
+@etag_json
+def api_projected_spills():
+    geography = request.args.get("geography", "Water company")
+    if geography not in FUTURES_GEOGRAPHIES:
+        abort(400, f"geography must be one of {FUTURES_GEOGRAPHIES}")
+    return projected_spill_aggregates(geography, request.args.get("member"))
+
+
+# Sites near a point (?lat=...&lon=...) or near any site with a flag (?flag=...), nearest first: those within
+# radius_km, or with k=... the k nearest to the point
+@server.route("/api/sites/near")
+@etag_json
+def api_near_sites():
+    radius_km = request.args.get("radius_km", type=float)
+    k = request.args.get("k", type=int)
+    latitude, longitude = request.args.get("lat", type=float), request.args.get("lon", type=float)
+    flag = request.args.get("flag")
+    if (radius_km is None) == (k is None) or (radius_km if k is None else k) <= 0:
+        abort(400, "give one of radius_km or k, greater than 0")
+    if flag is not None:
+        if flag not in OVERFLOW_LOC_FLAGS or radius_km is None:
+            abort(400, f"flag must be one of {OVERFLOW_LOC_FLAGS} and given with radius_km")
+        sites = sites_near_flag(flag, radius_km)
+    elif latitude is None or longitude is None:
+        abort(400, "give lat and lon, or flag")
+    elif k is not None:
+        sites = sites_nearest(latitude, longitude, k)
+    else:
+        sites = sites_within(latitude, longitude, radius_km)
+    return {"sites": sites.drop(columns=["Latitude", "Longitude"]).to_dict(orient="records")}
+
+
 # Run the application
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="Run the National Water Plan Dashapp")
+    parser.add_argument("--prerender", metavar="BUNDLE_DIR",
+                        help="Instead of running, render every page and input combination into a bundle for "
+                             "NWP_PRERENDERED_DIR")
+    parser.add_argument("--callbacks", help="Comma separated callback function names to prerender (default: all)")
+    args = parser.parse_args()
+
+    if args.prerender:
+        if shared_cache is not None:  # The bundle is the build's only output - nothing read from or left in it
+            shared_cache.close()
+            shared_cache = None
+        build_prerendered_bundle(args.prerender, args.callbacks.split(",") if args.callbacks else None)
+    else:
+        app.run(debug=True)
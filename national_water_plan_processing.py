@@ -1,110 +1,326 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
+
 import pandas as pd
 import numpy as np
-import warnings
 
 warnings.simplefilter("ignore")
 
-df = pd.read_csv('C:/Users/tomwr/Datascience/data_visualization/national_water_plan/national_water_plan.csv')
-
-
-# Site name
-df["Site name"] = df["Site name"].fillna("Unknown Site Name", inplace=False)
-df.replace({"Site name":
-           {"TBC": "Unknown Site Name",
-                   "Not Matched in Consents Database": "Unknown Site Name"}},
-           inplace=True)
-
-# Bathing Water Discharge Flag
-df["Bathing Water Discharge Flag"] = df["Bathing Water Discharge Flag"].fillna("N")
-df["Bathing Water Discharge Flag"].replace({"N": "No",
-                                            "Y": "Yes"},
-                                           inplace=True)
-# Shellfish Water Discharge Flag
-df["Shellfish Water Discharge Flag"] = df["Shellfish Water Discharge Flag"].fillna("N")
-df["Shellfish Water Discharge Flag"].replace({"N": "No",
-                                              "Y": "Yes"},
-                                             inplace=True)
-# Ecological High Priority Site Flag
-df["Ecological High Priority Site Flag"] = df["Ecological High Priority Site Flag"].fillna("N")
-df["Ecological High Priority Site Flag"].replace({"N": "No",
-                                                  "Y": "Yes"},
-                                                 inplace=True)
-
-# Non-bathing Priority Site Flag
-df["Non-bathing Priority Site Flag"].fillna("N", inplace=True)
-df["Non-bathing Priority Site Flag"].replace({"N": "No",
-                                              "Y": "Yes"},
-                                             inplace=True)
-# Spill Events 2020, 2021, 2022
-df["Spill Events 2020"].fillna(0, inplace=True)
-df["Spill Events 2021"].fillna(0, inplace=True)
-df["Spill Events 2022"].fillna(0, inplace=True)
-
-# Spill Improvement Date Planned
-df["Spill Improvement Date Planned"].fillna(2040, inplace=True)  # This is most common after 2023
-
-# Rainfall Improvement Target Delivery Flag
-df["Rainfall Improvement Target Delivery Flag"].fillna("N", inplace=True)  # Assume No
-df["Rainfall Improvement Target Delivery Flag"].replace({"N": "No",
-                                                         "Y": "Yes",
-                                                         "UNK": "No"},
-                                                        inplace=True)
-
-
-# Improvements List
-df["Improvements List"].fillna("No planned improvements", inplace=True)
+INPUT_PATH = 'C:/Users/tomwr/Datascience/data_visualization/national_water_plan/national_water_plan.csv'
+OUTPUT_PATH = 'C:/Users/tomwr/Datascience/Datasets/Tabular/national_water_plan/national_water_plan.csv'
 
 improvement_list = ["Storage", "Mew screen", "Other improvements to be confirmed",
                     "Nature-Based", "Increased pass forward flow", "Bespoke solution",
                     "Sealing of sewers", "Operational", "Smart sewers", "Spill treatment"]
 
-# Initialize all improvement columns with 0
-for improvement in improvement_list:
-    df[improvement] = 0
-
-# Iterate through each row and check for improvements
-for index, row in df.iterrows():
-    for improvement in improvement_list:
-        if improvement in row["Improvements List"]:
-            df.at[index, improvement] = 1
-
-# Predicted Annual Spill Frequence Post Scheme
-df['Predicted Annual Spill Frequence Post Scheme'].fillna(round(np.nanmedian(df['Predicted Annual Spill Frequence Post Scheme'])),
-                                                          inplace=True)
-df.rename(columns={'Predicted Annual Spill Frequence Post Scheme': 'Predicted Annual Spill Frequency Post Scheme'},
-          inplace=True)
-
-# Baseline
-df["Baseline"].fillna(0.0, inplace=True)  # Most common value.
-
-# Baseline Less than Target --> Baseline Less than Target Flag
-baseline_target_conditions = [(df["Baseline"] <= df["Predicted Annual Spill Frequency Post Scheme"]),
-                              (df["Baseline"] > df["Predicted Annual Spill Frequency Post Scheme"])]
-df["Baseline Less than Target Flag"] = np.select(baseline_target_conditions, ["Yes", "No"], default="No")
-df.drop(columns=["Baseline Less Than Target"], inplace=True)
-
-# Remove Requires No Improvement column as redundant
-df.drop(columns=["Requires No Improvement"], inplace=True)
-
-# Projected Spills 2025,2030,2035,2040,2045,2050
-df["2025 Projected Spills"].fillna(np.nanmedian(df["2025 Projected Spills"]), inplace=True)
-df["2030 Projected Spills"].fillna(np.nanmedian(df["2030 Projected Spills"]), inplace=True)
-df["2035 Projected Spills"].fillna(np.nanmedian(df["2035 Projected Spills"]), inplace=True)
-df["2040 Projected Spills"].fillna(np.nanmedian(df["2040 Projected Spills"]), inplace=True)
-df["2045 Projected Spills"].fillna(np.nanmedian(df["2045 Projected Spills"]), inplace=True)
-df["2050 Projected Spills"].fillna(np.nanmedian(df["2050 Projected Spills"]), inplace=True)
-
-df.drop(columns=["Improvements List"], inplace=True)
-
-df["Average Spill Count"] = (df["Spill Events 2020"] + df["Spill Events 2021"] + df["Spill Events 2022"])/3
-df["All Spill Events"] = df["Spill Events 2020"] + df["Spill Events 2021"] + df["Spill Events 2022"]
-
-# Create a column that is a row-wise sum of column 35 (Storage) to 44 (Spill treatment)
-df["Improvement Count Needed"] = df["Storage"] + df["Mew screen"] + df["Other improvements to be confirmed"] + \
-                                 df["Nature-Based"] + df["Increased pass forward flow"] + df["Bespoke solution"] + \
-                                 df["Sealing of sewers"] + df["Operational"] + df["Smart sewers"] + df["Spill treatment"]
+spill_event_columns = ["Spill Events 2020", "Spill Events 2021", "Spill Events 2022"]
+
+projected_spill_columns = ["2025 Projected Spills", "2030 Projected Spills", "2035 Projected Spills",
+                           "2040 Projected Spills", "2045 Projected Spills", "2050 Projected Spills"]
+
+YES_NO = {"N": "No", "Y": "Yes"}
+
+# COLUMN RULES - what happens to each column. apply_column_rules() runs each kind of rule as one vectorised
+# pass over all the columns it covers, in the order the rules are listed here.
+
+# Y/N flags - missing values are "N", then the codes are recoded with the mapping
+FLAG_RULES = {"Bathing Water Discharge Flag": YES_NO,
+              "Shellfish Water Discharge Flag": YES_NO,
+              "Ecological High Priority Site Flag": YES_NO,
+              "Non-bathing Priority Site Flag": YES_NO,
+              "Rainfall Improvement Target Delivery Flag": dict(YES_NO, UNK="No")}  # Assume No
+
+# Missing values filled with a constant
+CONSTANT_FILLS = {"Site name": "Unknown Site Name",
+                  "Spill Events 2020": 0,
+                  "Spill Events 2021": 0,
+                  "Spill Events 2022": 0,
+                  "Spill Improvement Date Planned": 2040,  # This is most common after 2023
+                  "Improvements List": "No planned improvements",
+                  "Baseline": 0.0}  # Most common value.
+
+# Values recoded to another value
+VALUE_REPLACEMENTS = {"Site name": {"TBC": "Unknown Site Name",
+                                    "Not Matched in Consents Database": "Unknown Site Name"}}
+
+# Missing values filled with the dataset median, rounded to the given number of decimals (None - not rounded)
+MEDIAN_FILLS = dict({'Predicted Annual Spill Frequence Post Scheme': 0},
+                    **{column: None for column in projected_spill_columns})
+
+# Comma separated lists - one 0/1 column per item, 1 if the list mentions it
+LIST_ENCODINGS = {"Improvements List": improvement_list}
+
+RENAMES = {'Predicted Annual Spill Frequence Post Scheme': 'Predicted Annual Spill Frequency Post Scheme'}
+
+# "Yes" where the comparison holds, otherwise "No"
+COMPARISON_FLAGS = {"Baseline Less than Target Flag": ("Baseline", "<=",
+                                                       "Predicted Annual Spill Frequency Post Scheme")}
+
+# Row-wise aggregates of a block of columns
+DERIVED_COLUMNS = {"Average Spill Count": ("mean", spill_event_columns),
+                   "All Spill Events": ("sum", spill_event_columns),
+                   "Improvement Count Needed": ("sum", improvement_list)}
+
+# Baseline Less Than Target is replaced by the flag, Requires No Improvement is redundant and the Improvements List
+# is encoded into columns
+DROPS = ["Baseline Less Than Target", "Requires No Improvement", "Improvements List"]
+
 # Set 'All' column to 'Yes
-df["All"] = "Yes"
+CONSTANT_COLUMNS = {"All": "Yes"}
+
+COMPARISONS = {"<=": np.less_equal, "<": np.less, ">=": np.greater_equal, ">": np.greater, "==": np.equal}
+AGGREGATIONS = {"sum": np.sum, "mean": np.mean}
+
+
+# Medians used to fill missing values. These are taken over the whole dataset, before any partitioning,
+# so the output is the same however many workers process it.
+def dataset_medians(df):
+    medians = np.nanmedian(df[list(MEDIAN_FILLS)].to_numpy(dtype=float), axis=0)
+    return {column: (median if decimals is None else round(median, decimals))
+            for (column, decimals), median in zip(MEDIAN_FILLS.items(), medians)}
+
+
+# Cleaning and encoding, as stages for any subset of sites - every step only looks at its own row.
+# Flags - missing values filled, then the codes recoded
+def clean_flags(df):
+    df = df.fillna(value={flag: "N" for flag in FLAG_RULES})
+    return df.replace(FLAG_RULES)
+
+
+# Constants and medians filled in one pass, then values recoded
+def impute(df, medians):
+    df = df.fillna(value=dict(CONSTANT_FILLS, **medians))
+    return df.replace(VALUE_REPLACEMENTS)
+
+
+# List encodings - a block of 0/1 columns per list
+def encode_improvements(df):
+    encoded = {}
+    for list_column, items in LIST_ENCODINGS.items():
+        lists = df[list_column].astype(str)
+        for item in items:
+            encoded[item] = lists.str.contains(item, regex=False).to_numpy(dtype=np.int64)
+    return df.assign(**encoded).rename(columns=RENAMES)
+
+
+# Comparison flags and derived aggregates, added as one block
+def derive_metrics(df):
+    derived = {}
+    for flag, (left, comparison, right) in COMPARISON_FLAGS.items():
+        derived[flag] = np.where(COMPARISONS[comparison](df[left].to_numpy(), df[right].to_numpy()), "Yes", "No")
+    for column, (aggregation, columns) in DERIVED_COLUMNS.items():
+        derived[column] = AGGREGATIONS[aggregation](df[columns].to_numpy(), axis=1)
+    derived.update(CONSTANT_COLUMNS)
+
+    return df.drop(columns=DROPS).assign(**derived)
+
+
+def apply_column_rules(df, medians):
+    return derive_metrics(encode_improvements(impute(clean_flags(df), medians)))
+
+
+# Process the whole dataset. With more than one worker, the sites are partitioned by water company and each
+# partition is cleaned and encoded in its own process. The result is in ID order either way.
+def process(df, workers=1):
+    medians = dataset_medians(df)
+    if workers == 1:
+        processed_df = apply_column_rules(df, medians)
+    else:
+        partitions = [company_df for _, company_df in df.groupby(by="Water company", sort=False, dropna=False)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            processed_df = pd.concat(pool.map(apply_column_rules, partitions, repeat(medians)))
+    return processed_df.sort_values(by="ID", kind="stable").reset_index(drop=True)
+
+
+# Write the processed release into a partitioned dataset store, one directory per release and water company:
+# <dataset_dir>/Release=<release>/Water company=<company>/. Re-writing a release replaces its partitions and
+# leaves the other releases alone. The dashboard reads it with NWP_DATASET_DIR set.
+def write_partitioned(processed_df, dataset_dir, release):
+    processed_df.assign(Release=release).to_parquet(dataset_dir,
+                                                    partition_cols=["Release", "Water company"],
+                                                    index=False,
+                                                    existing_data_behavior="delete_matching")
+
+
+def write_outputs(processed_df, output_path, dataset_dir=None, release=None):
+    processed_df.to_csv(output_path, index=False)
+    if dataset_dir:
+        write_partitioned(processed_df, dataset_dir, release)
+
+
+# STAGE CACHE - run_pipeline() processes the data as named stages (load, the cleaning and encoding STAGES, write)
+# and keeps each stage's output in the cache directory for later runs. A stage's key hashes the key before it with
+# the stage's code (its function and the functions of this file it calls) and its rules, starting from a hash of
+# the input file's bytes - so a key stands for the stage's output, and a changed rule recomputes that stage and
+# the ones after it. A run starts after the last stage already cached. The write stage is cached as the hash of
+# the CSV it wrote, and is skipped while that file is unchanged.
+# name -> (function, the rules it applies, None or a function of the whole stage input giving an extra argument)
+STAGES = {"clean flags": (clean_flags, FLAG_RULES, None),
+          "impute": (impute, [CONSTANT_FILLS, VALUE_REPLACEMENTS, MEDIAN_FILLS], dataset_medians),
+          "encode improvements": (encode_improvements, [LIST_ENCODINGS, RENAMES], None),
+          "derive metrics": (derive_metrics, [COMPARISON_FLAGS, DERIVED_COLUMNS, DROPS, CONSTANT_COLUMNS], None)}
+STAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".stage_cache")
+
+
+def load(input_path):
+    return pd.read_csv(input_path)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_code(*functions):
+    called = [globals()[name] for function in functions for name in function.__code__.co_names
+              if inspect.isfunction(globals().get(name))]
+    return "".join(inspect.getsource(function) for function in list(functions) + called)
+
+
+def stage_keys(input_path, write_settings):
+    key = hashlib.sha256(f"{file_hash(input_path)}|load|{stage_code(load)}".encode()).hexdigest()[:32]
+    keys = {"load": key}
+    for name, (function, rules, argument) in STAGES.items():
+        code = stage_code(function, *([argument] if argument else []))
+        keys[name] = key = hashlib.sha256(f"{key}|{name}|{code}|{rules!r}".encode()).hexdigest()[:32]
+    write_key = f"{key}|write|{stage_code(write_outputs)}|{write_settings!r}"
+    keys["write"] = hashlib.sha256(write_key.encode()).hexdigest()[:32]
+    return keys
+
+
+def cached_output(cache_dir, name, key):
+    return os.path.join(cache_dir, f"{name.replace(' ', '-')}-{key}.parquet")
+
+
+def save_output(df, path):
+    building_path = f"{path}.{os.getpid()}.building"
+    df.to_parquet(building_path, index=False)
+    os.replace(building_path, path)
+
+
+# Apply a stage to the whole dataset - across the pool by water company, if given. In ID order either way, so a
+# stage's output is the same however many workers made it.
+def apply_stage(function, argument, df, pool=None):
+    extra = [] if argument is None else [argument(df)]
+    if pool is None:
+        processed_df = function(df, *extra)
+    else:
+        partitions = [company_df for _, company_df in df.groupby(by="Water company", sort=False, dropna=False)]
+        processed_df = pd.concat(pool.map(function, partitions, *map(repeat, extra)))
+    return processed_df.sort_values(by="ID", kind="stable").reset_index(drop=True)
+
+
+# Whether the outputs the write stage recorded in write_record are still there as written
+def written(write_record, output_path, dataset_dir, release):
+    if not os.path.exists(write_record) or not os.path.exists(output_path):
+        return False
+    if dataset_dir and not os.path.isdir(os.path.join(dataset_dir, f"Release={release}")):
+        return False
+    with open(write_record) as record_file:
+        return json.load(record_file)["output_sha256"] == file_hash(output_path)
+
+
+# Run the stages, reusing cached outputs. Returns the run report: per stage, "hit" (taken from the cache),
+# "recomputed" or "skipped" (not needed - a later stage was a hit), with seconds taken and rows out.
+def run_pipeline(input_path, output_path, cache_dir=STAGE_CACHE_DIR, workers=1, dataset_dir=None, release=None):
+    write_settings = {"output": os.path.abspath(output_path),
+                      "dataset_dir": os.path.abspath(dataset_dir) if dataset_dir else None,
+                      "release": release}
+    keys = stage_keys(input_path, write_settings)
+    names = list(keys)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_record = os.path.join(cache_dir, f"write-{keys['write']}.json")
+
+    report = {name: {"stage": name, "status": "skipped", "seconds": 0.0, "rows": None} for name in names}
+    start = time.perf_counter()
+    if written(write_record, output_path, dataset_dir, release):
+        first, df = len(names), None
+        report["write"].update(status="hit")
+    else:
+        first, df = 0, None
+        for position in reversed(range(len(names) - 1)):
+            path = cached_output(cache_dir, names[position], keys[names[position]])
+            if os.path.exists(path):
+                first, df = position + 1, pd.read_parquet(path)
+                report[names[position]].update(status="hit", rows=len(df))
+                break
+    report[names[max(first - 1, 0)]]["seconds"] = time.perf_counter() - start
+
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+        for name in names[first:]:
+            start = time.perf_counter()
+            if name == "load":
+                df = load(input_path)
+            elif name == "write":
+                write_outputs(df, output_path, dataset_dir, release)
+                with open(write_record, "w") as record_file:
+                    json.dump({"output_sha256": file_hash(output_path)}, record_file)
+            else:
+                function, _, argument = STAGES[name]
+                df = apply_stage(function, argument, df, pool)
+            if name != "write":
+                save_output(df, cached_output(cache_dir, name, keys[name]))
+            report[name].update(status="recomputed", seconds=time.perf_counter() - start, rows=len(df))
+    return list(report.values())
+
+
+def print_report(report):
+    print("stage                status      seconds     rows")
+    for stage in report:
+        rows = "" if stage["rows"] is None else f" {stage['rows']:>8}"
+        print(f"{stage['stage']:<20} {stage['status']:<10} {stage['seconds']:>8.2f}{rows}")
+    print(f"{'total':<20} {'':<10} {sum(stage['seconds'] for stage in report):>8.2f}")
+
+
+# Time process() with 1 to max_workers processes
+def benchmark(df, max_workers, repeats=3):
+    print(f"{len(df)} sites, {df['Water company'].nunique()} water companies")
+    print("workers  best (s)  speedup")
+    single_worker_time = None
+    for workers in range(1, max_workers + 1):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            process(df, workers)
+            times.append(time.perf_counter() - start)
+        if single_worker_time is None:
+            single_worker_time = min(times)
+        print(f"{workers:>7}  {min(times):>8.2f}  {single_worker_time / min(times):>6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean and encode the raw National Water Plan overflows data")
+    parser.add_argument("--input", default=INPUT_PATH)
+    parser.add_argument("--output", default=OUTPUT_PATH)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes to clean and encode with - the data is partitioned by water company")
+    parser.add_argument("--dataset-dir",
+                        help="Also write the output into this partitioned dataset store (by release and company)")
+    parser.add_argument("--release", default="2020-2022",
+                        help="Plan release the input belongs to, for --dataset-dir")
+    parser.add_argument("--cache-dir", default=STAGE_CACHE_DIR,
+                        help="Where each stage's output is kept, to be reused by later runs")
+    parser.add_argument("--no-cache", action="store_true", help="Process everything, without the stage cache")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Time processing with 1 to --workers processes (default: all cores) instead")
+    args = parser.parse_args()
 
-# Write out to Local PC
-df.to_csv('C:/Users/tomwr/Datascience/Datasets/Tabular/national_water_plan/national_water_plan.csv', index=False)
+    if args.benchmark:
+        benchmark(pd.read_csv(args.input), args.workers if args.workers > 1 else os.cpu_count())
+    elif args.no_cache:
+        # Write out to Local PC
+        write_outputs(process(pd.read_csv(args.input), args.workers), args.output, args.dataset_dir, args.release)
+    else:
+        print_report(run_pipeline(args.input, args.output, args.cache_dir, args.workers, args.dataset_dir,
+                                  args.release))
@@ -0,0 +1,349 @@
+# Query backends for the National Water Plan Dashapp.
+# The callbacks select and aggregate sites through a backend rather than filtering the DataFrame directly:
+#   PandasBackend - boolean masks and groupby over the in-memory DataFrame (the default)
+#   SQLiteBackend - an embedded, file-based SQLite database with indexes on the geography columns
+# Both return identical DataFrames. Run this file to benchmark them on synthetic datasets of increasing size.
+# SiteLocator answers radius and nearest-site queries over the site coordinates.
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import numpy as np
+from scipy.spatial import KDTree
+
+# ROW SELECTION - the filters the pages apply. A filter is applied when its keyword is passed (even if the value
+# is None, which matches no rows): company, basin, receiving_environment, geography + geography_member,
+# flags (sites set for all of the boolean columns listed), any_flags (sites set for at least one of them) and
+# rows (a row bitmap - see RowBitmaps). A boolean column is either a "Yes"/"No" flag or a 0/1 indicator, like the
+# improvement columns.
+SELECTION_COLUMNS = {"company": "Water company",
+                     "basin": "River Basin District",
+                     "receiving_environment": "Receiving Environment"}
+
+GEOGRAPHY_COLUMNS = ["Water company", "Receiving Environment", "River Basin District", "Management Catchment",
+                     "Local Authority", "Water Body"]
+
+AGGREGATIONS = {"sum": "TOTAL", "mean": "AVG"}  # SQL equivalents of the pandas aggregations
+
+
+def is_numeric(dtype):
+    return dtype.kind in "iufb"
+
+
+def flag_set(values):
+    if is_numeric(values.dtype):
+        return (values.fillna(0) != 0).to_numpy()
+    return (values == "Yes").to_numpy()
+
+
+def selection_mask(frame, **filters):
+    mask = np.ones(len(frame), dtype=bool)
+    for name, column in SELECTION_COLUMNS.items():
+        if name in filters:
+            mask &= (frame[column] == filters[name]).to_numpy()
+    if "geography_member" in filters:
+        mask &= (frame[filters["geography"]] == filters["geography_member"]).to_numpy()
+    for flag in filters.get("flags") or []:
+        mask &= flag_set(frame[flag])
+    if filters.get("any_flags"):
+        mask &= np.logical_or.reduce([flag_set(frame[flag]) for flag in filters["any_flags"]])
+    if "rows" in filters:
+        mask &= unpack_rows(filters["rows"], len(frame))
+    return mask
+
+
+# ROW BITMAPS - a set of rows as packed bits over row positions, one bit per site. Combining sets is a bitwise
+# operation over len(frame) / 8 bytes, however many rows they hold.
+def pack_rows(mask):
+    return np.packbits(mask)
+
+
+def unpack_rows(bitmap, n_rows):
+    return np.unpackbits(bitmap, count=n_rows).view(bool)
+
+
+# Bitmaps of the rows set for each boolean column and of the rows in each member of each geography column, built
+# once from the frame. mask() answers the ROW SELECTION filters with bitwise ANDs and ORs of them.
+class RowBitmaps:
+    def __init__(self, frame, flag_columns, geography_columns=GEOGRAPHY_COLUMNS):
+        self.n_rows = len(frame)
+        self.flags = {flag: pack_rows(flag_set(frame[flag])) for flag in flag_columns}
+        self.geographies = {}
+        for column in geography_columns:
+            codes, members = pd.factorize(frame[column])  # Missing values get no member
+            self.geographies[column] = {member: pack_rows(codes == code) for code, member in enumerate(members)}
+        self.no_rows = pack_rows(np.zeros(self.n_rows, dtype=bool))
+
+    def member(self, column, member):
+        return self.geographies[column].get(member, self.no_rows)
+
+    def bitmap(self, **filters):
+        bitmap = pack_rows(np.ones(self.n_rows, dtype=bool))
+        for name, column in SELECTION_COLUMNS.items():
+            if name in filters:
+                bitmap &= self.member(column, filters[name])
+        if "geography_member" in filters:
+            bitmap &= self.member(filters["geography"], filters["geography_member"])
+        for flag in filters.get("flags") or []:
+            bitmap &= self.flags[flag]
+        if filters.get("any_flags"):
+            bitmap &= np.bitwise_or.reduce([self.flags[flag] for flag in filters["any_flags"]])
+        if "rows" in filters:
+            bitmap &= filters["rows"]
+        return bitmap
+
+    def mask(self, **filters):
+        return unpack_rows(self.bitmap(**filters), self.n_rows)
+
+
+# In-memory pandas backend. company_partition, if given, returns the rows for one company - used instead of the
+# whole frame whenever a selection is by company (and not by row bitmap, whose positions are over the whole
+# frame). bitmaps, if given, is the RowBitmaps of the frame and answers the filters in place of comparing values.
+class PandasBackend:
+    name = "pandas"
+
+    def __init__(self, frame, company_partition=None, bitmaps=None):
+        self.frame = frame
+        self.company_partition = company_partition
+        self.bitmaps = bitmaps
+
+    def _selection(self, filters):
+        if self.company_partition is not None and "company" in filters and "rows" not in filters:
+            frame = self.company_partition(filters["company"])
+            return frame, selection_mask(frame, **filters)
+        if self.bitmaps is not None:
+            return self.frame, self.bitmaps.mask(**filters)
+        return self.frame, selection_mask(self.frame, **filters)
+
+    # Rows matching the filters, in their original order. When every row matches, the result shares the frame's
+    # column data (copy-on-write) rather than copying it.
+    def select(self, columns=None, **filters):
+        frame, mask = self._selection(filters)
+        if mask.all():
+            return frame.copy(deep=False) if columns is None else frame[columns]
+        return frame[mask] if columns is None else frame.loc[mask, columns]
+
+    # Rows matching the filters grouped by the `by` columns, with `columns` aggregated ("sum" or "mean").
+    # One row per group, sorted by group.
+    def aggregate(self, by, columns, how="sum", **filters):
+        frame, mask = self._selection(filters)
+        return frame.loc[mask, by + columns].groupby(by=by, as_index=False).agg(how)
+
+    # Sum of each of `columns` over the rows matching the filters, as a Series indexed by column
+    def total(self, columns, **filters):
+        frame, mask = self._selection(filters)
+        return pd.Series({column: np.nansum(frame[column].to_numpy()[mask]) for column in columns})
+
+
+# Embedded SQL backend. The database is a single file built from the DataFrame by build_sqlite_database(). Each
+# thread gets its own read-only connection.
+class SQLiteBackend:
+    name = "sqlite"
+
+    def __init__(self, path, dtypes):
+        self.path = path
+        self.dtypes = dtypes  # Column dtypes of the source frame, so results come back exactly as pandas gives them
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return self.local.connection
+
+    def _flag_clause(self, flag):
+        return f'"{flag}" != 0' if is_numeric(self.dtypes[flag]) else f""""{flag}" = 'Yes'"""
+
+    def _where(self, filters):
+        clauses, params = [], []
+        for name, column in SELECTION_COLUMNS.items():
+            if name in filters:
+                clauses.append(f'"{column}" = ?')
+                params.append(filters[name])
+        if "geography_member" in filters:
+            clauses.append(f'"{filters["geography"]}" = ?')
+            params.append(filters["geography_member"])
+        for flag in filters.get("flags") or []:
+            clauses.append(self._flag_clause(flag))
+        if filters.get("any_flags"):
+            clauses.append("(" + " OR ".join(self._flag_clause(flag) for flag in filters["any_flags"]) + ")")
+        if "rows" in filters:
+            positions = np.flatnonzero(np.unpackbits(filters["rows"])).tolist()
+            clauses.append("rowid - 1 IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(positions))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def select(self, columns=None, **filters):
+        columns = list(self.dtypes.index) if columns is None else columns
+        where, params = self._where(filters)
+        selected = ", ".join(f'"{column}"' for column in columns)
+        query = f'SELECT rowid - 1 AS row_index, {selected} FROM sites{where} ORDER BY rowid'
+        rows = pd.read_sql_query(query, self.connection, params=params, index_col="row_index")
+        return rows.rename_axis(None).astype(self.dtypes[columns].to_dict())
+
+    def aggregate(self, by, columns, how="sum", **filters):
+        where, params = self._where(filters)
+        # pandas leaves out groups with a missing key
+        not_null = " AND ".join(f'"{column}" IS NOT NULL' for column in by)
+        where = f"{where} AND {not_null}" if where else f" WHERE {not_null}"
+        keys = ", ".join(f'"{column}"' for column in by)
+        aggregated = ", ".join(f'{AGGREGATIONS[how]}("{column}") AS "{column}"' for column in columns)
+        query = f"SELECT {keys}, {aggregated} FROM sites{where} GROUP BY {keys} ORDER BY {keys}"
+        grouped = pd.read_sql_query(query, self.connection, params=params)
+        dtypes = self.dtypes[by].to_dict()
+        if how == "sum":
+            dtypes.update(self.dtypes[columns].to_dict())
+        return grouped.astype(dtypes)
+
+    def total(self, columns, **filters):
+        where, params = self._where(filters)
+        totals = ", ".join(f'TOTAL("{column}")' for column in columns)
+        row = self.connection.execute(f"SELECT {totals} FROM sites{where}", params).fetchone()
+        return pd.Series({column: self.dtypes[column].type(value) for column, value in zip(columns, row)})
+
+
+# Write the frame to an SQLite file with an index per geography column. Built under a temporary name and moved
+# into place, so workers starting together never see a half-written database. An existing file is reused.
+def build_sqlite_database(frame, path, index_columns=GEOGRAPHY_COLUMNS):
+    if not os.path.exists(path):
+        building_path = f"{path}.{os.getpid()}.building"
+        with sqlite3.connect(building_path) as connection:
+            # Written a slice at a time - to_sql converts everything it is given to Python objects up front
+            for start in range(0, max(len(frame), 1), 100_000):
+                frame.iloc[start:start + 100_000].to_sql("sites", connection, index=False,
+                                                         if_exists="append" if start else "replace")
+            for i, column in enumerate(index_columns):
+                connection.execute(f'CREATE INDEX geography_{i} ON sites ("{column}")')
+        connection.close()
+        os.replace(building_path, path)
+    return SQLiteBackend(path, frame.dtypes)
+
+
+# SPATIAL INDEX - sites placed on the unit sphere (3D Cartesian coordinates), where the straight-line distance
+# between two sites maps exactly onto their great-circle distance. A KD-tree over those points finds the sites
+# within a radius, or the k nearest, in O(log n) rather than by measuring every site (or every pair of sites).
+EARTH_RADIUS_KM = 6371.0088
+
+
+def unit_vectors(latitudes, longitudes):
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    return np.column_stack([np.cos(latitudes) * np.cos(longitudes),
+                            np.cos(latitudes) * np.sin(longitudes),
+                            np.sin(latitudes)])
+
+
+def chord_length(distance_km):
+    return 2 * np.sin(np.minimum(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def great_circle_km(chords):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords / 2, 1))
+
+
+# KD-tree over the sites of a frame, by row position. Every query returns (row positions, distances in km),
+# nearest first. Sites without coordinates are never found.
+class SiteLocator:
+    def __init__(self, latitudes, longitudes):
+        points = unit_vectors(latitudes, longitudes)
+        self.rows = np.flatnonzero(np.isfinite(points).all(axis=1))
+        self.tree = KDTree(points[self.rows])
+
+    # Sites within radius_km of a point
+    def within(self, latitude, longitude, radius_km):
+        point = unit_vectors([latitude], [longitude])[0]
+        found = np.asarray(self.tree.query_ball_point(point, chord_length(radius_km)), dtype=np.int64)
+        chords = np.linalg.norm(self.tree.data[found] - point, axis=1)
+        order = np.argsort(chords, kind="stable")
+        return self.rows[found[order]], great_circle_km(chords[order])
+
+    # The k sites nearest a point
+    def nearest(self, latitude, longitude, k):
+        chords, found = self.tree.query(unit_vectors([latitude], [longitude])[0], k=max(min(k, len(self.rows)), 1))
+        return self.rows[np.atleast_1d(found)], great_circle_km(np.atleast_1d(chords))
+
+    # Sites within radius_km of any of the sites in source_mask (a boolean mask over row positions, e.g. a flag),
+    # other than those sites themselves - each with its distance to the nearest of them
+    def near_rows(self, source_mask, radius_km):
+        is_source = np.asarray(source_mask, dtype=bool)[self.rows]
+        if not is_source.any():
+            return self.rows[:0], np.empty(0)
+        sources = KDTree(self.tree.data[is_source])
+        chords, _ = sources.query(self.tree.data[~is_source], k=1, distance_upper_bound=chord_length(radius_km))
+        found = np.flatnonzero(np.isfinite(chords))
+        found = found[np.argsort(chords[found], kind="stable")]
+        return self.rows[~is_source][found], great_circle_km(chords[found])
+
+
+# BENCHMARK - the same selections and aggregations the callbacks make, on synthetic data of increasing size
+BENCHMARK_COLUMNS = GEOGRAPHY_COLUMNS + ["Site name", "Latitude", "Longitude", "Bathing Water Discharge Flag",
+                                         "Ecological High Priority Site Flag", "Spill Events 2020",
+                                         "Spill Events 2021", "Spill Events 2022", "All Spill Events",
+                                         "2025 Projected Spills", "2050 Projected Spills"]
+BENCHMARK_QUERIES = {
+    "company sites": ("select", dict(company="Yorkshire Water")),
+    "local authority sites": ("select", dict(geography="Local Authority", geography_member="Leeds")),
+    "basin totals": ("aggregate", dict(by=["River Basin District"], columns=["Spill Events 2020"])),
+    "authority means in basin": ("aggregate", dict(by=["Local Authority"], how="mean", basin="Humber",
+                                                   columns=["Spill Events 2021", "All Spill Events"])),
+    "flagged water bodies in basin": ("aggregate", dict(by=["Water Body"], columns=["All Spill Events"],
+                                                        basin="Anglian", flags=["Bathing Water Discharge Flag"])),
+}
+
+
+# Resample the real sites (with replacement) up to n_sites, jittering the coordinates and spill counts
+def synthetic_sites(sites, n_sites, seed=0):
+    rng = np.random.default_rng(seed)
+    synthetic = sites[BENCHMARK_COLUMNS].iloc[rng.integers(0, len(sites), n_sites)].reset_index(drop=True)
+    for column in ["Latitude", "Longitude"]:
+        synthetic[column] = synthetic[column] + rng.normal(0, 0.01, n_sites)
+    for column in ["Spill Events 2020", "Spill Events 2021", "Spill Events 2022"]:
+        synthetic[column] = np.maximum(synthetic[column] + rng.integers(-2, 3, n_sites), 0).astype(float)
+    synthetic["All Spill Events"] = synthetic[["Spill Events 2020", "Spill Events 2021",
+                                               "Spill Events 2022"]].sum(axis=1)
+    return synthetic
+
+
+def time_query(backend, method, kwargs, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = getattr(backend, method)(**kwargs)
+        times.append(time.perf_counter() - start)
+    return result, min(times) * 1000
+
+
+def benchmark(sizes, repeats, work_dir):
+    sites = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "national_water_plan.csv"))
+    for n_sites in sizes:
+        synthetic = synthetic_sites(sites, n_sites)
+        start = time.perf_counter()
+        path = os.path.join(work_dir, f"benchmark-{n_sites}.sqlite")
+        if os.path.exists(path):
+            os.remove(path)
+        backends = [PandasBackend(synthetic), build_sqlite_database(synthetic, path)]
+        print(f"\n{n_sites:,} sites (SQLite build {time.perf_counter() - start:.1f}s)")
+        print(f"{'query':<32}{'pandas (ms)':>12}{'sqlite (ms)':>12}  identical")
+        for query, (method, kwargs) in BENCHMARK_QUERIES.items():
+            (pandas_result, pandas_ms), (sqlite_result, sqlite_ms) = [time_query(backend, method, kwargs, repeats)
+                                                                      for backend in backends]
+            identical = pandas_result.reset_index(drop=True).equals(sqlite_result.reset_index(drop=True))
+            print(f"{query:<32}{pandas_ms:>12.1f}{sqlite_ms:>12.1f}  {identical}")
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pandas and SQLite query backends")
+    parser.add_argument("--sizes", default="14187,1000000,10000000",
+                        help="Comma separated numbers of synthetic sites")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--work-dir", default=tempfile.gettempdir(), help="Where the SQLite files are built")
+    args = parser.parse_args()
+
+    benchmark([int(size) for size in args.sizes.split(",")], args.repeats, args.work_dir)
@@ -0,0 +1,168 @@
+# Release-to-release changes for the National Water Plan sites.
+# diff_releases() joins two processed snapshots on ID through a sorted index and compares every column they share,
+# a whole column at a time - there is no loop over sites. It returns:
+#   sites   - one row per site added, removed or changed: ID, Water company, Status, how many columns changed and,
+#             per CHANGE_GROUPS group, whether any of its columns changed
+#   changes - the compact change table, one row per changed value: ID, Column, Old, New and Delta (numeric columns)
+# Run this file to diff two processed snapshots (CSV or parquet), or to time it on synthetic snapshots.
+
+import argparse
+import os
+import time
+
+import pandas as pd
+import numpy as np
+
+KEY_COLUMN = "ID"
+GROUP_COLUMN = "Water company"
+STATUSES = ["Added", "Removed", "Changed"]
+
+# What the changed columns describe - a site changed in a column not listed here counts as "Other"
+CHANGE_GROUPS = {"Targets": ["Sewage Reduction Plan Targets Met Flag", "Spill Improvement Date Planned",
+                             "Rainfall Improvement Target Delivery Flag",
+                             "Predicted Annual Spill Frequency Post Scheme", "Baseline",
+                             "Baseline Less than Target Flag", "Meets 2025 Requirements", "Meets 2030 Requirements",
+                             "Meets 2035 Requirements", "Meets 2040 Requirements", "Meets 2045 Requirements",
+                             "Meets 2050 Requirements"],
+                 "Projections": ["2025 Projected Spills", "2030 Projected Spills", "2035 Projected Spills",
+                                 "2040 Projected Spills", "2045 Projected Spills", "2050 Projected Spills"],
+                 "Improvements": ["Storage", "Mew screen", "Other improvements to be confirmed", "Nature-Based",
+                                  "Increased pass forward flow", "Bespoke solution", "Sealing of sewers",
+                                  "Operational", "Smart sewers", "Spill treatment", "Improvement Count Needed"]}
+OTHER_GROUP = "Other"
+
+
+def is_numeric(values):
+    return values.dtype.kind in "iufb"
+
+
+# Match the sites of two releases by key: the row positions of the matched sites in each, and masks of the sites
+# only in the old release (removed) and only in the new one (added). Keys are unique within a release.
+def join_on_key(old_keys, new_keys):
+    old_keys, new_keys = np.asarray(old_keys).astype(str), np.asarray(new_keys).astype(str)
+    old_order = np.argsort(old_keys, kind="stable")
+    sorted_old_keys = old_keys[old_order]
+    positions = np.minimum(np.searchsorted(sorted_old_keys, new_keys), max(len(old_keys) - 1, 0))
+    matched = (sorted_old_keys[positions] == new_keys) if len(old_keys) else np.zeros(len(new_keys), dtype=bool)
+    new_rows = np.flatnonzero(matched)
+    old_rows = old_order[positions[matched]]
+    removed = np.ones(len(old_keys), dtype=bool)
+    removed[old_rows] = False
+    return old_rows, new_rows, removed, ~matched
+
+
+# A column's values at the row positions - numeric columns as NumPy arrays, others (e.g. the Arrow backed
+# strings) stay in their own array type, so comparing them needs no conversion to Python objects
+def column_values(frame, column, rows):
+    if is_numeric(frame[column]):
+        return frame[column].to_numpy()[rows]
+    return frame[column].array.take(rows)
+
+
+# Whether each pair of values differs - missing in both counts as the same
+def values_differ(old_values, new_values):
+    if is_numeric(old_values) and is_numeric(new_values):
+        old_values, new_values = old_values.astype(float), new_values.astype(float)
+        return ~((old_values == new_values) | (np.isnan(old_values) & np.isnan(new_values)))
+    if is_numeric(old_values) != is_numeric(new_values):  # A column whose type changed between releases
+        old_values, new_values = np.asarray(old_values, dtype=object), np.asarray(new_values, dtype=object)
+    old_missing, new_missing = pd.isna(old_values), pd.isna(new_values)
+    differs = np.asarray(pd.array(old_values != new_values, dtype="boolean").fillna(False), dtype=bool)
+    return np.where(old_missing | new_missing, old_missing != new_missing, differs)
+
+
+def diff_releases(old, new, key=KEY_COLUMN, group=GROUP_COLUMN):
+    old_rows, new_rows, removed, added = join_on_key(old[key].to_numpy(), new[key].to_numpy())
+    columns = [column for column in new.columns if column in old.columns and column != key]
+    column_groups = {column: name for name, group_columns in CHANGE_GROUPS.items() for column in group_columns}
+
+    matched_keys = new[key].to_numpy()[new_rows]
+    n_changed = np.zeros(len(new_rows), dtype=np.int64)
+    group_changed = {name: np.zeros(len(new_rows), dtype=bool) for name in list(CHANGE_GROUPS) + [OTHER_GROUP]}
+    changes = []
+    for column in columns:
+        old_values, new_values = column_values(old, column, old_rows), column_values(new, column, new_rows)
+        differs = values_differ(old_values, new_values)
+        if not differs.any():
+            continue
+        n_changed += differs
+        group_changed[column_groups.get(column, OTHER_GROUP)] |= differs
+        changed = np.flatnonzero(differs)
+        numeric = is_numeric(old_values) and is_numeric(new_values)
+        changes.append(pd.DataFrame({key: matched_keys[changed],
+                                     "Column": column,
+                                     "Old": np.asarray(old_values[changed], dtype=object),
+                                     "New": np.asarray(new_values[changed], dtype=object),
+                                     "Delta": (new_values[changed].astype(float) - old_values[changed].astype(float)
+                                               if numeric else np.nan)}))
+
+    changed = np.flatnonzero(n_changed > 0)
+    no_groups = {name: False for name in group_changed}
+    sites = pd.concat([
+        new.loc[added, [key, group]].assign(Status="Added", **{"Changed Columns": 0}, **no_groups),
+        old.loc[removed, [key, group]].assign(Status="Removed", **{"Changed Columns": 0}, **no_groups),
+        new.iloc[new_rows[changed]][[key, group]].assign(Status="Changed",
+                                                         **{"Changed Columns": n_changed[changed]},
+                                                         **{name: flags[changed]
+                                                            for name, flags in group_changed.items()})])
+    sites = sites.sort_values(by=key, kind="stable").reset_index(drop=True)
+
+    if changes:
+        changes = pd.concat(changes, ignore_index=True).sort_values(by=[key], kind="stable").reset_index(drop=True)
+    else:
+        changes = pd.DataFrame({key: [], "Column": [], "Old": [], "New": [], "Delta": []})
+    changes["Column"] = changes["Column"].astype("category")
+    return sites, changes
+
+
+# Per group (e.g. water company): sites added, removed and changed, and changed sites per change group
+def release_summary(sites, group=GROUP_COLUMN):
+    groups = list(CHANGE_GROUPS) + [OTHER_GROUP]
+    statuses = pd.crosstab(sites[group], sites["Status"]).reindex(columns=STATUSES, fill_value=0)
+    return statuses.join(sites.groupby(group)[groups].sum()).reset_index()
+
+
+def read_snapshot(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+
+
+# Two snapshots of n_sites resampled from the real sites, with unique IDs: the new one has a share of the sites
+# removed, added and with changed projections and improvement dates
+def synthetic_releases(sites, n_sites, changed_share=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    old = sites.iloc[rng.integers(0, len(sites), n_sites)].reset_index(drop=True)
+    old[KEY_COLUMN] = [f"S{i:08d}" for i in range(n_sites)]
+    new = old.copy()
+    changed = rng.random(n_sites) < changed_share
+    new.loc[changed, "2030 Projected Spills"] = new.loc[changed, "2030 Projected Spills"] + 1
+    new.loc[changed, "Spill Improvement Date Planned"] = 2030
+    added = new.iloc[:int(n_sites * changed_share / 5)].copy()
+    added[KEY_COLUMN] = [f"N{i:08d}" for i in range(len(added))]
+    new = pd.concat([new.iloc[int(n_sites * changed_share / 5):], added], ignore_index=True)
+    return old, new
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two processed National Water Plan releases")
+    parser.add_argument("old", nargs="?", help="Processed snapshot (CSV or parquet) of the earlier release")
+    parser.add_argument("new", nargs="?", help="Processed snapshot of the later release")
+    parser.add_argument("--output", default="national_water_plan_changes.csv", help="Where the change table goes")
+    parser.add_argument("--benchmark", metavar="N_SITES", type=int,
+                        help="Instead, time a diff of two synthetic releases of this many sites")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        real_sites = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "national_water_plan.csv"))
+        old_release, new_release = synthetic_releases(real_sites, args.benchmark)
+    elif args.old and args.new:
+        old_release, new_release = read_snapshot(args.old), read_snapshot(args.new)
+    else:
+        parser.error("give the old and new snapshots, or --benchmark")
+
+    start = time.perf_counter()
+    changed_sites, change_table = diff_releases(old_release, new_release)
+    print(f"{len(old_release):,} -> {len(new_release):,} sites, diffed in {time.perf_counter() - start:.2f}s")
+    print(release_summary(changed_sites).to_string(index=False))
+    if not args.benchmark:
+        change_table.to_csv(args.output, index=False)
+        print(f"{len(change_table):,} changed values written to {args.output}")
@@ -0,0 +1,147 @@
+# What-if scenarios for the National Water Plan projected spills.
+# A scenario sets, for any of the improvement types, a reduction (the share of a site's projected spills the
+# improvement removes once delivered) and/or a year it is delivered by. ScenarioEngine applies a scenario to every
+# site at once as array operations over the sites x projection years matrix, then totals the trajectories by
+# geography member. projected_bands() puts Monte Carlo uncertainty bands around the projected spills.
+# Run this file to time both on the full dataset.
+
+import argparse
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+import numpy as np
+
+PROJECTED_SPILL_COLUMNS = ["2025 Projected Spills", "2030 Projected Spills", "2035 Projected Spills",
+                           "2040 Projected Spills", "2045 Projected Spills", "2050 Projected Spills"]
+DELIVERY_DATE_COLUMN = "Spill Improvement Date Planned"
+SPILL_EVENT_COLUMNS = ["Spill Events 2020", "Spill Events 2021", "Spill Events 2022"]
+BAND_PERCENTILES = [5, 25, 50, 75, 95]
+BATCH_DRAWS = 250  # Draws per batch - each batch is one task for the pool
+
+
+# A scenario for each improvement type given: {improvement: (reduction, delivered_by)}. reduction is a fraction
+# from 0 to 1, delivered_by a year or None to keep the planned dates.
+def scenario(improvements, reduction=0.0, delivered_by=None):
+    return {improvement: (reduction, delivered_by) for improvement in improvements}
+
+
+# The arrays a scenario is applied to, built once from the frame:
+#   projected   - sites x projection years, the planned trajectories
+#   planned     - each site's planned improvement delivery year
+#   post_scheme - each site's projected spills in the first projection year after its planned delivery, what it
+#                 drops to when delivered earlier
+#   has         - sites x improvement types, whether the site needs the improvement
+#   codes       - per geography column, each site's member number (factorized), and the members in that order
+class ScenarioEngine:
+    def __init__(self, frame, improvement_columns, geography_columns, projected_columns=PROJECTED_SPILL_COLUMNS):
+        self.improvements = list(improvement_columns)
+        self.years = np.array([int(column[:4]) for column in projected_columns])
+        self.projected = np.nan_to_num(frame[projected_columns].to_numpy(dtype=float))
+        self.planned = frame[DELIVERY_DATE_COLUMN].to_numpy(dtype=float)
+        first_delivered = np.minimum(np.searchsorted(self.years, self.planned), len(self.years) - 1)
+        self.post_scheme = self.projected[np.arange(len(frame)), first_delivered]
+        self.has = frame[self.improvements].fillna(0).to_numpy() != 0
+        self.codes = {column: pd.factorize(frame[column], sort=True) for column in geography_columns}
+
+    # Sites x projection years under the scenario
+    def trajectories(self, scenario):
+        reductions = np.array([scenario.get(improvement, (0.0, None))[0] or 0.0 for improvement in self.improvements])
+        delivered_by = np.array([scenario.get(improvement, (0.0, None))[1] or np.inf
+                                 for improvement in self.improvements], dtype=float)
+
+        # A site is delivered by the earliest year of any of its improvements brought forward, if before its plan
+        delivery = np.minimum(self.planned, np.where(self.has, delivered_by, np.inf).min(axis=1))
+        delivered = self.years >= delivery[:, None]
+        brought_forward = delivered & (self.years < self.planned[:, None])
+        projected = np.where(brought_forward, self.post_scheme[:, None], self.projected)
+
+        # Once delivered, each improvement the site needs removes its share of what is left
+        remaining = np.where(self.has, 1 - np.clip(reductions, 0, 1), 1).prod(axis=1)
+        return np.where(delivered, projected * remaining[:, None], projected)
+
+    # Projected spills per member of the geography column under the scenario (the planned ones with no scenario):
+    # members x projection years, indexed by member
+    def totals(self, geography, scenario=None):
+        trajectories = self.projected if not scenario else self.trajectories(scenario)
+        codes, members = self.codes[geography]
+        present = codes >= 0  # Sites with no member are left out, as in a groupby
+        totals = np.column_stack([np.bincount(codes[present], weights=trajectories[present, i],
+                                              minlength=len(members))
+                                  for i in range(len(self.years))])
+        return pd.DataFrame(totals, index=members, columns=self.years)
+
+
+# UNCERTAINTY - each site's spills vary from year to year as they did in 2020-2022. A draw scales the site's whole
+# projected trajectory by a gamma distributed factor with mean 1 and the site's coefficient of variation, so a
+# site with steady counts barely moves and an erratic one moves a lot. Each batch of draws is one matrix product
+# (draws x sites factors by sites x years projections) giving every draw's totals. Batches are seeded from
+# (seed, key) alone, so the bands are the same whether they are drawn in this process or across a pool.
+def spill_variability(frame):
+    events = frame[SPILL_EVENT_COLUMNS].to_numpy(dtype=float)
+    mean, std = np.nanmean(events, axis=1), np.nanstd(events, axis=1)
+    return np.divide(std, mean, out=np.zeros_like(mean), where=mean > 0)
+
+
+def sample_batch(projected, variability, n_draws, seed):
+    rng = np.random.default_rng(seed)
+    varies = variability > 0
+    shape = 1 / variability[varies] ** 2
+    factors = np.ones((n_draws, len(projected)))
+    factors[:, varies] = rng.gamma(shape, 1 / shape, size=(n_draws, int(varies.sum())))
+    return factors @ projected
+
+
+# Percentile bands (BAND_PERCENTILES) of the total projected spills of the frame's sites: projection years x
+# percentiles. key identifies the sites (e.g. a geography and member) so each set gets its own draws.
+def projected_bands(frame, draws=2000, seed=0, key=(), pool=None, projected_columns=PROJECTED_SPILL_COLUMNS):
+    projected = np.nan_to_num(frame[projected_columns].to_numpy(dtype=float))
+    variability = spill_variability(frame)
+    sizes = [min(BATCH_DRAWS, draws - start) for start in range(0, draws, BATCH_DRAWS)]
+    seeds = np.random.SeedSequence([seed, zlib.crc32(repr(key).encode())]).spawn(len(sizes))
+    batches = (pool.map if pool is not None else map)(sample_batch, repeat(projected), repeat(variability),
+                                                        sizes, seeds)
+    totals = np.concatenate(list(batches))
+    return pd.DataFrame(np.percentile(totals, BAND_PERCENTILES, axis=0).T,
+                        index=[int(column[:4]) for column in projected_columns],
+                        columns=BAND_PERCENTILES)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the projected spills scenario engine and uncertainty bands")
+    parser.add_argument("--input",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "national_water_plan.csv"))
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--draws", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes to draw the bands with")
+    args = parser.parse_args()
+
+    sites = pd.read_csv(args.input)
+    improvement_columns = ["Storage", "Mew screen", "Other improvements to be confirmed", "Nature-Based",
+                           "Increased pass forward flow", "Bespoke solution", "Sealing of sewers", "Operational",
+                           "Smart sewers", "Spill treatment"]
+    engine = ScenarioEngine(sites, improvement_columns, ["Water company", "River Basin District"])
+    storage_by_2030 = scenario(["Storage"], reduction=0.5, delivered_by=2030)
+    for geography in engine.codes:
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            totals = engine.totals(geography, storage_by_2030)
+            times.append(time.perf_counter() - start)
+        change = totals.sum() - engine.totals(geography).sum()
+        print(f"{geography}: {len(totals)} members, best {min(times) * 1000:.1f} ms, "
+              f"national change {', '.join(f'{year} {value:+.0f}' for year, value in change.items())}")
+
+    by_company = dict(list(sites.groupby("Water company")))
+    for workers in sorted({1, args.workers}):
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        start = time.perf_counter()
+        bands = {company: projected_bands(company_sites, args.draws, key=("Water company", company), pool=pool)
+                 for company, company_sites in by_company.items()}
+        print(f"Bands for {len(bands)} companies, {args.draws} draws, {workers} process(es): "
+              f"{time.perf_counter() - start:.2f} s")
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,101 @@
+# Map tiles for the National Water Plan sites, in the Web Mercator z/x/y (slippy map) scheme.
+# The sites are sorted on the Morton (Z-order) code of their tile at MAX_ZOOM, which makes every tile at every zoom
+# level one contiguous run of the sorted sites - found with two binary searches, however many sites there are.
+# Below POINT_ZOOM a tile holds aggregates instead of sites: the sites in each of its cells (the tiles CELL_LEVELS
+# zoom levels deeper) counted and summed at their mean position.
+
+import numpy as np
+
+MAX_ZOOM = 24
+POINT_ZOOM = 10
+CELL_LEVELS = 3  # 8 x 8 cells per aggregated tile
+MAX_LATITUDE = 85.0511287798  # Web Mercator's limit
+
+
+# Position in the Web Mercator square, 0 to 1 from the west and from the north
+def mercator(latitudes, longitudes):
+    latitudes = np.radians(np.clip(np.asarray(latitudes, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitudes, dtype=float) + 180) / 360
+    y = (1 - np.log(np.tan(latitudes) + 1 / np.cos(latitudes)) / np.pi) / 2
+    return x, y
+
+
+def tile_coordinates(latitudes, longitudes, z):
+    n_tiles = 1 << z
+    x, y = mercator(latitudes, longitudes)
+    return (np.clip(np.floor(x * n_tiles), 0, n_tiles - 1).astype(np.uint64),
+            np.clip(np.floor(y * n_tiles), 0, n_tiles - 1).astype(np.uint64))
+
+
+# Spread the bits of x and y out and interleave them - y's bits above x's
+def morton_code(x, y):
+    def spread(values):
+        values = np.asarray(values, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+            values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+        return values
+    return spread(x) | (spread(y) << np.uint64(1))
+
+
+# Tiles of the sites with coordinates, carrying a value per site for each of `values` (name -> per-site values).
+# Row positions are those of the arrays given.
+class TileSet:
+    def __init__(self, latitudes, longitudes, values):
+        latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+        located = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        codes = morton_code(*tile_coordinates(latitudes[located], longitudes[located], MAX_ZOOM))
+        order = np.argsort(codes, kind="stable")
+        self.n_rows = len(latitudes)
+        self.rows = located[order]
+        self.codes = codes[order]
+        self.latitudes, self.longitudes = latitudes[self.rows], longitudes[self.rows]
+        self.values = {name: np.nan_to_num(np.asarray(column, dtype=float))[self.rows]
+                       for name, column in values.items()}
+
+    # The run of sorted sites in tile z/x/y
+    def span(self, z, x, y):
+        shift = np.uint64(2 * (MAX_ZOOM - z))
+        first = morton_code(x, y) << shift
+        return np.searchsorted(self.codes, [first, first + (np.uint64(1) << shift)])
+
+    # Tile contents as columns: at POINT_ZOOM and beyond, the sites ("row" - their row positions); below it, the
+    # cells holding sites ("count" - how many), with the values summed
+    def tile(self, z, x, y):
+        start, end = self.span(z, x, y)
+        if z >= POINT_ZOOM:
+            return dict({"row": self.rows[start:end],
+                         "lat": self.latitudes[start:end],
+                         "lon": self.longitudes[start:end]},
+                        **{name: values[start:end] for name, values in self.values.items()})
+        if start == end:
+            return dict({"count": [], "lat": [], "lon": []}, **{name: [] for name in self.values})
+        cells = self.codes[start:end] >> np.uint64(2 * (MAX_ZOOM - z - CELL_LEVELS))
+        firsts = np.flatnonzero(np.concatenate([[True], cells[1:] != cells[:-1]]))
+        counts = np.diff(np.append(firsts, end - start))
+        return dict({"count": counts,
+                     "lat": np.add.reduceat(self.latitudes[start:end], firsts) / counts,
+                     "lon": np.add.reduceat(self.longitudes[start:end], firsts) / counts},
+                    **{name: np.add.reduceat(values[start:end], firsts) for name, values in self.values.items()})
+
+    # Tiles at zoom z covering a bounding box (degrees), as x and y ranges
+    @staticmethod
+    def tiles_covering(z, west, south, east, north):
+        x_range, y_range = tile_coordinates([north, south], [west, east], z)
+        return range(int(x_range[0]), int(x_range[1]) + 1), range(int(y_range[0]), int(y_range[1]) + 1)
+
+    # Mask over row positions of the sites in a bounding box - looked up through the few tiles covering it, at the
+    # deepest zoom where a tile is still as wide and as tall as the box
+    def mask_within(self, west, south, east, north):
+        x, y = mercator([north, south], [west, east])
+        span = max(x[1] - x[0], y[1] - y[0], 1e-12)
+        z = int(np.clip(np.floor(np.log2(1 / span)), 0, MAX_ZOOM))
+        x_range, y_range = self.tiles_covering(z, west, south, east, north)
+        spans = [self.span(z, x, y) for x in x_range for y in y_range]
+        candidates = np.concatenate([np.arange(start, end) for start, end in spans]) if spans else []
+        candidates = np.asarray(candidates, dtype=np.int64)
+        inside = ((self.latitudes[candidates] >= south) & (self.latitudes[candidates] <= north) &
+                  (self.longitudes[candidates] >= west) & (self.longitudes[candidates] <= east))
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.rows[candidates[inside]]] = True
+        return mask
@@ -0,0 +1,30 @@
+# Shared fixtures for the National Water Plan tests. The dashboard module reads the processed CSV from GitHub at
+# import time - here it reads the copy in the repository instead.
+
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_CSV = os.path.join(REPO_DIR, "national_water_plan.csv")
+
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope="session")
+def dashboard():
+    read_csv = pd.read_csv
+
+    def read_local_csv(path, *args, **kwargs):
+        if str(path).startswith("https://raw.githubusercontent.com/"):
+            path = LOCAL_CSV
+        return read_csv(path, *args, **kwargs)
+
+    pd.read_csv = read_local_csv
+    try:
+        import national_water_plan_dash_deploy
+    finally:
+        pd.read_csv = read_csv
+    return national_water_plan_dash_deploy
@@ -0,0 +1,162 @@
+import copy
+import json
+
+import plotly.graph_objects as go
+import pytest
+from plotly.io.json import to_json_plotly
+
+from national_water_plan_processing import write_partitioned
+
+
+# The callback as registered - through every layer of CALLBACK_LAYERS
+def registered(dashboard, name):
+    return dashboard.registered_callbacks[name][0]
+
+
+# No member chosen yet (the first Futures load) selects no sites - an empty map, not an error
+@pytest.mark.parametrize("year", [2021, "All"])
+def test_futures_map_without_member(dashboard, year):
+    fig = registered(dashboard, "futures_map")("Water company", None, year, None)
+    assert isinstance(fig, go.Figure)
+    assert sum(len(trace.lat) for trace in fig.data if trace.lat is not None) == 0
+
+
+@pytest.mark.parametrize("year", [2021, "All"])
+def test_futures_map_colour_range_spans_member(dashboard, year):
+    fig = registered(dashboard, "futures_map")("Water company", "Yorkshire Water", year, None)
+    counts = dashboard.df.loc[dashboard.df["Water company"] == "Yorkshire Water", "Improvement Count Needed"]
+    assert (fig.layout.coloraxis.cmin, fig.layout.coloraxis.cmax) == (counts.min(), counts.max())
+
+
+# The client's figure after a Patch - its Assign and Delete operations, as dash-renderer applies them
+def apply_patch(figure, patch):
+    figure = copy.deepcopy(figure)
+    for operation in patch.to_plotly_json()["operations"]:
+        *parents, key = operation["location"]
+        target = figure
+        for parent in parents:
+            target = target.setdefault(parent, {}) if isinstance(target, dict) else target[parent]
+        if operation["operation"] == "Assign":
+            target[key] = operation["params"]["value"]
+        elif operation["operation"] == "Delete":
+            if isinstance(target, dict):
+                target.pop(key, None)
+        else:
+            raise AssertionError(f"unexpected patch operation {operation['operation']}")
+    return figure
+
+
+def figure_json(fig):
+    return json.loads(to_json_plotly(fig))
+
+
+def test_marker_patch_removes_what_the_new_figure_lacks(dashboard):
+    old = go.Figure(go.Scattergeo(lat=[51.5, 53.8], lon=[-0.1, -1.5], customdata=[[1], [2]],
+                                  hovertemplate="%{customdata[0]}", marker=dict(size=[3, 4])),
+                    layout=dict(title="2020", barmode="group", template="seaborn"))
+    new = go.Figure(go.Scattergeo(lat=[51.5, 53.8], lon=[-0.1, -1.5], hovertemplate="%{lat}",
+                                  marker=dict(size=[5, 6])),
+                    layout=dict(title="2021", template="seaborn"))
+    patch, _ = dashboard.figure_patch(new, "markers")
+    assert apply_patch(figure_json(old), patch) == figure_json(new)
+
+
+def test_data_patch_matches_full_figure(dashboard):
+    old = go.Figure(go.Bar(x=["a", "b"], y=[1, 2]), layout=dict(title="2020", barmode="group", xaxis=dict(title="x")))
+    new = go.Figure(go.Bar(x=["a"], y=[3]), layout=dict(title="2021"))
+    patch, _ = dashboard.figure_patch(new, "data")
+    assert apply_patch(figure_json(old), patch) == figure_json(new)
+
+
+def test_figure_with_other_layout_keys_is_sent_in_full(dashboard):
+    fig = go.Figure(go.Bar(x=["a"], y=[1]), layout=dict(hovermode="x"))
+    assert dashboard.figure_patch(fig, "data")[0] is fig
+
+
+# A year change on the maps - the patched figure is the one a full update would have sent
+@pytest.mark.parametrize("name, first, second", [
+    ("company_map", (2020, "Thames Water", None), (2022, "Thames Water", None)),
+    ("river_basin_map", ("Thames", 2020, None), ("Thames", "All", None)),
+    ("futures_map", ("Water company", "Thames Water", 2020, None), ("Water company", "Thames Water", 2022, None)),
+])
+def test_map_year_patch_matches_full_figure(dashboard, name, first, second):
+    build = registered(dashboard, name)  # Outside a Dash request the full figure is returned
+    old, new = figure_json(build(*first)), build(*second)
+    patch, _ = dashboard.figure_patch(new, "markers")
+    assert apply_patch(old, patch) == figure_json(new)
+
+
+# A map selection of the given sites, as the browser sends it
+def selected_data(sites):
+    return {"points": [{"lat": lat, "lon": lon} for lat, lon in zip(sites["Latitude"], sites["Longitude"])]}
+
+
+def figure_values(fig, axis="y"):
+    return [value for trace in fig.data for value in (trace[axis] if trace[axis] is not None else [])]
+
+
+# A selection with none of the sites a chart's own filters match shows zeros, not the unselected totals
+def test_improvements_for_a_selection_outside_the_environment(dashboard):
+    df = dashboard.df
+    coastal = df[(df["Receiving Environment"] == "Coastal") & df["Latitude"].notna()].head(20)
+    fig = registered(dashboard, "improvements_bar_count")("Inland", selected_data(coastal))
+    assert figure_values(fig) == [0] * len(dashboard.IMPROVEMENT_COLUMNS)
+
+
+@pytest.mark.parametrize("match", ["All", "Any"])
+def test_flag_totals_for_a_selection_without_flagged_sites(dashboard, match):
+    df = dashboard.df
+    sites = df[(df["Water company"] == "Thames Water") & (df["Bathing Water Discharge Flag"] == "No") &
+               df["Latitude"].notna()].head(20)
+    fig = registered(dashboard, "hp_spills_flag_bar")(["Bathing Water Discharge Flag"], match, selected_data(sites))
+    assert figure_values(fig) == [0, 0, 0]
+
+
+# A release rewritten in the store is diffed again, not served from the cached diff
+def test_release_changes_follow_store_rewrites(dashboard, tmp_path, monkeypatch):
+    sites = dashboard.df.head(50)
+    write_partitioned(sites, tmp_path, "2020-2022")
+    write_partitioned(sites, tmp_path, "2025")
+    monkeypatch.setattr(dashboard, "DATASET_DIR", str(tmp_path))
+    assert dashboard.release_changes("2020-2022", "2025")[1].empty
+
+    fingerprint = dashboard.store_fingerprint(["2020-2022"])
+    write_partitioned(sites.assign(**{"2030 Projected Spills": sites["2030 Projected Spills"] + 1}), tmp_path, "2025")
+    assert dashboard.store_fingerprint(["2020-2022"]) == fingerprint
+    changes = dashboard.release_changes("2020-2022", "2025")[1]
+    assert changes["Column"].unique().tolist() == ["2030 Projected Spills"]
+    assert len(changes) == sites["2030 Projected Spills"].notna().sum()
+
+
+# A bundle is only served for the store it was built from - the Release Changes page reads every release
+def test_prerendered_bundle_rejected_after_store_rewrite(dashboard, tmp_path, monkeypatch):
+    store, bundle = tmp_path / "store", tmp_path / "bundle"
+    sites = dashboard.df.head(50)
+    write_partitioned(sites, store, "2020-2022")
+    write_partitioned(sites, store, "2025")
+    monkeypatch.setattr(dashboard, "DATASET_DIR", str(store))
+    monkeypatch.setattr(dashboard, "PRERENDERED_DIR", str(bundle))
+    dashboard.build_prerendered_bundle(str(bundle), names=["render_page_content"])
+    assert dashboard.load_prerendered_manifest()["store_fingerprint"] == dashboard.store_fingerprint()
+
+    write_partitioned(sites.head(40), store, "2025")
+    assert dashboard.load_prerendered_manifest() is None
+
+
+# The report is measured at load time - it never reads the dataset again
+def test_column_report(dashboard, monkeypatch):
+    monkeypatch.setattr(dashboard.pd, "read_csv", None)
+    report = dashboard.server.test_client().get("/stats/columns").get_json()
+    assert report["loaded_columns"] == len(dashboard.df.columns)
+    assert "Marine Protected Area Discharge Flag" in report["skipped_columns"]
+    assert "Marine Protected Area Discharge Flag" not in dashboard.df.columns
+    assert report["skipped_bytes"] > 0
+
+
+# gzip only when the client accepts it - "gzip;q=0" refuses it
+@pytest.mark.parametrize("accept_encoding, encoding", [("gzip, deflate", "gzip"), ("gzip;q=0, deflate", None),
+                                                       ("identity", None), ("*", "gzip")])
+def test_layout_compression_follows_accept_encoding(dashboard, accept_encoding, encoding):
+    response = dashboard.server.test_client().get("/_dash-layout", headers={"Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == encoding
@@ -0,0 +1,88 @@
+import filecmp
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import LOCAL_CSV
+from national_water_plan_processing import process, run_pipeline, write_outputs
+
+IMPROVEMENTS = ["Storage", "Mew screen", "Other improvements to be confirmed", "Nature-Based",
+                "Increased pass forward flow", "Bespoke solution", "Sealing of sewers", "Operational", "Smart sewers",
+                "Spill treatment"]
+RAW_FLAGS = ["Bathing Water Discharge Flag", "Shellfish Water Discharge Flag", "Ecological High Priority Site Flag",
+             "Non-bathing Priority Site Flag", "Rainfall Improvement Target Delivery Flag"]
+
+
+# A raw input in the layout the processing script reads, rebuilt from a sample of the processed sites: improvements
+# as a list, Y/N flags, the original misspelt column, and some missing values and "TBC" site names to clean
+@pytest.fixture(scope="module")
+def raw_path(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    sites = pd.read_csv(LOCAL_CSV).sample(n=400, random_state=0)
+    raw = sites.drop(columns=IMPROVEMENTS + ["Baseline Less than Target Flag", "Average Spill Count",
+                                             "All Spill Events", "Improvement Count Needed", "All"])
+    raw["Improvements List"] = [", ".join(improvement for improvement in IMPROVEMENTS if site[improvement]) or np.nan
+                                for _, site in sites[IMPROVEMENTS].iterrows()]
+    raw = raw.rename(columns={"Predicted Annual Spill Frequency Post Scheme":
+                              "Predicted Annual Spill Frequence Post Scheme"})
+    raw["Baseline Less Than Target"] = "Y"
+    raw["Requires No Improvement"] = "N"
+    for flag in RAW_FLAGS:
+        raw[flag] = raw[flag].map({"Yes": "Y", "No": "N"})
+        raw.loc[rng.random(len(raw)) < 0.1, flag] = np.nan
+    for column in ["2025 Projected Spills", "Predicted Annual Spill Frequence Post Scheme", "Spill Events 2021",
+                   "Baseline"]:
+        raw.loc[rng.random(len(raw)) < 0.05, column] = np.nan
+    raw.loc[rng.random(len(raw)) < 0.02, "Site name"] = "TBC"
+    path = tmp_path_factory.mktemp("raw") / "raw.csv"
+    raw.to_csv(path, index=False)
+    return path
+
+
+# What --no-cache writes
+@pytest.fixture(scope="module")
+def uncached_output(raw_path, tmp_path_factory):
+    path = tmp_path_factory.mktemp("uncached") / "processed.csv"
+    write_outputs(process(pd.read_csv(raw_path)), path)
+    return path
+
+
+def statuses(report):
+    return {stage["stage"]: stage["status"] for stage in report}
+
+
+def test_cached_runs_match_uncached(raw_path, uncached_output, tmp_path):
+    output, cache_dir = tmp_path / "processed.csv", tmp_path / "cache"
+    cold = run_pipeline(raw_path, output, cache_dir)
+    assert set(statuses(cold).values()) == {"recomputed"}
+    assert filecmp.cmp(output, uncached_output, shallow=False)
+
+    warm = statuses(run_pipeline(raw_path, output, cache_dir))
+    assert warm.pop("write") == "hit" and set(warm.values()) == {"skipped"}
+    assert filecmp.cmp(output, uncached_output, shallow=False)
+
+    # A lost output is written again from the last cached stage
+    output.unlink()
+    rewritten = statuses(run_pipeline(raw_path, output, cache_dir))
+    assert rewritten["write"] == "recomputed" and "hit" in rewritten.values()
+    assert filecmp.cmp(output, uncached_output, shallow=False)
+
+
+def test_workers_match_uncached(raw_path, uncached_output, tmp_path):
+    output = tmp_path / "processed.csv"
+    run_pipeline(raw_path, output, tmp_path / "cache", workers=2)
+    assert filecmp.cmp(output, uncached_output, shallow=False)
+    pd.testing.assert_frame_equal(process(pd.read_csv(raw_path), workers=2), process(pd.read_csv(raw_path)))
+
+
+def test_changed_input_is_reprocessed(raw_path, uncached_output, tmp_path):
+    output, cache_dir = tmp_path / "processed.csv", tmp_path / "cache"
+    run_pipeline(raw_path, output, cache_dir)
+    changed_path = tmp_path / "raw.csv"
+    raw = pd.read_csv(raw_path)
+    raw.loc[0, "Spill Events 2020"] = raw.loc[0, "Spill Events 2020"] + 1
+    raw.to_csv(changed_path, index=False)
+
+    assert set(statuses(run_pipeline(changed_path, output, cache_dir)).values()) == {"recomputed"}
+    assert not filecmp.cmp(output, uncached_output, shallow=False)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from national_water_plan_releases import diff_releases, join_on_key, release_summary
+
+
+# S1 is removed, S4 added; S2's projection, storage and receiving environment change; S3 only has a missing value
+# in both releases
+@pytest.fixture
+def releases():
+    old = pd.DataFrame({"ID": ["S1", "S2", "S3"],
+                        "Water company": ["X", "X", "Y"],
+                        "Receiving Environment": ["Inland", "Inland", "Coastal"],
+                        "2030 Projected Spills": [4.0, 5.0, np.nan],
+                        "Storage": [0, 0, 1]})
+    new = pd.DataFrame({"ID": ["S4", "S3", "S2"],
+                        "Water company": ["Y", "Y", "X"],
+                        "Receiving Environment": ["Inland", "Coastal", "Coastal"],
+                        "2030 Projected Spills": [1.0, np.nan, 6.5],
+                        "Storage": [1, 1, 1]})
+    return old, new
+
+
+def test_join_on_key():
+    old_rows, new_rows, removed, added = join_on_key(["S1", "S2", "S3"], ["S4", "S3", "S2"])
+    assert old_rows.tolist() == [2, 1]
+    assert new_rows.tolist() == [1, 2]
+    assert removed.tolist() == [True, False, False]
+    assert added.tolist() == [True, False, False]
+
+
+def test_sites(releases):
+    sites, _ = diff_releases(*releases)
+    assert sites[["ID", "Water company", "Status", "Changed Columns"]].values.tolist() == [
+        ["S1", "X", "Removed", 0], ["S2", "X", "Changed", 3], ["S4", "Y", "Added", 0]]
+    changed = sites.set_index("ID").loc["S2"]
+    assert changed["Projections"] and changed["Improvements"] and changed["Other"]
+    assert not changed["Targets"]
+
+
+def test_changes(releases):
+    _, changes = diff_releases(*releases)
+    assert changes["ID"].tolist() == ["S2", "S2", "S2"]
+    by_column = changes.set_index("Column")
+    assert by_column.loc["2030 Projected Spills", ["Old", "New", "Delta"]].tolist() == [5.0, 6.5, 1.5]
+    assert by_column.loc["Storage", ["Old", "New", "Delta"]].tolist() == [0, 1, 1]
+    assert by_column.loc["Receiving Environment", ["Old", "New"]].tolist() == ["Inland", "Coastal"]
+    assert np.isnan(by_column.loc["Receiving Environment", "Delta"])
+
+
+def test_identical_releases(releases):
+    old = releases[0]
+    sites, changes = diff_releases(old, old.iloc[::-1].reset_index(drop=True))
+    assert sites.empty and changes.empty
+
+
+def test_release_summary(releases):
+    summary = release_summary(diff_releases(*releases)[0]).set_index("Water company")
+    assert summary.loc["X", ["Added", "Removed", "Changed", "Projections"]].tolist() == [0, 1, 1, 1]
+    assert summary.loc["Y", ["Added", "Removed", "Changed", "Projections"]].tolist() == [1, 0, 0, 0]
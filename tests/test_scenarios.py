@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from national_water_plan_scenarios import (BAND_PERCENTILES, SPILL_EVENT_COLUMNS, ScenarioEngine, projected_bands,
+                                           scenario)
+
+PROJECTED_COLUMNS = ["2025 Projected Spills", "2030 Projected Spills", "2035 Projected Spills"]
+
+
+# Site A needs storage, planned for 2035; B needs storage and a screen, planned for 2030; C needs nothing
+@pytest.fixture
+def sites():
+    return pd.DataFrame({"ID": ["A", "B", "C"],
+                         "Water company": ["X", "X", "Y"],
+                         "2025 Projected Spills": [10.0, 4.0, 5.0],
+                         "2030 Projected Spills": [8.0, 4.0, 5.0],
+                         "2035 Projected Spills": [6.0, 2.0, 5.0],
+                         "Spill Improvement Date Planned": [2035, 2030, 2040],
+                         "Storage": [1, 1, 0],
+                         "Mew screen": [0, 1, 0],
+                         "Spill Events 2020": [3, 3, 3],
+                         "Spill Events 2021": [3, 3, 3],
+                         "Spill Events 2022": [3, 3, 3]})
+
+
+@pytest.fixture
+def engine(sites):
+    return ScenarioEngine(sites, ["Storage", "Mew screen"], ["Water company"], PROJECTED_COLUMNS)
+
+
+def test_scenario():
+    assert scenario(["Storage", "Mew screen"], 0.5, 2025) == {"Storage": (0.5, 2025), "Mew screen": (0.5, 2025)}
+
+
+def test_planned_totals(engine):
+    totals = engine.totals("Water company")
+    assert totals.index.tolist() == ["X", "Y"]
+    assert totals.columns.tolist() == [2025, 2030, 2035]
+    np.testing.assert_allclose(totals.to_numpy(), [[14, 12, 8], [5, 5, 5]])
+
+
+# Storage delivered by 2025, halving spills: A drops to its post-scheme 6 from 2025 and then halves; B is brought
+# forward from 2030 to 2025 (its 2025 spills were already its post-scheme level) and halves; C is untouched
+def test_storage_brought_forward(engine):
+    trajectories = engine.trajectories(scenario(["Storage"], 0.5, 2025))
+    np.testing.assert_allclose(trajectories, [[3, 3, 3], [2, 2, 1], [5, 5, 5]])
+    totals = engine.totals("Water company", scenario(["Storage"], 0.5, 2025))
+    np.testing.assert_allclose(totals.to_numpy(), [[5, 5, 4], [5, 5, 5]])
+
+
+# A screen halving spills on its planned date: only B needs one, and it is delivered in 2030
+def test_reduction_on_planned_dates(engine):
+    trajectories = engine.trajectories(scenario(["Mew screen"], 0.5))
+    np.testing.assert_allclose(trajectories, [[10, 8, 6], [4, 2, 1], [5, 5, 5]])
+
+
+# Each improvement a site needs removes its share of what is left
+def test_reductions_compound(engine):
+    what_if = dict(scenario(["Storage"], 0.5), **scenario(["Mew screen"], 0.5))
+    np.testing.assert_allclose(engine.trajectories(what_if)[1], [4, 1, 0.5])
+
+
+# Sites whose spills never varied have no uncertainty - every percentile is the planned total
+def test_bands_without_variability(sites):
+    bands = projected_bands(sites, draws=300, projected_columns=PROJECTED_COLUMNS)
+    assert bands.index.tolist() == [2025, 2030, 2035]
+    assert bands.columns.tolist() == BAND_PERCENTILES
+    for percentile in BAND_PERCENTILES:
+        np.testing.assert_allclose(bands[percentile].to_numpy(), [19, 17, 13])
+
+
+def test_bands_are_reproducible(sites):
+    sites = sites.assign(**{SPILL_EVENT_COLUMNS[0]: [1, 6, 0], SPILL_EVENT_COLUMNS[2]: [9, 2, 5]})
+    first = projected_bands(sites, draws=600, seed=1, key=("Water company", "X"), projected_columns=PROJECTED_COLUMNS)
+    again = projected_bands(sites, draws=600, seed=1, key=("Water company", "X"), projected_columns=PROJECTED_COLUMNS)
+    other = projected_bands(sites, draws=600, seed=1, key=("Water company", "Y"), projected_columns=PROJECTED_COLUMNS)
+    pd.testing.assert_frame_equal(first, again)
+    assert not first.equals(other)
+    assert (first[5] <= first[50]).all() and (first[50] <= first[95]).all()
+
+
+# Batches are seeded by the sites' key alone, so a pool draws the same bands
+def test_bands_same_across_a_pool(sites):
+    sites = sites.assign(**{SPILL_EVENT_COLUMNS[0]: [1, 6, 0]})
+    expected = projected_bands(sites, draws=600, key=("Water company", "X"), projected_columns=PROJECTED_COLUMNS)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        pooled = projected_bands(sites, draws=600, key=("Water company", "X"), pool=pool,
+                                 projected_columns=PROJECTED_COLUMNS)
+    pd.testing.assert_frame_equal(expected, pooled)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from national_water_plan_tiles import POINT_ZOOM, TileSet
+
+
+@pytest.fixture(scope="module")
+def tile_set():
+    rng = np.random.default_rng(0)
+    latitudes = rng.uniform(50, 55.5, 5000)
+    longitudes = rng.uniform(-5.5, 1.8, 5000)
+    latitudes[:10] = np.nan  # Sites without coordinates are in no tile
+    return TileSet(latitudes, longitudes, {"spills": rng.integers(0, 100, 5000)}), latitudes, longitudes
+
+
+@pytest.mark.parametrize("box", [(-5.5, 50, 1.8, 55.5),  # Every site
+                                 (-2, 52, -1, 53),
+                                 (-1.2001, 50, -1.2, 55.5),  # Tall and narrow
+                                 (-5.5, 52.5, 1.8, 52.5001),  # Wide and flat
+                                 (10, 60, 11, 61)])  # No sites
+def test_mask_within_matches_a_scan(tile_set, box):
+    tiles, latitudes, longitudes = tile_set
+    west, south, east, north = box
+    expected = (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+    assert np.array_equal(tiles.mask_within(*box), expected)
+
+
+def test_mask_within_tall_box_looks_up_few_tiles(tile_set, monkeypatch):
+    tiles = tile_set[0]
+    spans = []
+    span = tiles.span
+    monkeypatch.setattr(tiles, "span", lambda z, x, y: spans.append((z, x, y)) or span(z, x, y))
+    tiles.mask_within(-1.2001, 50, -1.2, 55.5)
+    assert len(spans) <= 4
+
+
+def test_tile_point_and_aggregated_counts(tile_set):
+    tiles = tile_set[0]
+    whole = tiles.tile(0, 0, 0)
+    assert whole["count"].sum() == 4990
+    x_range, y_range = tiles.tiles_covering(POINT_ZOOM, -5.5, 50, 1.8, 55.5)
+    rows = np.concatenate([tiles.tile(POINT_ZOOM, x, y)["row"] for x in x_range for y in y_range])
+    assert sorted(rows) == list(range(10, 5000))